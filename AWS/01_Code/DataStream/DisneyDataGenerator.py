@@ -9,12 +9,21 @@ Professor: Javi Briones
 """
 
 """ Import Libraries """
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import BotoCoreError, ClientError
+from botocore.config import Config
 from datetime import datetime, timedelta
+from collections import Counter
+import itertools
+import threading
+import argparse
 import logging
 import random
 import boto3
 import time
 import json
+import gzip
+import csv
 import os
 
 """ Variables """
@@ -33,6 +42,98 @@ AWS_ACCESS_KEY = os.getenv('AWS_ACCESS_KEY')
 AWS_SECRET_KEY = os.getenv('AWS_SECRET_KEY')
 REGION = os.getenv('AWS_REGION', 'eu-central-1')
 STREAM_NAME = os.getenv('KINESIS_STREAM_NAME', 'DisneyClickstream')
+SEED_DATA_DIR = os.getenv('SEED_DATA_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'AWS_Personalize', 'CSV'))
+
+""" Kinesis Limits """
+# PutRecords accepts up to 500 records and 5 MB per call, 1 MB per record (data + partition key)
+MAX_RECORDS_PER_CALL = 500
+MAX_BYTES_PER_CALL = 5 * 1024 * 1024
+MAX_BYTES_PER_RECORD = 1024 * 1024
+
+# Errors of a whole PutRecords call worth retrying, any other client error fails the call
+THROTTLING_ERROR_CODES = {"ProvisionedThroughputExceededException", "ThrottlingException", "KMSThrottlingException",
+                          "LimitExceededException"}
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | {"InternalFailure", "InternalServerError", "ServiceUnavailable"}
+
+""" Input Params """
+parser = argparse.ArgumentParser(description=('Disney+ User Interactions Data Generator'))
+
+parser.add_argument(
+    '--mode',
+    required=False,
+    choices=['record', 'batch', 'replay'],
+    default='record',
+    help=('record: one PutRecord call per event. batch: PutRecords load test at --rate records/sec. '
+          'replay: sends the events of the --input recording with PutRecords.'))
+
+parser.add_argument(
+    '--rate',
+    required=False,
+    type=float,
+    default=1000,
+    help='Target records per second across all the workers (batch mode).')
+
+parser.add_argument(
+    '--workers',
+    required=False,
+    type=int,
+    default=4,
+    help='Number of concurrent producer workers (batch mode).')
+
+parser.add_argument(
+    '--duration',
+    required=False,
+    type=float,
+    default=60,
+    help='Duration of the load test in seconds (batch mode).')
+
+parser.add_argument(
+    '--events',
+    required=False,
+    choices=['uniform', 'sessions'],
+    default='uniform',
+    help='uniform: random user, action and title. sessions: Play/Watch/Stop sessions with Zipf-distributed users and titles.')
+
+parser.add_argument(
+    '--seed',
+    required=False,
+    type=int,
+    default=None,
+    help='Seed of the event generator, for reproducible runs.')
+
+parser.add_argument(
+    '--zipf_exponent',
+    required=False,
+    type=float,
+    default=1.1,
+    help='Skew of the user and title popularity (sessions events).')
+
+parser.add_argument(
+    '--record',
+    required=False,
+    default=None,
+    help='Optional NDJSON.gz file where every generated event is recorded for later replay.')
+
+parser.add_argument(
+    '--input',
+    required=False,
+    default=None,
+    help='Recording to replay (replay mode).')
+
+parser.add_argument(
+    '--speed',
+    required=False,
+    type=float,
+    default=1.0,
+    help='Replay speed: 1 keeps the original timing, N replays N times faster, 0 replays as fast as possible.')
+
+parser.add_argument(
+    '--max_retries',
+    required=False,
+    type=int,
+    default=5,
+    help='Retries of the failed entries of a PutRecords call (batch mode).')
 
 """ Code: Helpful Functions """
 def generate_event():
@@ -55,23 +156,403 @@ def generate_event():
         "eventValue": None
     }
 
+""" Code: Shard Statistics """
+
+class ShardStats:
+
+    """
+    Thread-safe per-shard record counts taken from the PutRecord(s) responses,
+    logged periodically to detect hot shards before they throttle.
+    """
+
+    def __init__(self, shard_ids: list = None, interval_seconds: float = 10):
+
+        """
+        Parameters:
+            shard_ids (list): Open shards of the stream, so that idle shards are reported too.
+            interval_seconds (float): Minimum time between two logged summaries.
+        """
+
+        self.lock = threading.Lock()
+        self.counts = Counter({shard_id: 0 for shard_id in shard_ids or []})
+        self.interval_seconds = interval_seconds
+        self.last_log = time.monotonic()
+
+    def add(self, shard_id: str, count: int = 1):
+
+        with self.lock:
+            self.counts[shard_id] += count
+
+    def summary(self):
+
+        """
+        Returns:
+            dict: Records per shard, the hottest shard and its skew (records / mean records per shard).
+        """
+
+        with self.lock:
+            counts = dict(self.counts)
+
+        total = sum(counts.values())
+        hot_shard = max(counts, key=counts.get) if counts else None
+
+        return {
+            "records": total,
+            "shards": counts,
+            "hot_shard": hot_shard,
+            "skew": round(counts[hot_shard] * len(counts) / total, 2) if total else None
+        }
+
+    def maybe_log(self):
+
+        """
+        Logs the summary if the interval has elapsed since the last one.
+        """
+
+        with self.lock:
+            if time.monotonic() - self.last_log < self.interval_seconds:
+                return
+            self.last_log = time.monotonic()
+
+        logging.info(f"Shard distribution | {json.dumps(self.summary())}")
+
+def list_shard_ids(kinesis):
+
+    """
+    Returns the IDs of the open shards of the stream, or an empty list if they cannot be listed.
+    """
+
+    try:
+        # Closed parent shards of a resharded stream no longer receive records
+        response = kinesis.list_shards(StreamName=STREAM_NAME, ShardFilter={'Type': 'AT_LATEST'})
+        shard_ids = [shard["ShardId"] for shard in response["Shards"]]
+
+        # Follow-up pages only accept the token
+        while response.get("NextToken"):
+            response = kinesis.list_shards(NextToken=response["NextToken"])
+            shard_ids += [shard["ShardId"] for shard in response["Shards"]]
+
+        return shard_ids
+
+    except Exception as e:
+        logging.warning(f"Could not list the shards of the stream: {e}")
+        return []
+
+""" Code: Record and Replay """
+
+def recorded(event_source, path: str):
+
+    """
+    Wraps an event source so that every event is also appended to a recording.
+
+    Every line of the NDJSON.gz recording holds the generation time, the stream and the event:
+    {"t": 1735689600.123, "topic": "DisneyClickstream", "payload": {...}}
+
+    Parameters:
+        event_source (callable): Function that returns the next event.
+        path (str): Output file.
+
+    Returns:
+        tuple (callable, file): The recording event source and the file to close at the end.
+    """
+
+    lock = threading.Lock()
+    f = gzip.open(path, "wt", encoding="utf-8")
+
+    def _source():
+        event = event_source()
+        line = json.dumps({"t": time.time(), "topic": STREAM_NAME, "payload": event})
+        with lock:
+            f.write(line + "\n")
+        return event
+
+    return _source, f
+
+def read_recording(path: str):
+
+    """
+    Streams the (generation time, event) pairs of a recording in file order.
+    """
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            message = json.loads(line)
+            yield message["t"], message["payload"]
+
+""" Code: Session Generator """
+
+class SessionGenerator:
+
+    """
+    Generates clickstream events as viewing sessions (Play, one or more Watch, Stop)
+    seeded from the Personalize CSV datasets.
+
+    Users and titles are ranked by their number of interactions in interactions.csv and
+    drawn from a Zipf distribution over that ranking, so a few users and titles concentrate
+    most of the traffic as in production. The average number of Watch events per session and
+    the share of sessions that end with a Stop are taken from the interactions as well.
+    """
+
+    def __init__(self, data_dir: str = SEED_DATA_DIR, zipf_exponent: float = 1.1,
+                 concurrent_sessions: int = 50, seed: int = None):
+
+        """
+        Parameters:
+            data_dir (str): Directory with users.csv, items.csv and interactions.csv.
+            zipf_exponent (float): Skew of the popularity distribution (0 is uniform).
+            concurrent_sessions (int): Number of sessions interleaved at any time.
+            seed (int): Seed of the random generator.
+        """
+
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+        users = [row["USER_ID"] for row in self._read_csv(data_dir, "users.csv")]
+        titles = {row["ITEM_ID"]: row["TITLE"] for row in self._read_csv(data_dir, "items.csv")}
+        interactions = self._read_csv(data_dir, "interactions.csv")
+
+        user_counts = Counter(row["USER_ID"] for row in interactions)
+        item_counts = Counter(row["ITEM_ID"] for row in interactions)
+        event_counts = Counter(row["EVENT_TYPE"] for row in interactions)
+
+        # Most active first, ties in file order
+        self.users = sorted(users, key=lambda user: -user_counts[user])
+        self.items = [titles[item] for item in sorted(titles, key=lambda item: -item_counts[item])]
+
+        self.user_weights = self._zipf_weights(len(self.users), zipf_exponent)
+        self.item_weights = self._zipf_weights(len(self.items), zipf_exponent)
+
+        plays = max(event_counts["Play"], 1)
+        self.mean_watches = max(event_counts["Watch"] / plays, 1)
+        self.stop_probability = min(event_counts["Stop"] / plays, 1)
+
+        self.sessions = [self._new_session() for _ in range(concurrent_sessions)]
+
+    @staticmethod
+    def _read_csv(data_dir: str, file_name: str):
+
+        with open(os.path.join(data_dir, file_name), newline="", encoding="utf-8") as f:
+            return list(csv.DictReader(f))
+
+    @staticmethod
+    def _zipf_weights(n: int, exponent: float):
+
+        # Cumulative weights of the ranks 1..n
+        return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, n + 1)))
+
+    def _new_session(self):
+
+        """
+        Returns the user, title and remaining actions of a new session.
+        """
+
+        user_id = self.rng.choices(self.users, cum_weights=self.user_weights)[0]
+        item_id = self.rng.choices(self.items, cum_weights=self.item_weights)[0]
+
+        # Geometric number of Watch events with the observed mean
+        watches = 1
+        while self.rng.random() > 1 / self.mean_watches:
+            watches += 1
+
+        actions = ["Play"] + ["Watch"] * watches
+
+        if self.rng.random() < self.stop_probability:
+            actions.append("Stop")
+
+        return user_id, item_id, actions
+
+    def generate_event(self):
+
+        """
+        Advances a random active session and returns its next event.
+
+        Returns:
+            dict: A dictionary representing a clickstream event.
+        """
+
+        with self.lock:
+
+            index = self.rng.randrange(len(self.sessions))
+            user_id, item_id, actions = self.sessions[index]
+            action = actions.pop(0)
+
+            if not actions:
+                self.sessions[index] = self._new_session()
+
+        return {
+            "timestamp": datetime.utcnow().isoformat(),
+            "userId": user_id,
+            "eventType": action,
+            "itemId": item_id,
+            "eventValue": None
+        }
+
+def build_batches(events: list):
+
+    """
+    Splits events into PutRecords entries within the per-call record and size limits.
+
+    Parameters:
+        events (list): Clickstream events.
+
+    Returns:
+        list: Batches of PutRecords entries.
+    """
+
+    batches = [[]]
+    size = 0
+
+    for event in events:
+
+        data = json.dumps(event).encode('utf-8')
+        entry = {'Data': data, 'PartitionKey': event["userId"]}
+        entry_size = len(data) + len(entry['PartitionKey'])
+
+        if entry_size > MAX_BYTES_PER_RECORD:
+            logging.warning(f'Event of {entry_size} bytes exceeds the Kinesis record limit, skipping.')
+            continue
+
+        if len(batches[-1]) >= MAX_RECORDS_PER_CALL or size + entry_size > MAX_BYTES_PER_CALL:
+            batches.append([])
+            size = 0
+
+        batches[-1].append(entry)
+        size += entry_size
+
+    return [batch for batch in batches if batch]
+
+def put_records(kinesis, entries: list, max_retries: int = 5, shard_stats: ShardStats = None):
+
+    """
+    Sends a batch with PutRecords, retrying only the failed entries with exponential backoff.
+
+    Throttling, server and connection errors of the whole call are retried as well. Entries still
+    failing after the retries, or rejected with a non-retryable error, are counted as failed.
+
+    Parameters:
+        kinesis (Kinesis.Client): Kinesis client.
+        entries (list): PutRecords entries (Data, PartitionKey).
+        max_retries (int): Maximum number of retries of the failed entries.
+        shard_stats (ShardStats): Optional per-shard counts of the written records.
+
+    Returns:
+        dict: Number of sent and failed records, calls, and throttled entries.
+    """
+
+    stats = {"sent": 0, "failed": 0, "calls": 0, "throttled": 0}
+    error = None
+
+    for attempt in range(max_retries + 1):
+
+        if attempt:
+            time.sleep(min(0.05 * 2 ** attempt, 2) * random.uniform(0.5, 1))
+
+        stats["calls"] += 1
+
+        try:
+            response = kinesis.put_records(StreamName=STREAM_NAME, Records=entries)
+
+        except ClientError as err:
+            error = err
+            code = err.response.get("Error", {}).get("Code")
+
+            if code in THROTTLING_ERROR_CODES:
+                stats["throttled"] += len(entries)
+            elif code not in RETRYABLE_ERROR_CODES and \
+                    err.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) < 500:
+                break
+
+            continue
+
+        except BotoCoreError as err:
+            # Endpoint, connection and read timeout errors
+            error = err
+            continue
+
+        retry = []
+
+        # Results are in the same order as the entries
+        for entry, result in zip(entries, response["Records"]):
+
+            if "ErrorCode" not in result:
+                stats["sent"] += 1
+                if shard_stats is not None:
+                    shard_stats.add(result["ShardId"])
+                continue
+
+            if result["ErrorCode"] in THROTTLING_ERROR_CODES:
+                stats["throttled"] += 1
+
+            error = f'{result["ErrorCode"]}: {result.get("ErrorMessage")}'
+            retry.append(entry)
+
+        entries = retry
+
+        if not entries:
+            break
+
+    stats["failed"] = len(entries)
+
+    if entries:
+        logging.error(f'Failed to put {len(entries)} records after {stats["calls"]} calls: {error}')
+
+    return stats
+
+def run_producer(kinesis, rate: float, deadline: float, max_retries: int, totals: dict, lock: threading.Lock,
+                 event_source=generate_event, shard_stats: ShardStats = None):
+
+    """
+    Producer worker: sends the events due at the target rate until the deadline.
+    """
+
+    start = last_flush = time.monotonic()
+    due = 0
+
+    while time.monotonic() < deadline:
+
+        now = time.monotonic()
+        pending = int(rate * (now - start)) - due
+
+        # Send full batches right away, partial ones at most every 100 ms
+        if pending <= 0 or (pending < MAX_RECORDS_PER_CALL and now - last_flush < 0.1):
+            time.sleep(0.01)
+            continue
+
+        last_flush = now
+
+        pending = min(pending, MAX_RECORDS_PER_CALL)
+        due += pending
+
+        for batch in build_batches([event_source() for _ in range(pending)]):
+
+            stats = put_records(kinesis, batch, max_retries, shard_stats)
+
+            with lock:
+                for key, value in stats.items():
+                    totals[key] += value
+
+            if shard_stats is not None:
+                shard_stats.maybe_log()
 
 """ Code: Entry Point """
 
-def run_streaming(delay_seconds: int = 1):
+def run_streaming(delay_seconds: int = 1, event_source=generate_event):
 
     """
     Continuously generates and sends simulated clickstream events to an Amazon Kinesis Data Stream.
 
     Parameters:
         delay_seconds (int): Delay between events in seconds. Defaults to 1.
+        event_source (callable): Function that returns the next event.
     """
 
     # Cliente de Kinesis
     kinesis = boto3.client('kinesis', region_name=REGION)
 
+    shard_stats = ShardStats(list_shard_ids(kinesis), interval_seconds=60)
+
     while True:
-        event = generate_event()
+        event = event_source()
 
         logging.info(f"Event | {json.dumps(event)}")
 
@@ -82,12 +563,138 @@ def run_streaming(delay_seconds: int = 1):
                 PartitionKey=event["userId"]
             )
             logging.info(f'Event sent to Kinesis | ShardId: {response["ShardId"]}')
+            shard_stats.add(response["ShardId"])
+            shard_stats.maybe_log()
         
         except Exception as e:
             logging.info(f'Failed to send event', e)
 
         time.sleep(delay_seconds)
 
+def run_batch_streaming(rate: float = 1000, workers: int = 4, duration_seconds: float = 60, max_retries: int = 5,
+                        event_source=generate_event):
+
+    """
+    Load tests the Kinesis Data Stream with concurrent PutRecords producers at a target rate.
+
+    Parameters:
+        rate (float): Target records per second across all the workers.
+        workers (int): Number of concurrent producer workers.
+        duration_seconds (float): Duration of the load test.
+        max_retries (int): Retries of the failed entries of each call.
+        event_source (callable): Function that returns the next event.
+
+    Returns:
+        dict: Run summary with the achieved records/sec, the throttling counts and the records per shard.
+    """
+
+    # Clients are thread-safe, the pool is sized for the concurrent workers
+    kinesis = boto3.client('kinesis', region_name=REGION,
+                           config=Config(max_pool_connections=max(workers, 10)))
+
+    totals = {"sent": 0, "failed": 0, "calls": 0, "throttled": 0}
+    lock = threading.Lock()
+    shard_stats = ShardStats(list_shard_ids(kinesis))
+    failed_workers = 0
+
+    start = time.monotonic()
+    deadline = start + duration_seconds
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_producer, kinesis, rate / workers, deadline, max_retries, totals, lock,
+                                   event_source, shard_stats)
+                   for _ in range(workers)]
+
+        for future in futures:
+
+            # A failed worker stops sending but the others finish the run and the summary is still logged
+            try:
+                future.result()
+            except Exception:
+                logging.exception("Producer worker failed.")
+                failed_workers += 1
+
+    elapsed = time.monotonic() - start
+
+    summary = {
+        **totals,
+        "target_records_per_second": rate,
+        "failed_workers": failed_workers,
+        "records_per_second": round(totals["sent"] / elapsed, 1),
+        "elapsed_seconds": round(elapsed, 1),
+        "shard_distribution": shard_stats.summary()
+    }
+
+    logging.info(f"Run summary | {json.dumps(summary)}")
+
+    return summary
+
+def run_replay(path: str, speed: float = 1.0, max_retries: int = 5):
+
+    """
+    Replays a recording into the Kinesis Data Stream with PutRecords.
+
+    Parameters:
+        path (str): Recording to replay.
+        speed (float): Replay speed: 1 keeps the original timing, N is N times faster, 0 is as fast as possible.
+        max_retries (int): Retries of the failed entries of each call.
+
+    Returns:
+        dict: Run summary with the achieved records/sec, the throttling counts and the records per shard.
+    """
+
+    kinesis = boto3.client('kinesis', region_name=REGION)
+
+    totals = {"sent": 0, "failed": 0, "calls": 0, "throttled": 0}
+    shard_stats = ShardStats(list_shard_ids(kinesis))
+
+    recording = read_recording(path)
+    message = next(recording, None)
+    first = message[0] if message else None
+    pending = []
+
+    start = last_flush = time.monotonic()
+
+    while message is not None or pending:
+
+        now = time.monotonic()
+
+        # Events are due when their offset from the first one, divided by the speed, has elapsed
+        while message is not None and len(pending) < MAX_RECORDS_PER_CALL and \
+                (speed <= 0 or message[0] - first <= (now - start) * speed):
+            pending.append(message[1])
+            message = next(recording, None)
+
+        # Send full batches right away, partial ones at most every 100 ms
+        if not pending or (len(pending) < MAX_RECORDS_PER_CALL and message is not None and now - last_flush < 0.1):
+            time.sleep(0.01)
+            continue
+
+        last_flush = now
+
+        for batch in build_batches(pending):
+
+            for key, value in put_records(kinesis, batch, max_retries, shard_stats).items():
+                totals[key] += value
+
+            shard_stats.maybe_log()
+
+        pending = []
+
+    elapsed = time.monotonic() - start
+
+    summary = {
+        **totals,
+        "speed": speed,
+        "records_per_second": round(totals["sent"] / max(elapsed, 1e-9), 1),
+        "elapsed_seconds": round(elapsed, 1),
+        "shard_distribution": shard_stats.summary()
+    }
+
+    logging.info(f"Replay summary | {json.dumps(summary)}")
+
+    return summary
+
 """ Run """
 
 if __name__ == "__main__":
@@ -100,7 +707,34 @@ if __name__ == "__main__":
         # Run Generator
         logging.info('Initializing the data generator.')
 
-        run_streaming()
+        args, opts = parser.parse_known_args()
+
+        if args.mode == 'replay' and not args.input:
+            parser.error('--mode replay requires --input')
+
+        if args.events == 'sessions':
+            event_source = SessionGenerator(zipf_exponent=args.zipf_exponent, seed=args.seed).generate_event
+        else:
+            random.seed(args.seed)
+            event_source = generate_event
+
+        recording = None
+
+        if args.record and args.mode != 'replay':
+            event_source, recording = recorded(event_source, args.record)
+
+        try:
+            if args.mode == 'batch':
+                run_batch_streaming(rate=args.rate, workers=args.workers, duration_seconds=args.duration,
+                                    max_retries=args.max_retries, event_source=event_source)
+            elif args.mode == 'replay':
+                run_replay(args.input, speed=args.speed, max_retries=args.max_retries)
+            else:
+                run_streaming(event_source=event_source)
+
+        finally:
+            if recording:
+                recording.close()
 
         logging.info('Terminating the data generator.')
 
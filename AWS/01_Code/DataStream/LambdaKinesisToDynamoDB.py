@@ -9,9 +9,12 @@ Professor: Javi Briones
 """
 
 """ Import Libraries """
+from collections import deque
 import logging
+import hashlib
 import base64
 import boto3
+import time
 import json
 import os
 
@@ -20,10 +23,198 @@ logging.getLogger().setLevel(logging.INFO)
 
 """ Environment Variables """
 DYNAMO_DB_TABLE_NAME = os.getenv('DYNAMO_DB_TABLE_NAME', 'DisneyClickstreamTable')
+# Optional, e.g. http://localhost:8000 to test against DynamoDB Local
+DYNAMO_DB_ENDPOINT_URL = os.getenv('DYNAMO_DB_ENDPOINT_URL')
 
-dynamodb = boto3.resource('dynamodb')
+# Split failing batches in halves to isolate the failing records
+BISECT_ON_ERROR = os.getenv('BISECT_ON_ERROR', 'false').lower() == 'true'
+
+# DynamoDB BatchWriteItem accepts up to 25 items per request
+DYNAMO_DB_BATCH_SIZE = 25
+
+# Seconds between key skew summaries and number of heavy hitters reported
+KEY_SKEW_SUMMARY_SECONDS = float(os.getenv('KEY_SKEW_SUMMARY_SECONDS', '60'))
+KEY_SKEW_TOP_K = int(os.getenv('KEY_SKEW_TOP_K', '10'))
+
+dynamodb = boto3.resource('dynamodb', endpoint_url=DYNAMO_DB_ENDPOINT_URL)
 table = dynamodb.Table(DYNAMO_DB_TABLE_NAME)
 
+""" Code: Key Skew """
+
+class CountMinSketch:
+
+    """
+    Approximate write frequency per partition key in fixed memory, with the top-k heavy hitters.
+
+    Estimates never undercount; they overcount by at most e * total / width with
+    probability 1 - e ** -depth.
+    """
+
+    def __init__(self, width: int = 2048, depth: int = 4, top_k: int = 10):
+
+        self.width = width
+        self.depth = depth
+        self.top_k = top_k
+        self.rows = [[0] * width for _ in range(depth)]
+        self.heavy_hitters = {}
+        self.total = 0
+
+    def _indexes(self, key: str):
+
+        # One 64-bit hash per row, all taken from a single digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8 * self.depth).digest()
+
+        return [int.from_bytes(digest[8 * i:8 * (i + 1)], 'little') % self.width for i in range(self.depth)]
+
+    def add(self, key: str, count: int = 1):
+
+        """
+        Counts a write of the key and updates the heavy hitters.
+
+        Returns:
+            int: Estimated number of writes of the key.
+        """
+
+        estimate = None
+
+        for row, index in zip(self.rows, self._indexes(key)):
+            row[index] += count
+            estimate = row[index] if estimate is None else min(estimate, row[index])
+
+        self.total += count
+
+        if key in self.heavy_hitters or len(self.heavy_hitters) < self.top_k:
+            self.heavy_hitters[key] = estimate
+        else:
+            coldest = min(self.heavy_hitters, key=self.heavy_hitters.get)
+
+            if estimate > self.heavy_hitters[coldest]:
+                del self.heavy_hitters[coldest]
+                self.heavy_hitters[key] = estimate
+
+        return estimate
+
+    def summary(self):
+
+        """
+        Returns:
+            dict: Total writes and the heavy hitters with their estimated count and share of the writes.
+        """
+
+        top = sorted(self.heavy_hitters.items(), key=lambda item: -item[1])
+
+        return {
+            'writes': self.total,
+            'top_keys': [{'key': key, 'writes': count, 'share': round(count / self.total, 4)} for key, count in top]
+        }
+
+# Kept across the invocations served by the same execution environment
+key_sketch = CountMinSketch(top_k=KEY_SKEW_TOP_K)
+last_key_summary = time.monotonic()
+
+def track_keys(items: list):
+
+    """
+    Counts the written partition keys and logs the key skew summary every KEY_SKEW_SUMMARY_SECONDS.
+    """
+
+    global last_key_summary
+
+    for item in items:
+        key_sketch.add(item['user_id'])
+
+    if time.monotonic() - last_key_summary >= KEY_SKEW_SUMMARY_SECONDS:
+        last_key_summary = time.monotonic()
+        logging.info(f"Key skew summary: {json.dumps(key_sketch.summary())}")
+
+""" Code: Helpful Functions """
+
+def decode_records(records: list):
+
+    """
+    Decodes the Kinesis records into DynamoDB items in a single pass.
+
+    Parameters:
+        records (list): Kinesis records of the invocation.
+
+    Returns:
+        tuple (list, int): The (sequence number, item) pairs to insert and the number of
+            records that could not be decoded. Those are logged and dropped, a retry would fail again.
+    """
+
+    entries = []
+    invalid = 0
+
+    for record in records:
+
+        sequence_number = record['kinesis']['sequenceNumber']
+
+        try:
+            # Decode Kinesis Message
+            data = json.loads(base64.b64decode(record['kinesis']['data']))
+
+            entries.append((sequence_number, {
+                'user_id': data['userId'],
+                'timestamp': data['timestamp'],
+                'item': data['itemId']
+            }))
+
+        except Exception as err:
+            invalid += 1
+            logging.error(f"Failed to process record {sequence_number}: {err}")
+
+    return entries, invalid
+
+def write_batch(entries: list):
+
+    """
+    Writes up to 25 items with a BatchWriteItem request. The batch writer resends
+    the unprocessed items returned by DynamoDB until all of them are written.
+    """
+
+    # Items with the same key in a request are rejected, the last one wins
+    with table.batch_writer(overwrite_by_pkeys=['user_id', 'timestamp']) as batch:
+        for _, item in entries:
+            batch.put_item(Item=item)
+
+def write_items(entries: list, bisect: bool = BISECT_ON_ERROR):
+
+    """
+    Writes the items in batches of 25.
+
+    Parameters:
+        entries (list): (sequence number, item) pairs to insert.
+        bisect (bool): Split failing batches in halves until the failing records are isolated.
+            Otherwise every record of a failing batch is reported as failed.
+
+    Returns:
+        tuple (int, list): Number of BatchWriteItem requests and the sequence numbers of the failed records.
+    """
+
+    batches = 0
+    failed = []
+    # Chunks are written in stream order, so the newest record of a repeated key wins
+    pending = deque(entries[i:i + DYNAMO_DB_BATCH_SIZE] for i in range(0, len(entries), DYNAMO_DB_BATCH_SIZE))
+
+    while pending:
+
+        chunk = pending.popleft()
+        batches += 1
+
+        try:
+            write_batch(chunk)
+
+        except Exception as err:
+
+            if bisect and len(chunk) > 1:
+                middle = len(chunk) // 2
+                pending.extendleft([chunk[middle:], chunk[:middle]])
+            else:
+                failed.extend(sequence_number for sequence_number, _ in chunk)
+                logging.error(f"Failed to write {len(chunk)} records into DynamoDB: {err}")
+
+    return batches, failed
+
 """ Code: Entry point """
 
 def lambda_handler(event, context):
@@ -37,33 +228,33 @@ def lambda_handler(event, context):
         context (LambdaContext): Contains metadata about the invocation, function, and execution environment.
 
     Returns:
-        dict: A response object with HTTP statusCode and body indicating the result.
+        dict: A response object with HTTP statusCode and body indicating the result, and the
+            batchItemFailures (sequence numbers) so that only the records that failed to be written are retried.
     """
 
-    for record in event['Records']:
+    start = time.monotonic()
 
-        # Decode Kinesis Message
-        payload = base64.b64decode(record['kinesis']['data'])
+    entries, invalid = decode_records(event['Records'])
 
-        try:
-            data = json.loads(payload)
-            logging.info(f"Event received: {data}")
+    # Insert into DynamoDB
+    batches, failed = write_items(entries)
 
-            # Insert into DynamoDB
-            response = table.put_item(
-                Item={
-                    'user_id': data['userId'],
-                    'timestamp': data['timestamp'],
-                    'item': data['itemId']
-                }
-            )
+    not_written = set(failed)
+    track_keys([item for sequence_number, item in entries if sequence_number not in not_written])
 
-            logging.info("Successfully inserted into DynamoDB.")
+    metrics = {
+        'records': len(event['Records']),
+        'written': len(entries) - len(failed),
+        'invalid': invalid,
+        'failed': len(failed),
+        'batches': batches,
+        'duration_ms': round((time.monotonic() - start) * 1000, 1)
+    }
 
-        except Exception as err:
-            logging.error(f"Failed to process record: {err}")
+    logging.info(f"Invocation metrics: {json.dumps(metrics)}")
 
     return {
         'statusCode': 200,
-        'body': 'Processed {} records.'.format(len(event['Records']))
+        'body': 'Processed {} records.'.format(len(event['Records'])),
+        'batchItemFailures': [{'itemIdentifier': sequence_number} for sequence_number in failed]
     }
@@ -3,7 +3,10 @@ import json
 import logging
 import base64
 import time
-from datetime import datetime
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from collections import deque
 
 # Configure logging
 logger = logging.getLogger()
@@ -16,22 +19,41 @@ personalize_events_client = boto3.client('personalize-events')
 PERSONALIZE_TRACKING_ID = 'YOUR_PERSONALIZE_TRACKING_ID'
 USER_ID_DEFAULT = 'anonymous'
 
+# PutEvents accepts up to 10 events per call
+MAX_EVENTS_PER_CALL = 10
+
+# Users sent concurrently
+PERSONALIZE_MAX_WORKERS = int(os.getenv('PERSONALIZE_MAX_WORKERS', '8'))
+
+# Split failing batches in halves to isolate the failing records
+BISECT_ON_ERROR = os.getenv('BISECT_ON_ERROR', 'false').lower() == 'true'
+
 def lambda_handler(event, context):
     """
     AWS Lambda handler to process Kinesis records and send events to Amazon Personalize.
 
+    The events are grouped by user (used as the session ID) and sent in batches of up to
+    10 events per PutEvents call, several users at a time.
+
     Args:
         event (dict): Event payload from Kinesis.
         context (object): Lambda context runtime methods and attributes.
+
+    Returns:
+        dict: The batchItemFailures (sequence numbers) of the records that could not be sent,
+            so that only those records are retried.
     """
     logger.info("Lambda triggered with Kinesis event")
 
+    failed = []
+    sessions = {}
+
     for record in event['Records']:
         try:
             # Decode base64 payload
             payload = base64.b64decode(record['kinesis']['data']).decode('utf-8')
             data = json.loads(payload)
-            logger.info(f"Decoded record: {data}")
+            logger.debug(f"Decoded record: {data}")
 
             user_id = data.get('userId', USER_ID_DEFAULT)
             item_id = data.get('itemId')
@@ -43,47 +65,109 @@ def lambda_handler(event, context):
                 logger.warning("Record missing itemId or eventType, skipping.")
                 continue
 
-            send_event_to_personalize(
-                tracking_id=PERSONALIZE_TRACKING_ID,
-                user_id=user_id,
-                item_id=item_id,
-                event_type=event_type,
-                event_value=event_value,
-                timestamp=timestamp
-            )
+            # Records keep their stream order within each user
+            sessions.setdefault(user_id, []).append((
+                record['kinesis']['sequenceNumber'],
+                build_event(item_id, event_type, event_value, timestamp)
+            ))
 
         except Exception as e:
+            # Dropped, a retry would fail again and block the shard
             logger.error(f"Error processing record: {e}", exc_info=True)
 
-def send_event_to_personalize(tracking_id, user_id, item_id, event_type, event_value=None, timestamp=None):
+    with ThreadPoolExecutor(max_workers=PERSONALIZE_MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(send_events_to_personalize, PERSONALIZE_TRACKING_ID, user_id, entries)
+            for user_id, entries in sessions.items()
+        ]
+
+        for future in futures:
+            failed += future.result()
+
+    logger.info(f"Sent {sum(len(entries) for entries in sessions.values())} events "
+                f"for {len(sessions)} users, {len(failed)} records failed")
+
+    return {'batchItemFailures': [{'itemIdentifier': sequence_number} for sequence_number in failed]}
+
+def parse_timestamp(timestamp):
     """
-    Send an event to Amazon Personalize using the PutEvents API.
+    Converts the timestamp of a record into a timezone-aware datetime.
+
+    Args:
+        timestamp (str | int | float): ISO 8601 string (UTC if no offset) or Unix timestamp.
+
+    Returns:
+        datetime: The event time in UTC.
+    """
+    if isinstance(timestamp, (int, float)):
+        return datetime.fromtimestamp(timestamp, tz=timezone.utc)
+
+    sent_at = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+
+    return sent_at if sent_at.tzinfo else sent_at.replace(tzinfo=timezone.utc)
+
+def build_event(item_id, event_type, event_value=None, timestamp=None):
+    """
+    Builds a PutEvents event, sent at the time the record was generated.
 
     Args:
-        tracking_id (str): Amazon Personalize tracking ID.
-        user_id (str): ID of the user who triggered the event.
         item_id (str): ID of the item involved in the event.
         event_type (str): Type of the event (e.g. 'click', 'purchase').
         event_value (float, optional): Numeric value associated with the event.
-        timestamp (int, optional): Unix timestamp of the event.
+        timestamp (str | int, optional): Time of the event, ISO 8601 or Unix timestamp.
+
+    Returns:
+        dict: The event.
     """
     if timestamp is None:
         timestamp = int(time.time())
 
-    event = {
+    return {
         'eventType': event_type,
-        'sentAt': datetime.utcnow().isoformat(),
+        'sentAt': parse_timestamp(timestamp),
         'properties': json.dumps({
             'itemId': item_id,
             'eventValue': event_value
         })
     }
 
-    personalize_events_client.put_events(
-        trackingId=tracking_id,
-        userId=user_id,
-        sessionId=user_id, 
-        eventList=[event]
-    )
+def send_events_to_personalize(tracking_id, user_id, entries, bisect=BISECT_ON_ERROR):
+    """
+    Send the events of a user to Amazon Personalize using the PutEvents API, up to 10 events per call.
+
+    Args:
+        tracking_id (str): Amazon Personalize tracking ID.
+        user_id (str): ID of the user who triggered the events, also used as the session ID.
+        entries (list): (sequence number, event) pairs in stream order.
+        bisect (bool): Split failing batches in halves until the failing records are isolated.
+            Otherwise every record of a failing batch is reported as failed.
+
+    Returns:
+        list: Sequence numbers of the records whose call failed.
+    """
+    failed = []
+    # Batches are sent in stream order
+    pending = deque(entries[i:i + MAX_EVENTS_PER_CALL] for i in range(0, len(entries), MAX_EVENTS_PER_CALL))
+
+    while pending:
+        batch = pending.popleft()
+
+        try:
+            personalize_events_client.put_events(
+                trackingId=tracking_id,
+                userId=user_id,
+                sessionId=user_id,
+                eventList=[event for _, event in batch]
+            )
+
+            logger.debug(f"{len(batch)} events pushed to Personalize for user {user_id}")
+
+        except Exception as e:
+            if bisect and len(batch) > 1:
+                middle = len(batch) // 2
+                pending.extendleft([batch[middle:], batch[:middle]])
+            else:
+                failed += [sequence_number for sequence_number, _ in batch]
+                logger.error(f"Error sending {len(batch)} events for user {user_id}: {e}")
 
-    logger.info(f"Event pushed to Personalize for user {user_id}, item {item_id}")
+    return failed
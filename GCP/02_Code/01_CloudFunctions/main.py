@@ -37,12 +37,20 @@ def get_pubsub_message(cloud_event):
     pubsub_msg = base64.b64decode(cloud_event.data["message"]["data"])
     msg = json.loads(pubsub_msg)
 
-    # Find the nearest Supercharger (optional)
-    # ToDo
+    # Find the nearest Supercharger (optional), looked up by the pipeline with --superchargers
+    superchargers = msg.get("superchargers") or {}
+    nearest = superchargers.get("nearest") or []
+
+    if nearest:
+        supercharger = (f"Nearest Supercharger: {nearest[0]['name']} at {nearest[0]['distance_km']} km "
+                        f"({superchargers['reachable']} reachable with the remaining autonomy).")
+    else:
+        supercharger = ""
 
     # Notification content
     content = f"""
         {msg['message']}
+        {supercharger}
     """
 
     # Print out the message to simulate a call to Firebase
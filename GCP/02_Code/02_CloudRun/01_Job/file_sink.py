@@ -0,0 +1,271 @@
+"""
+Script: BigQuery File Sink
+
+Description: Writes the exported rows to local newline-delimited JSON or Parquet chunk files
+    and loads them into BigQuery with load jobs, a cheaper ingestion path than streaming
+    inserts for batch dumps.
+
+    Run this script directly to benchmark the serialization throughput offline
+    with synthetic rows (no GCP credentials needed):
+
+        python file_sink.py --rows 200000 --format parquet
+
+EDEM. Master Big Data & Cloud 2024/2025
+Professor: Javi Briones
+"""
+
+""" Import Libraries """
+
+import argparse
+import resource
+import logging
+import random
+import time
+import json
+import os
+
+""" Variables """
+
+FILE_FORMATS = ("ndjson", "parquet")
+
+# Schema of the BigQuery table, as created from 03_BigQuery/schema.json. The job image
+# only contains this directory, so this is the single definition used by the export
+SCHEMA = [
+    {"name": "vehicle_id", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "event", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "timestamp", "type": "STRING", "mode": "NULLABLE"},
+    {"name": "payload", "type": "JSON", "mode": "NULLABLE"}
+]
+
+""" Code """
+
+def validate_row(row: dict, schema: list):
+
+    """
+    Checks that a row only contains fields of the schema and that REQUIRED fields are present.
+
+    Raises:
+        ValueError: If the row does not match the schema.
+    """
+
+    names = {field["name"] for field in schema}
+    unknown = row.keys() - names
+
+    if unknown:
+        raise ValueError(f"Fields not in the BigQuery schema: {sorted(unknown)}")
+
+    for field in schema:
+        if field.get("mode") == "REQUIRED" and row.get(field["name"]) is None:
+            raise ValueError(f"Missing required field: {field['name']}")
+
+def _write_ndjson(path: str, rows: list, schema: list):
+
+    # JSON columns are written as raw JSON so the load job stores objects, not strings
+    json_fields = {field["name"] for field in schema if field["type"] == "JSON"}
+
+    with open(path, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write("{" + ",".join(
+                f"{json.dumps(key)}:{value if key in json_fields and value is not None else json.dumps(value)}"
+                for key, value in row.items()) + "}\n")
+
+def _write_parquet(path: str, rows: list, schema: list):
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # JSON columns are stored as strings and parsed by BigQuery against the load job schema
+    arrow_schema = pa.schema([(field["name"], pa.string()) for field in schema])
+    columns = {field["name"]: [row.get(field["name"]) for row in rows] for field in schema}
+
+    pq.write_table(pa.Table.from_pydict(columns, schema=arrow_schema), path, compression="snappy")
+
+def iter_chunk_files(rows, directory: str, file_format: str = "ndjson",
+                     rows_per_file: int = 100000, schema: list = None):
+
+    """
+    Writes rows to chunk files of at most rows_per_file rows, yielding every file as soon as it is written.
+
+    Parameters:
+        rows (iterable): Rows to write.
+        directory (str): Output directory.
+        file_format (str): "ndjson" or "parquet".
+        rows_per_file (int): Maximum number of rows per file.
+        schema (list): BigQuery schema the rows are validated against.
+
+    Yields:
+        str: Path of the written file.
+    """
+
+    if file_format not in FILE_FORMATS:
+        raise ValueError(f"Unsupported file format: {file_format}")
+
+    schema = schema or SCHEMA
+    writer = _write_ndjson if file_format == "ndjson" else _write_parquet
+    extension = "json" if file_format == "ndjson" else "parquet"
+
+    os.makedirs(directory, exist_ok=True)
+
+    index = 0
+    chunk = []
+
+    for row in rows:
+
+        validate_row(row, schema)
+        chunk.append(row)
+
+        if len(chunk) >= rows_per_file:
+            path = os.path.join(directory, f"chunk-{index:05d}.{extension}")
+            writer(path, chunk, schema)
+            index += 1
+            chunk = []
+            yield path
+
+    if chunk:
+        path = os.path.join(directory, f"chunk-{index:05d}.{extension}")
+        writer(path, chunk, schema)
+        yield path
+
+def write_chunk_files(rows, directory: str, file_format: str = "ndjson",
+                      rows_per_file: int = 100000, schema: list = None):
+
+    """
+    Writes all the rows to chunk files, see iter_chunk_files.
+
+    Returns:
+        list: Paths of the written files.
+    """
+
+    return list(iter_chunk_files(rows, directory, file_format, rows_per_file, schema))
+
+def load_chunk_files(client, paths, table_ref, file_format: str = "ndjson", schema: list = None,
+                     max_in_flight: int = 2):
+
+    """
+    Loads the chunk files into BigQuery as they are written and deletes every file once its
+    job has finished, so only max_in_flight files are kept on disk (memory-backed on Cloud Run).
+
+    Parameters:
+        client (bigquery.Client): BigQuery client.
+        paths (iterable): Paths of the chunk files, e.g. from iter_chunk_files.
+        table_ref (TableReference): Destination table.
+        file_format (str): "ndjson" or "parquet".
+        schema (list): BigQuery schema of the table.
+        max_in_flight (int): Maximum number of load jobs (and files) pending at once.
+
+    Returns:
+        tuple (int, int, list): Number of loaded rows and files, and the indexes of the files whose load job failed.
+    """
+
+    from google.cloud import bigquery
+
+    schema = schema or SCHEMA
+
+    job_config = bigquery.LoadJobConfig(
+        source_format=(bigquery.SourceFormat.NEWLINE_DELIMITED_JSON if file_format == "ndjson"
+                       else bigquery.SourceFormat.PARQUET),
+        schema=[bigquery.SchemaField(field["name"], field["type"], mode=field.get("mode", "NULLABLE"))
+                for field in schema],
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+
+    pending = []
+    loaded = 0
+    files = 0
+    failed = []
+
+    def _finish(index, path, job):
+
+        nonlocal loaded
+
+        try:
+            job.result()
+            loaded += job.output_rows
+
+        except Exception as err:
+            failed.append(index)
+            logging.error("Load job of %s failed: %s", path, err)
+
+        finally:
+            os.remove(path)
+
+    try:
+        for index, path in enumerate(paths):
+
+            files += 1
+
+            try:
+                with open(path, "rb") as f:
+                    job = client.load_table_from_file(f, table_ref, job_config=job_config)
+
+            except Exception as err:
+                failed.append(index)
+                logging.error("Load job of %s could not be submitted: %s", path, err)
+                os.remove(path)
+                continue
+
+            pending.append((index, path, job))
+
+            if len(pending) >= max_in_flight:
+                _finish(*pending.pop(0))
+
+        while pending:
+            _finish(*pending.pop(0))
+
+    finally:
+        # An error while writing or loading leaves no files behind
+        for _, path, _ in pending:
+            if os.path.exists(path):
+                os.remove(path)
+
+    return loaded, files, failed
+
+""" Benchmark """
+
+def generate_rows(num_rows: int, num_vehicles: int = 1000, seed: int = 42):
+
+    """
+    Generates synthetic rows shaped like the Firestore export.
+    """
+
+    rng = random.Random(seed)
+
+    for i in range(num_rows):
+
+        vehicle_id = f"V{rng.randint(1, num_vehicles):05d}"
+
+        yield {
+            "vehicle_id": vehicle_id,
+            "event": rng.choice(["critical_battery_users", "non_critical_battery_users"]),
+            "timestamp": f"2025-01-01T00:{(i // 60) % 60:02d}:{i % 60:02d}Z",
+            "payload": json.dumps({
+                "vehicle_id": vehicle_id,
+                "battery_info": {"battery_level": rng.randint(10, 100), "event_type": "driving"},
+                "driving_info": {"avg_speed": rng.uniform(0, 120), "avg_braking_force": rng.uniform(-1, 0)},
+                "environment_info": {"avg_temperature": rng.uniform(-10, 35), "avg_humidity": rng.uniform(20, 80)}
+            })
+        }
+
+if __name__ == "__main__":
+
+    # Set Logs
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description=('Offline serialization benchmark of the file sink'))
+    parser.add_argument('--rows', type=int, default=200000, help='Number of synthetic rows.')
+    parser.add_argument('--format', choices=FILE_FORMATS, default='ndjson', help='Output file format.')
+    parser.add_argument('--rows_per_file', type=int, default=100000, help='Maximum rows per chunk file.')
+    parser.add_argument('--output_dir', default='/tmp/file_sink_benchmark', help='Output directory.')
+    args = parser.parse_args()
+
+    rows = list(generate_rows(args.rows))
+
+    start = time.monotonic()
+    paths = write_chunk_files(rows, args.output_dir, args.format, args.rows_per_file)
+    elapsed = time.monotonic() - start
+
+    size_mb = sum(os.path.getsize(path) for path in paths) / 1024 / 1024
+
+    logging.info("Wrote %d rows to %d %s files (%.1f MB) in %.2f s: %.1f rows/s, %.1f MB/s, peak memory %.1f MB.",
+                 args.rows, len(paths), args.format, size_mb, elapsed, args.rows / elapsed, size_mb / elapsed,
+                 # ru_maxrss is reported in kilobytes on Linux
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
@@ -1,4 +1,4 @@
-""" 
+"""
 Script: Cloud Run Job
 
 Description: Cloud Run Job to execute data dumps from Firestore to BigQuery.
@@ -9,28 +9,188 @@ Professor: Javi Briones
 
 """ Import Libraries """
 
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from google.cloud import firestore
 from google.cloud import bigquery
+from google.cloud.firestore_v1.base_query import FieldFilter
+import resource
 import logging
+import time
 import json
 import os
 
-# Configure clients
-firestore_client = firestore.Client()
-bigquery_client = bigquery.Client()
+# Custom Modules
+import file_sink
 
 # Environment Variables
 FIRESTORE_COLLECTION = os.getenv('FIRESTORE_COLLECTION')
 BIGQUERY_DATASET = os.getenv('BIGQUERY_DATASET')
 BIGQUERY_TABLE = os.getenv('BIGQUERY_TABLE')
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', '8'))
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '500'))
+EXPORT_CHUNK_BYTES = int(os.getenv('EXPORT_CHUNK_BYTES', str(5 * 1024 * 1024)))
+EXPORT_MODE = os.getenv('EXPORT_MODE', 'full')
+EXPORT_STATE_COLLECTION = os.getenv('EXPORT_STATE_COLLECTION', f'{FIRESTORE_COLLECTION}_export_state')
+EXPORT_SINK = os.getenv('EXPORT_SINK', 'streaming')
+EXPORT_SINKS = ('streaming', 'load', 'local')
+EXPORT_FILE_FORMAT = os.getenv('EXPORT_FILE_FORMAT', 'ndjson')
+EXPORT_FILE_ROWS = int(os.getenv('EXPORT_FILE_ROWS', '100000'))
+EXPORT_DIR = os.getenv('EXPORT_DIR', '/tmp/export')
 
 """ Code """
 
+# Clients are created on first use, EXPORT_SINK=local never needs BigQuery
+firestore_client = None
+bigquery_client = None
+
+def get_firestore_client():
+
+    global firestore_client
+
+    if firestore_client is None:
+        firestore_client = firestore.Client()
+
+    return firestore_client
+
+def get_bigquery_client():
+
+    global bigquery_client
+
+    if bigquery_client is None:
+        bigquery_client = bigquery.Client()
+
+    return bigquery_client
+
+def load_watermarks(state_collection: str = EXPORT_STATE_COLLECTION):
+
+    """
+    Loads the export high-water marks: the last exported sub-document ID (a timestamp)
+    of every vehicle and subcollection.
+
+    Parameters:
+        state_collection (str): The Firestore collection where the watermarks are stored.
+
+    Returns:
+        dict: {vehicle_id: {subcollection_name: last exported document ID}}
+    """
+
+    return {doc.id: doc.to_dict() for doc in get_firestore_client().collection(state_collection).stream()}
+
+def save_watermarks(watermarks: dict, state_collection: str = EXPORT_STATE_COLLECTION):
+
+    """
+    Persists the export high-water marks, merging them with the stored ones.
+
+    Parameters:
+        watermarks (dict): {vehicle_id: {subcollection_name: last exported document ID}}
+        state_collection (str): The Firestore collection where the watermarks are stored.
+
+    Returns:
+        None
+    """
+
+    client = get_firestore_client()
+    collection_ref = client.collection(state_collection)
+    items = list(watermarks.items())
+
+    # Firestore batches accept up to 500 writes
+    for i in range(0, len(items), 500):
+
+        batch = client.batch()
+
+        for vehicle_id, marks in items[i:i + 500]:
+            batch.set(collection_ref.document(vehicle_id), marks, merge=True)
+
+        batch.commit()
+
+def get_vehicle_rows(doc, watermarks: dict = None):
+
+    """
+    Retrieves the rows of a single vehicle document from all its subcollections.
+
+    Parameters:
+        doc (DocumentReference): The Firestore document of the vehicle.
+        watermarks (dict): Optional {subcollection_name: last exported document ID}.
+            Only newer documents are retrieved.
+
+    Returns:
+        list: A list of dictionaries containing vehicle_id, event name,
+            timestamp, and payload (JSON string format).
+    """
+
+    vehicle_id = doc.id
+    watermarks = watermarks or {}
+    data = []
+
+    # Retrieve subcollections
+    for subcollection in doc.collections():
+        subcollection_name = subcollection.id
+
+        query = subcollection
+        watermark = watermarks.get(subcollection_name)
+
+        # Sub-document IDs are timestamps, so the ID order is the time order
+        if watermark:
+            query = subcollection.where(filter=FieldFilter("__name__", ">", subcollection.document(watermark)))
+
+        for sub_doc in query.stream():
+
+            # Build the output format
+            data.append({
+                "vehicle_id": vehicle_id,
+                "event": subcollection_name,
+                "timestamp": sub_doc.id,
+                "payload": json.dumps(sub_doc.to_dict())
+            })
+
+    return data
+
+def iter_documents_with_subcollections(collection_name: str, max_workers: int = EXPORT_WORKERS,
+                                       watermarks: dict = None):
+
+    """
+    Streams the rows of a Firestore collection along with their nested subcollections,
+    reading several vehicles in parallel.
+
+    Only a bounded number of vehicles is in flight at any time, so memory does not
+    grow with the size of the collection.
+
+    Parameters:
+        collection_name (str): The name of the Firestore collection to retrieve documents from.
+        max_workers (int): Number of vehicles read concurrently.
+        watermarks (dict): Optional {vehicle_id: {subcollection_name: last exported document ID}}
+            to retrieve only the documents newer than the last export.
+
+    Yields:
+        dict: A row with vehicle_id, event name, timestamp, and payload (JSON string format).
+    """
+
+    documents = get_firestore_client().collection(collection_name).list_documents()
+    watermarks = watermarks or {}
+    max_in_flight = 2 * max_workers
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+
+        pending = set()
+
+        for doc in documents:
+
+            pending.add(executor.submit(get_vehicle_rows, doc, watermarks.get(doc.id)))
+
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    yield from future.result()
+
+        for future in pending:
+            yield from future.result()
+
 def get_all_documents_with_subcollections(collection_name: str):
 
     """
     Retrieves all documents from a Firestore collection along with their nested subcollections.
-    
+
     Parameters:
         collection_name (str): The name of the Firestore collection to retrieve documents from.
 
@@ -39,66 +199,214 @@ def get_all_documents_with_subcollections(collection_name: str):
             timestamp, and payload (JSON string format).
     """
 
-    collection_ref = firestore_client.collection(collection_name)
-    documents = collection_ref.list_documents()
-    
-    data = []
+    return list(iter_documents_with_subcollections(collection_name))
 
-    for doc in documents:
-        vehicle_id = doc.id  
+def iter_chunks(rows, chunk_size: int = EXPORT_CHUNK_SIZE, chunk_bytes: int = EXPORT_CHUNK_BYTES):
 
-        # Retrieve subcollections
-        subcollections = doc.collections()
-        for subcollection in subcollections:
-            subcollection_name = subcollection.id 
-            sub_docs = subcollection.stream()
+    """
+    Groups rows into chunks bounded by number of rows and approximate size in bytes.
 
-            for sub_doc in sub_docs:
-                doc_dict = {} 
-                sub_doc_dict = sub_doc.to_dict()
+    Parameters:
+        rows (iterable): Rows to group.
+        chunk_size (int): Maximum number of rows per chunk.
+        chunk_bytes (int): Maximum approximate size of a chunk in bytes.
 
-                # Build the output format
-                doc_dict["vehicle_id"] = vehicle_id
-                doc_dict["event"] = subcollection_name
-                doc_dict["timestamp"] = sub_doc.id
-                doc_dict["payload"] = json.dumps(sub_doc_dict) 
+    Yields:
+        list: A chunk of rows.
+    """
 
-                # Add row to dataset
-                data.append(doc_dict)
-    
-    return data
+    chunk = []
+    size = 0
+
+    for row in rows:
+
+        row_size = len(row["payload"]) + 100
+
+        if chunk and (len(chunk) >= chunk_size or size + row_size > chunk_bytes):
+            yield chunk
+            chunk, size = [], 0
+
+        chunk.append(row)
+        size += row_size
+
+    if chunk:
+        yield chunk
+
+def row_id(row: dict):
+
+    """
+    Deterministic ID of a row, used by BigQuery to drop duplicated inserts.
+    """
+
+    return f"{row['vehicle_id']}/{row['event']}/{row['timestamp']}"
 
 def upload_to_bigquery(data: list):
 
     """
     Uploads the data to BigQuery in JSON format.
-    
+
     Parameters:
         data (list): A list of dictionaries containing the data to be uploaded to BigQuery.
-    
+
     Returns:
-        None
+        list: Insert errors returned by BigQuery (empty if successful).
     """
 
-    table_ref = bigquery_client.dataset(BIGQUERY_DATASET).table(BIGQUERY_TABLE)
+    client = get_bigquery_client()
+    table_ref = client.dataset(BIGQUERY_DATASET).table(BIGQUERY_TABLE)
 
-    errors = bigquery_client.insert_rows_json(table_ref, data)
+    errors = client.insert_rows_json(table_ref, data, row_ids=[row_id(row) for row in data])
 
     if errors:
-        logging.error(" Error inserting into BigQuery:", errors)
+        logging.error("Error inserting into BigQuery: %s", errors)
     else:
         logging.info("Data successfully inserted into BigQuery.")
 
+    return errors
+
+def exported_watermarks(watermarks: dict, failed: set):
+
+    """
+    Nests the new watermarks by vehicle. Subcollections with failed rows keep their
+    previous watermark and are retried next run.
+
+    Parameters:
+        watermarks (dict): {(vehicle_id, subcollection_name): last exported document ID}
+        failed (set): (vehicle_id, subcollection_name) pairs with rows that were not exported.
+
+    Returns:
+        dict: {vehicle_id: {subcollection_name: last exported document ID}}
+    """
+
+    nested = {}
+
+    for (vehicle_id, event), timestamp in watermarks.items():
+        if (vehicle_id, event) not in failed:
+            nested.setdefault(vehicle_id, {})[event] = timestamp
+
+    return nested
+
+def stream_to_bigquery(rows):
+
+    """
+    Uploads the rows to BigQuery in bounded chunks as they are read.
+
+    Parameters:
+        rows (iterable): Rows to upload.
+
+    Returns:
+        dict: Number of uploaded rows, chunks and chunks with errors, and the new
+            watermarks of the vehicles and subcollections whose rows were all uploaded.
+    """
+
+    stats = {"rows": 0, "chunks": 0, "failed_chunks": 0}
+    watermarks = {}
+    failed = set()
+
+    for chunk in iter_chunks(rows):
+
+        chunk_failed = bool(upload_to_bigquery(chunk))
+
+        for row in chunk:
+
+            key = (row["vehicle_id"], row["event"])
+
+            if chunk_failed:
+                failed.add(key)
+            elif row["timestamp"] > watermarks.get(key, ""):
+                watermarks[key] = row["timestamp"]
+
+        stats["failed_chunks"] += chunk_failed
+        stats["rows"] += len(chunk)
+        stats["chunks"] += 1
+
+    stats["watermarks"] = exported_watermarks(watermarks, failed)
+
+    return stats
+
+def load_to_bigquery(rows, load: bool = True):
+
+    """
+    Writes the rows to local chunk files and, unless load is False, loads every file
+    into BigQuery with a load job as soon as it is written and then deletes it.
+
+    Parameters:
+        rows (iterable): Rows to export.
+        load (bool): Submit the load jobs. If False, only the local files are written.
+
+    Returns:
+        dict: Number of exported rows, written files and files whose load job failed, and the
+            new watermarks of the vehicles and subcollections whose rows were all loaded.
+    """
+
+    stats = {"rows": 0}
+    watermarks = {}
+    file_keys = []
+
+    def _track(rows):
+        for row in rows:
+
+            # iter_chunk_files starts a new file every EXPORT_FILE_ROWS rows
+            if stats["rows"] % EXPORT_FILE_ROWS == 0:
+                file_keys.append(set())
+
+            key = (row["vehicle_id"], row["event"])
+            file_keys[-1].add(key)
+
+            if row["timestamp"] > watermarks.get(key, ""):
+                watermarks[key] = row["timestamp"]
+
+            stats["rows"] += 1
+            yield row
+
+    paths = file_sink.iter_chunk_files(_track(rows), EXPORT_DIR, EXPORT_FILE_FORMAT, EXPORT_FILE_ROWS)
+    failed_files = []
+
+    if load:
+        client = get_bigquery_client()
+        table_ref = client.dataset(BIGQUERY_DATASET).table(BIGQUERY_TABLE)
+        loaded, files, failed_files = file_sink.load_chunk_files(client, paths, table_ref, EXPORT_FILE_FORMAT)
+        logging.info("%d rows successfully loaded into BigQuery.", loaded)
+    else:
+        files = len(list(paths))
+
+    failed = set().union(*(file_keys[index] for index in failed_files))
+
+    return {"rows": stats["rows"], "chunks": files, "failed_chunks": len(failed_files),
+            "watermarks": exported_watermarks(watermarks, failed)}
+
 if __name__ == "__main__":
 
     # Set Logs
     logging.getLogger().setLevel(logging.INFO)
-    
-    # Retrieve data from Firestore
-    documents = get_all_documents_with_subcollections(FIRESTORE_COLLECTION)
 
-    if documents:
-        # Upload to BigQuery
-        upload_to_bigquery(documents)
+    # A typo would export nothing and still advance the watermarks in incremental mode
+    if EXPORT_SINK not in EXPORT_SINKS:
+        raise ValueError(f"Unsupported EXPORT_SINK: {EXPORT_SINK!r}, expected one of {EXPORT_SINKS}")
+
+    start = time.monotonic()
+
+    incremental = EXPORT_MODE == 'incremental'
+    watermarks = load_watermarks() if incremental else None
+
+    rows = iter_documents_with_subcollections(FIRESTORE_COLLECTION, watermarks=watermarks)
+
+    if EXPORT_SINK == 'streaming':
+        # Stream data from Firestore to BigQuery
+        stats = stream_to_bigquery(rows)
+    else:
+        # Load data from Firestore to BigQuery through files ('local' only writes the files)
+        stats = load_to_bigquery(rows, load=EXPORT_SINK == 'load')
+
+    if incremental and stats["watermarks"] and EXPORT_SINK != 'local':
+        save_watermarks(stats["watermarks"])
+
+    elapsed = time.monotonic() - start
+
+    if stats["rows"]:
+        logging.info("Exported %d rows in %d chunks (%d failed) in %.1f s: %.1f rows/s, peak memory %.1f MB.",
+                     stats["rows"], stats["chunks"], stats["failed_chunks"], elapsed, stats["rows"] / elapsed,
+                     # ru_maxrss is reported in kilobytes on Linux
+                     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
     else:
         logging.warning("No data available to upload to BigQuery.")
@@ -0,0 +1,168 @@
+"""
+Script: Autonomy Benchmark
+
+Description: Compares the scalar CalculateAutonomyDoFn with the vectorized
+    BatchedCalculateAutonomyDoFn on random payloads.
+
+    Before timing, it checks that both paths return identical payloads for every
+    element, including the traffic score thresholds, NaN scores, negative values and
+    payloads with missing fields.
+
+EDEM. Master Big Data & Cloud 2024/2025
+Professor: Javi Briones
+"""
+
+""" Import Libraries """
+
+# A. Python Libraries
+import argparse
+import logging
+import random
+import copy
+import math
+import time
+
+# B. Custom Classes
+from edem_dataflow_pipeline_todo import CalculateAutonomyDoFn, BatchedCalculateAutonomyDoFn
+
+""" Input Params """
+
+parser = argparse.ArgumentParser(description=('Autonomy benchmark'))
+
+parser.add_argument(
+    '--num_elements',
+    required=False,
+    type=int,
+    default=100000,
+    help='Number of payloads.')
+
+parser.add_argument(
+    '--batch_size',
+    required=False,
+    type=int,
+    default=1000,
+    help='Elements per vectorized batch (bundle size).')
+
+parser.add_argument(
+    '--seed',
+    required=False,
+    type=int,
+    default=42,
+    help='Seed of the random payloads.')
+
+""" Code """
+
+def generate_elements(num_elements: int, seed: int = 42):
+
+    """
+    Generates random (payload, traffic score) elements, with edge cases mixed in.
+    """
+
+    rng = random.Random(seed)
+
+    # Threshold, boundary and non-finite scores are the cases where a vectorized comparison could diverge
+    special_scores = [0.5, 1.5, 0.0, -0.1, math.nan, math.inf, 0.5000000001, 1.4999999999]
+
+    elements = []
+
+    for i in range(num_elements):
+
+        payload = {
+            "vehicle_id": f"V{i:06d}",
+            "battery_info": {"battery_level": rng.randint(0, 100)},
+            "environment_info": {"avg_temperature": rng.uniform(-30, 60), "avg_humidity": rng.uniform(0, 100)},
+            "driving_info": {"avg_braking_force": rng.uniform(-1.5, 0.5)}
+        }
+
+        if rng.random() < 0.02:
+            del payload["environment_info"]["avg_humidity"]
+
+        score = rng.choice(special_scores) if rng.random() < 0.05 else rng.uniform(0, 2.5)
+
+        elements.append((payload, score))
+
+    return elements
+
+def run_scalar(elements: list):
+
+    do_fn = CalculateAutonomyDoFn()
+
+    return [result for element in elements for result in do_fn.process(element)]
+
+def run_vectorized(elements: list, batch_size: int):
+
+    do_fn = BatchedCalculateAutonomyDoFn(max_batch_size=batch_size)
+    results = []
+
+    for i in range(0, len(elements), batch_size):
+        results.extend(payload for _, payload in do_fn._calculate_batch(elements[i:i + batch_size]))
+
+    return results
+
+def same_payload(a: dict, b: dict):
+
+    """
+    Exact comparison that also treats NaN scores as equal.
+    """
+
+    a_info, b_info = a["autonomy_info"], b["autonomy_info"]
+    nan_scores = math.isnan(a_info["traffic_score"]) and math.isnan(b_info["traffic_score"])
+
+    if nan_scores:
+        a_info, b_info = dict(a_info, traffic_score=None), dict(b_info, traffic_score=None)
+
+    return dict(a, autonomy_info=a_info) == dict(b, autonomy_info=b_info)
+
+def check_equivalence(elements: list, batch_size: int):
+
+    """
+    Raises:
+        AssertionError: If the vectorized results differ from the scalar ones.
+    """
+
+    scalar = run_scalar(copy.deepcopy(elements))
+    vectorized = run_vectorized(copy.deepcopy(elements), batch_size)
+
+    assert len(scalar) == len(vectorized), f"{len(scalar)} scalar results, {len(vectorized)} vectorized results"
+
+    for expected, actual in zip(scalar, vectorized):
+        assert same_payload(expected, actual), f"Mismatch:\n  scalar:     {expected}\n  vectorized: {actual}"
+
+    return len(scalar)
+
+def run_benchmark(num_elements: int, batch_size: int, seed: int = 42):
+
+    """
+    Returns:
+        dict: Checked results and the per-element cost of both paths.
+    """
+
+    elements = generate_elements(num_elements, seed)
+    checked = check_equivalence(elements, batch_size)
+
+    timings = {}
+
+    for name, function in (("scalar", lambda e: run_scalar(e)), ("vectorized", lambda e: run_vectorized(e, batch_size))):
+        copies = copy.deepcopy(elements)
+        start = time.perf_counter()
+        function(copies)
+        timings[name] = time.perf_counter() - start
+
+    return {
+        "elements": num_elements,
+        "identical_results": checked,
+        "scalar_us_per_element": round(timings["scalar"] / num_elements * 1e6, 2),
+        "vectorized_us_per_element": round(timings["vectorized"] / num_elements * 1e6, 2),
+        "speedup": round(timings["scalar"] / timings["vectorized"], 2)
+    }
+
+""" Run """
+
+if __name__ == "__main__":
+
+    # Set Logs
+    logging.getLogger().setLevel(logging.INFO)
+
+    args, opts = parser.parse_known_args()
+
+    logging.info("Autonomy benchmark: %s", run_benchmark(args.num_elements, args.batch_size, args.seed))
@@ -0,0 +1,197 @@
+"""
+Script: Telemetry Codec Benchmark
+
+Description: Micro-benchmark of the decoding step of the pipeline (ParsePubSubMessage).
+    Compares generic stdlib JSON decoding into dicts with decoding into the typed
+    telemetry records through every installed JSON codec, on messages of a simulated fleet.
+
+    It also compares the JSON and the Avro wire formats (telemetry_schemas.py):
+    payload bytes per message, encode time and decode time into records.
+
+EDEM. Master Big Data & Cloud 2024/2025
+Professor: Javi Briones
+"""
+
+""" Import Libraries """
+
+# A. Python Libraries
+import argparse
+import logging
+import json
+import time
+
+# B. Custom Classes
+from edem_data_generator import VehicleFleet, get_city_coordinates
+from edem_dataflow_pipeline_todo import ParsePubSubMessage, ParsePubSubMessageDoFn, get_json_decoder
+from telemetry_schemas import TELEMETRY_SCHEMAS, AvroEncoder
+
+""" Input Params """
+
+parser = argparse.ArgumentParser(description=('Telemetry codec benchmark'))
+
+parser.add_argument(
+    '--num_messages',
+    required=False,
+    type=int,
+    default=100000,
+    help='Number of messages per telemetry type.')
+
+parser.add_argument(
+    '--repeat',
+    required=False,
+    type=int,
+    default=3,
+    help='Runs per codec, the best one is reported.')
+
+""" Code """
+
+def build_payloads(num_messages: int, seed: int = 42):
+
+    """
+    Generates the events of every telemetry type.
+
+    Returns:
+        dict: Telemetry type as key and the list of events as value.
+    """
+
+    fleet = VehicleFleet(num_vehicles=1000, city_coordinates=get_city_coordinates("Valencia"), seed=seed)
+
+    return {
+        "battery": fleet.generate_battery_batch(num_messages),
+        "driving": fleet.generate_driving_batch(num_messages),
+        "environment": fleet.generate_environment_batch(num_messages)
+    }
+
+def build_messages(num_messages: int, seed: int = 42):
+
+    """
+    Generates the encoded messages of every telemetry type.
+
+    Returns:
+        dict: Telemetry type as key and the list of JSON encoded messages as value.
+    """
+
+    return {telemetry_type: [json.dumps(e).encode("utf-8") for e in events]
+            for telemetry_type, events in build_payloads(num_messages, seed).items()}
+
+def best_time(function, repeat: int):
+
+    """
+    Returns the best elapsed seconds of several runs of a function.
+    """
+
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+def run_benchmark(num_messages: int, repeat: int = 3):
+
+    """
+    Measures the decode throughput of every available codec.
+
+    Returns:
+        dict: Messages per second of every case.
+    """
+
+    messages = build_messages(num_messages)
+    total = sum(len(batch) for batch in messages.values())
+
+    cases = {"json -> dict (baseline)": lambda: [json.loads(m) for batch in messages.values() for m in batch]}
+
+    for codec in ("json", "orjson", "msgspec"):
+
+        try:
+            decode = get_json_decoder(codec)
+        except ImportError:
+            logging.info("%s is not installed, skipping.", codec)
+            continue
+
+        cases[f"{codec} -> records"] = lambda decode=decode: [
+            ParsePubSubMessage(m, telemetry_type, decode) for telemetry_type, batch in messages.items() for m in batch]
+
+    return {name: round(total / best_time(function, repeat)) for name, function in cases.items()}
+
+class _AvroMessage:
+
+    """ Minimal stand-in of the PubsubMessage read with attributes """
+
+    __slots__ = ("data", "attributes")
+
+    def __init__(self, data: bytes, attributes: dict):
+        self.data = data
+        self.attributes = attributes
+
+def compare_encodings(num_messages: int, repeat: int = 3):
+
+    """
+    Compares the JSON and Avro wire formats through the pipeline parser.
+
+    Returns:
+        dict: Bytes per message, encode and decode messages per second of every format.
+    """
+
+    payloads = build_payloads(num_messages)
+    total = sum(len(events) for events in payloads.values())
+
+    avro_encoder = AvroEncoder()
+    parsers = {}
+
+    for telemetry_type in payloads:
+        parsers[telemetry_type] = ParsePubSubMessageDoFn(telemetry_type, avro_schemas={
+            version: schemas[telemetry_type] for version, schemas in TELEMETRY_SCHEMAS.items()})
+        parsers[telemetry_type].setup()
+
+    encoders = {
+        "json": lambda payload, telemetry_type: json.dumps(payload).encode("utf-8"),
+        "avro": avro_encoder.encode
+    }
+
+    results = {}
+
+    for encoding, encode in encoders.items():
+
+        encoded = {telemetry_type: [encode(e, telemetry_type) for e in events]
+                   for telemetry_type, events in payloads.items()}
+
+        if encoding == "avro":
+            encoded = {telemetry_type: [_AvroMessage(m, avro_encoder.attributes) for m in messages]
+                       for telemetry_type, messages in encoded.items()}
+
+        def _decode():
+            for telemetry_type, messages in encoded.items():
+                for m in messages:
+                    next(parsers[telemetry_type].process(m))
+
+        size = sum(len(getattr(m, "data", m)) for messages in encoded.values() for m in messages)
+
+        results[encoding] = {
+            "bytes_per_message": round(size / total, 1),
+            "encode_messages_per_second": round(total / best_time(
+                lambda: [encode(e, t) for t, events in payloads.items() for e in events], repeat)),
+            "decode_messages_per_second": round(total / best_time(_decode, repeat))
+        }
+
+    return results
+
+""" Run """
+
+if __name__ == "__main__":
+
+    # Set Logs
+    logging.getLogger().setLevel(logging.INFO)
+
+    args, opts = parser.parse_known_args()
+
+    results = run_benchmark(args.num_messages, args.repeat)
+
+    for name, rate in results.items():
+        logging.info("%-26s %12d messages/s", name, rate)
+
+    for encoding, stats in compare_encodings(args.num_messages, args.repeat).items():
+        logging.info("%-5s %6.1f bytes/message, encode %8d messages/s, decode %8d messages/s", encoding,
+                     stats["bytes_per_message"], stats["encode_messages_per_second"], stats["decode_messages_per_second"])
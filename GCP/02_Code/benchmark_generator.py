@@ -0,0 +1,132 @@
+"""
+Script: Generator Rate Benchmark
+
+Description: Checks that the batch mode of the vehicle data generator (stream_fleet)
+    reaches its target rate when every publish takes the client batch delay.
+
+    The Pub/Sub client is replaced by one that completes every message after --publish_latency
+    seconds, the max_latency of the PubSubMessages batch settings, so no GCP project is needed.
+
+EDEM. Master Big Data & Cloud 2024/2025
+Professor: Javi Briones
+"""
+
+""" Import Libraries """
+
+# A. Python Libraries
+from concurrent.futures import Future
+import threading
+import argparse
+import queue
+import logging
+import time
+
+# B. Custom Classes
+from edem_data_generator import VehicleFleet, stream_fleet, get_city_coordinates
+from pubsub import PubSubMessages
+
+""" Input Params """
+
+parser = argparse.ArgumentParser(description=('Generator rate benchmark'))
+
+parser.add_argument(
+    '--events_per_second',
+    required=False,
+    type=float,
+    default=5000,
+    help='Target publishing rate.')
+
+parser.add_argument(
+    '--duration',
+    required=False,
+    type=float,
+    default=5,
+    help='Seconds to publish for.')
+
+parser.add_argument(
+    '--publish_latency',
+    required=False,
+    type=float,
+    default=0.05,
+    help='Seconds until a published message completes.')
+
+parser.add_argument(
+    '--num_vehicles',
+    required=False,
+    type=int,
+    default=1000,
+    help='Number of simulated vehicles.')
+
+""" Code """
+
+class DelayedPublisherClient:
+
+    """ Stand-in for pubsub_v1.PublisherClient that completes every message after a fixed delay """
+
+    def __init__(self, latency: float):
+
+        self.latency = latency
+        self.pending = queue.Queue()
+
+        # A single thread completes the messages in publish order, like the client batch thread
+        threading.Thread(target=self._complete, daemon=True).start()
+
+    def _complete(self):
+
+        while True:
+            done_at, future = self.pending.get()
+            time.sleep(max(0.0, done_at - time.monotonic()))
+            future.set_result("message-id")
+
+    def topic_path(self, project_id: str, topic_name: str):
+
+        return f"projects/{project_id}/topics/{topic_name}"
+
+    def publish(self, topic_path: str, data: bytes, **attributes):
+
+        future = Future()
+        self.pending.put((time.monotonic() + self.latency, future))
+
+        return future
+
+def check_rate(events_per_second: float, duration_seconds: float, publish_latency: float,
+               num_vehicles: int, tolerance: float = 0.95):
+
+    """
+    Raises:
+        AssertionError: If the achieved rate is below tolerance * target.
+
+    Returns:
+        dict: Target and achieved events per second.
+    """
+
+    # Bypass __init__, which builds the real client
+    publisher = PubSubMessages.__new__(PubSubMessages)
+    publisher.publisher = DelayedPublisherClient(publish_latency)
+    publisher.project_id = "local"
+    publisher.topic_paths = {}
+    publisher.avro_encoder = None
+
+    fleet = VehicleFleet(num_vehicles=num_vehicles, city_coordinates=get_city_coordinates("Valencia"), seed=42)
+    topics = {"battery": "battery", "driving": "driving", "environment": "environment"}
+
+    result = stream_fleet(publisher, fleet, topics, events_per_second, duration_seconds=duration_seconds)
+
+    assert result["failed"] == 0, f"{result['failed']} events failed"
+    assert result["events_per_second"] >= tolerance * events_per_second, \
+        f"{result['events_per_second']:.1f} events/s achieved, target {events_per_second}"
+
+    return {"target_events_per_second": events_per_second,
+            "achieved_events_per_second": round(result["events_per_second"], 1)}
+
+""" Run """
+
+if __name__ == "__main__":
+
+    # Set Logs
+    logging.getLogger().setLevel(logging.INFO)
+
+    args, opts = parser.parse_known_args()
+
+    logging.info("Generator rate benchmark: %s",
+                 check_rate(args.events_per_second, args.duration, args.publish_latency, args.num_vehicles))
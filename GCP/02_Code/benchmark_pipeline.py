@@ -0,0 +1,239 @@
+"""
+Script: End-to-End Pipeline Benchmark
+
+Description: Drives a simulated fleet through the generator, the Dataflow pipeline
+    (DirectRunner) and the Firestore/notification sinks using the in-process
+    transport, and reports throughput and peak memory.
+
+    This is the baseline every performance change in the pipeline is compared against.
+
+    The fleet is published before the pipeline starts, because the local transport reads
+    every topic as a bounded snapshot, so no end-to-end latency is reported: measured
+    from the publish time it would only reflect the total runtime.
+
+EDEM. Master Big Data & Cloud 2024/2025
+Professor: Javi Briones
+"""
+
+""" Import Libraries """
+
+# A. Python Libraries
+import argparse
+import resource
+import logging
+import json
+import time
+
+# B. Custom Classes
+from edem_data_generator import VehicleFleet, get_city_coordinates
+from local_transport import LocalPubSubMessages
+import edem_dataflow_pipeline_todo as pipeline
+import local_transport
+
+""" Input Params """
+
+parser = argparse.ArgumentParser(description=('End-to-end pipeline benchmark'))
+
+parser.add_argument(
+    '--num_vehicles',
+    required=False,
+    type=int,
+    default=1000,
+    help='Number of simulated vehicles.')
+
+parser.add_argument(
+    '--num_events',
+    required=False,
+    type=int,
+    default=30000,
+    help='Total number of telemetry events published across the three topics.')
+
+parser.add_argument(
+    '--batch_size',
+    required=False,
+    type=int,
+    default=5000,
+    help='Number of events generated per fleet batch.')
+
+parser.add_argument(
+    '--window_size',
+    required=False,
+    type=int,
+    default=60,
+    help='Size in seconds of the pipeline fixed windows.')
+
+parser.add_argument(
+    '--processing_mode',
+    required=False,
+    choices=['windowed', 'stateful'],
+    default='windowed',
+    help='Pipeline processing mode to benchmark.')
+
+parser.add_argument(
+    '--seed',
+    required=False,
+    type=int,
+    default=42,
+    help='Seed of the fleet random generator.')
+
+parser.add_argument(
+    '--autonomy_mode',
+    required=False,
+    choices=['vectorized', 'scalar'],
+    default='vectorized',
+    help='Autonomy computation of the pipeline to benchmark.')
+
+""" Code """
+
+def publish_fleet(num_vehicles: int, num_events: int, batch_size: int, seed: int):
+
+    """
+    Publishes the telemetry of a simulated fleet to the in-process broker.
+
+    Returns:
+        float: Seconds spent generating and publishing.
+    """
+
+    fleet = VehicleFleet(num_vehicles=num_vehicles, city_coordinates=get_city_coordinates("Valencia"), seed=seed)
+    publisher = LocalPubSubMessages(project_id="local")
+
+    start = time.monotonic()
+    remaining = num_events
+
+    while remaining > 0:
+
+        size = min(batch_size, remaining)
+
+        for category, events in fleet.generate_batch(size).items():
+            publisher.publishBatch(payloads=events, topic_name=category)
+
+        remaining -= size
+
+    return time.monotonic() - start
+
+def check_stateful_arrival_order(flush_interval: int = 60):
+
+    """
+    Runs StatefulBusinessLogicDoFn on hand-written arrival orders and checks every vehicle
+    lands in the same output as in the windowed path.
+
+    Raises:
+        AssertionError: If a vehicle is routed to the wrong output.
+    """
+
+    import apache_beam as beam
+    from apache_beam.testing.util import assert_that, equal_to
+
+    def battery(vehicle_id, second, level, event_type="driving"):
+        return ("battery", pipeline.BatteryEvent.from_dict({"vehicle_id": vehicle_id, "timestamp": f"2025-01-01T00:00:{second:02d}Z",
+                                                             "battery_level": level, "event_type": event_type}))
+
+    def driving(vehicle_id, second):
+        return ("driving", pipeline.DrivingEvent.from_dict({"vehicle_id": vehicle_id, "timestamp": f"2025-01-01T00:00:{second:02d}Z",
+                                                             "speed": 50, "braking_force": -0.5, "steering_angle": 0}))
+
+    def environment(vehicle_id, second):
+        return ("environment", pipeline.EnvironmentEvent.from_dict({"vehicle_id": vehicle_id, "timestamp": f"2025-01-01T00:00:{second:02d}Z",
+                                                                     "latitude": 39.47, "longitude": -0.38, "temperature": 20, "humidity": 50}))
+
+    arrivals = {
+        # Critical battery, driving and environment never arrive in the interval
+        "V001": [battery("V001", 1, 20)],
+        # Critical battery first, the rest of the data later
+        "V002": [battery("V002", 1, 20), driving("V002", 2), environment("V002", 3)],
+        # Late, older critical reading after a newer healthy one
+        "V003": [driving("V003", 1), environment("V003", 2), battery("V003", 5, 60), battery("V003", 3, 20)],
+        # Charging event earlier in the interval than the critical reading
+        "V004": [driving("V004", 1), environment("V004", 2), battery("V004", 3, 100, "charging"), battery("V004", 4, 20)],
+    }
+
+    expected = {"critical_battery_users": ["V001", "V002"], "non_critical_battery_users": ["V003", "V004"]}
+
+    with beam.Pipeline(runner="DirectRunner") as p:
+
+        events = [(vehicle_id, event) for vehicle_id, vehicle_events in arrivals.items() for event in vehicle_events]
+
+        outputs = (
+            p
+                | beam.Create(events)
+                | beam.Map(lambda kv: beam.window.TimestampedValue(kv, 0))
+                | beam.ParDo(pipeline.StatefulBusinessLogicDoFn(flush_interval=flush_interval)).with_outputs(
+                    "critical_battery_users", "non_critical_battery_users")
+        )
+
+        for tag, vehicle_ids in expected.items():
+            assert_that(outputs[tag] | f"{tag} IDs" >> beam.Map(lambda payload: payload["vehicle_id"]),
+                        equal_to(vehicle_ids), label=f"Check {tag}")
+
+    return sum(len(vehicle_events) for vehicle_events in arrivals.values())
+
+def run_benchmark(num_vehicles: int, num_events: int, batch_size: int, window_size: int, seed: int,
+                  processing_mode: str = 'windowed', autonomy_mode: str = 'vectorized'):
+
+    """
+    Runs the generator and the pipeline and collects the benchmark results.
+
+    Returns:
+        dict: Benchmark summary.
+    """
+
+    # Always go through the module: save_main_session restores a copy of the main globals
+    broker = local_transport.broker
+    broker.reset()
+
+    publish_seconds = publish_fleet(num_vehicles, num_events, batch_size, seed)
+
+    start = time.monotonic()
+
+    pipeline.run([
+        '--project_id', 'local',
+        '--battery_telemetry_subscription', 'battery',
+        '--driving_telemetry_subscription', 'driving',
+        '--environment_telemetry_subscription', 'environment',
+        '--firestore_collection', 'vehicles',
+        '--output_topic', 'notifications',
+        '--system_id', 'benchmark',
+        '--window_size', str(window_size),
+        '--processing_mode', processing_mode,
+        '--autonomy_mode', autonomy_mode,
+        '--transport', 'local',
+        '--runner', 'DirectRunner'])
+
+    pipeline_seconds = time.monotonic() - start
+
+    sinks = ["firestore/non_critical_battery_users", "firestore/critical_battery_users", "notifications"]
+    return {
+        "processing_mode": processing_mode,
+        "autonomy_mode": autonomy_mode,
+        "vehicles": num_vehicles,
+        "events": num_events,
+        "publish_events_per_second": round(num_events / publish_seconds, 1),
+        "pipeline_seconds": round(pipeline_seconds, 2),
+        "pipeline_events_per_second": round(num_events / pipeline_seconds, 1),
+        "outputs": {sink: len(broker.messages(sink)) for sink in sinks},
+        # ru_maxrss is reported in kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+""" Run """
+
+if __name__ == "__main__":
+
+    # Set Logs
+    logging.getLogger().setLevel(logging.INFO)
+    logging.getLogger("apache_beam").setLevel(logging.WARNING)
+
+    args, opts = parser.parse_known_args()
+
+    if args.processing_mode == 'stateful':
+        logging.info("Stateful arrival orders checked: %d events", check_stateful_arrival_order())
+
+    summary = run_benchmark(num_vehicles=args.num_vehicles,
+        num_events=args.num_events,
+        batch_size=args.batch_size,
+        window_size=args.window_size,
+        processing_mode=args.processing_mode,
+        autonomy_mode=args.autonomy_mode,
+        seed=args.seed)
+
+    logging.info("Benchmark results: %s", json.dumps(summary, indent=2))
@@ -0,0 +1,210 @@
+"""
+Script: Supercharger Index Benchmark
+
+Description: Benchmark of the nearest charging station lookup of the pipeline
+    (SuperchargerIndex) on a synthetic dataset of stations clustered around cities.
+
+    Before timing, it checks the nearest-k and within-radius answers of the index against
+    a brute force haversine scan of every station, including queries near the poles
+    and across the antimeridian.
+
+EDEM. Master Big Data & Cloud 2024/2025
+Professor: Javi Briones
+"""
+
+""" Import Libraries """
+
+# A. Python Libraries
+import argparse
+import logging
+import random
+import time
+
+# B. Custom Classes
+import numpy as np
+from edem_dataflow_pipeline_todo import SuperchargerIndex, EARTH_RADIUS_KM
+
+""" Input Params """
+
+parser = argparse.ArgumentParser(description=('Supercharger index benchmark'))
+
+parser.add_argument(
+    '--num_stations',
+    required=False,
+    type=int,
+    default=100000,
+    help='Number of charging stations.')
+
+parser.add_argument(
+    '--num_queries',
+    required=False,
+    type=int,
+    default=10000,
+    help='Number of timed queries per case.')
+
+parser.add_argument(
+    '--cell_size',
+    required=False,
+    type=float,
+    default=0.5,
+    help='Grid cell size of the index in degrees.')
+
+parser.add_argument(
+    '--seed',
+    required=False,
+    type=int,
+    default=42,
+    help='Seed of the random stations and queries.')
+
+""" Code """
+
+def generate_stations(num_stations: int, seed: int = 42):
+
+    """
+    Generates stations around random city centres, plus a sparse uniform background.
+    """
+
+    rng = random.Random(seed)
+    centres = [(rng.uniform(-55, 70), rng.uniform(-180, 180)) for _ in range(500)]
+    stations = []
+
+    for i in range(num_stations):
+
+        if rng.random() < 0.1:
+            latitude, longitude = rng.uniform(-89.9, 89.9), rng.uniform(-180, 180)
+        else:
+            latitude, longitude = rng.choice(centres)
+            latitude = max(-89.9, min(89.9, rng.gauss(latitude, 1.0)))
+            longitude = (rng.gauss(longitude, 1.5) + 180) % 360 - 180
+
+        stations.append({"id": f"S{i:06d}", "name": f"Supercharger {i}", "latitude": latitude, "longitude": longitude})
+
+    return stations
+
+def generate_queries(stations: list, num_queries: int, seed: int = 42):
+
+    """
+    Query points near the stations, and a few edge cases (poles, antimeridian, open ocean).
+    """
+
+    rng = random.Random(seed + 1)
+
+    queries = [(89.95, 10.0), (-89.95, -170.0), (0.0, 179.99), (0.0, -179.99), (-30.0, -140.0)]
+
+    for _ in range(num_queries - len(queries)):
+        station = rng.choice(stations)
+        queries.append((max(-89.99, min(89.99, station["latitude"] + rng.gauss(0, 0.5))),
+                        (station["longitude"] + rng.gauss(0, 0.5) + 180) % 360 - 180))
+
+    return queries
+
+def brute_force(coordinates, latitude: float, longitude: float):
+
+    """
+    Haversine distances in km from a point to every station.
+
+    Params:
+        coordinates(tuple): Latitudes and longitudes of the stations, in radians.
+    """
+
+    latitudes, longitudes = coordinates
+    latitude, longitude = np.radians(latitude), np.radians(longitude)
+
+    a = np.sin((latitudes - latitude) / 2) ** 2 + np.cos(latitude) * np.cos(latitudes) * np.sin((longitudes - longitude) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def station_coordinates(index: SuperchargerIndex):
+
+    return (np.radians([station["latitude"] for station in index.stations]),
+            np.radians([station["longitude"] for station in index.stations]))
+
+def check_index(index: SuperchargerIndex, queries: list, k: int = 5, radius_km: float = 150.0):
+
+    """
+    Raises:
+        AssertionError: If the index answers differ from the brute force scan.
+    """
+
+    coordinates = station_coordinates(index)
+
+    for latitude, longitude in queries:
+
+        distances = np.sort(brute_force(coordinates, latitude, longitude))
+
+        # Distances are rounded to 10 m
+        nearest = np.array([station["distance_km"] for station in index.nearest(latitude, longitude, k)])
+        assert np.allclose(nearest, distances[:k], atol=0.006, rtol=0), f"nearest({latitude}, {longitude}): {nearest}"
+
+        expected = int((distances <= radius_km).sum())
+        assert index.count_within(latitude, longitude, radius_km) == expected, f"within({latitude}, {longitude})"
+        assert len(index.within(latitude, longitude, radius_km)) == expected, f"within({latitude}, {longitude})"
+
+    return len(queries)
+
+def time_per_query(function, queries: list):
+
+    """
+    Returns the median and 99th percentile microseconds per query.
+    """
+
+    timings = []
+
+    for latitude, longitude in queries:
+        start = time.perf_counter()
+        function(latitude, longitude)
+        timings.append(time.perf_counter() - start)
+
+    p50, p99 = np.percentile(timings, [50, 99]) * 1e6
+
+    return {"p50": round(float(p50), 1), "p99": round(float(p99), 1)}
+
+def run_benchmark(num_stations: int, num_queries: int, cell_size: float = 0.5, seed: int = 42):
+
+    """
+    Returns:
+        dict: Build time, checked queries and microseconds per query (median and p99) of every case.
+    """
+
+    stations = generate_stations(num_stations, seed)
+    queries = generate_queries(stations, num_queries, seed)
+
+    start = time.perf_counter()
+    index = SuperchargerIndex(stations, cell_size)
+    build_seconds = time.perf_counter() - start
+
+    checked = check_index(index, queries[:500])
+
+    cases = {
+        "nearest_1": lambda lat, lon: index.nearest(lat, lon, 1),
+        "nearest_5": lambda lat, lon: index.nearest(lat, lon, 5),
+        "reachable_count_150km": lambda lat, lon: index.count_within(lat, lon, 150),
+        "reachable_count_400km": lambda lat, lon: index.count_within(lat, lon, 400),
+        "within_50km": lambda lat, lon: index.within(lat, lon, 50),
+    }
+
+    results = {
+        "stations": num_stations,
+        "build_seconds": round(build_seconds, 3),
+        "checked_queries": checked,
+        "us_per_query": {name: time_per_query(function, queries) for name, function in cases.items()}
+    }
+
+    # Brute force scan of every station, on fewer queries
+    coordinates = station_coordinates(index)
+    results["us_per_query"]["brute_force_nearest_1"] = time_per_query(
+        lambda lat, lon: int(np.argmin(brute_force(coordinates, lat, lon))), queries[:max(1, num_queries // 10)])
+
+    return results
+
+""" Run """
+
+if __name__ == "__main__":
+
+    # Set Logs
+    logging.getLogger().setLevel(logging.INFO)
+
+    args, opts = parser.parse_known_args()
+
+    logging.info("Supercharger index benchmark: %s",
+                 run_benchmark(args.num_stations, args.num_queries, args.cell_size, args.seed))
@@ -12,12 +12,17 @@ Professor: Javi Briones
 # A. Python Libraries
 from geopy.geocoders import Nominatim
 from datetime import datetime, timedelta
+import numpy as np
 import argparse
 import logging
 import random
 import time
+import unicodedata
+import json
+import os
 
 # B. Custom Classes
+from telemetry_replay import TelemetryRecorder, RecordingPubSubMessages
 from pubsub import PubSubMessages
 
 """ Input Params """
@@ -52,10 +57,72 @@ parser.add_argument(
 parser.add_argument(
     '--num_vehicles',
     required=False,
+    type=int,
     default=5,
     help='Number of vehicles to generate data for.')
 
-args, opts = parser.parse_known_args()
+parser.add_argument(
+    '--mode',
+    required=False,
+    choices=['event', 'batch'],
+    default='event',
+    help='event: one message per second. batch: vectorized fleet publishing at --events_per_second.')
+
+parser.add_argument(
+    '--events_per_second',
+    required=False,
+    type=float,
+    default=1000,
+    help='Target publishing rate for the batch mode.')
+
+parser.add_argument(
+    '--encoding',
+    required=False,
+    choices=['json', 'avro'],
+    default='json',
+    help='Wire format of the telemetry messages. avro: compact binary with a versioned schema (telemetry_schemas.py).')
+
+parser.add_argument(
+    '--record',
+    required=False,
+    default=None,
+    help='Optional NDJSON.gz file where every published message is recorded for later replay.')
+
+""" Variables """
+
+# Bundled coordinates of common cities, so the generator starts instantly and works offline
+KNOWN_CITIES = {
+    "valencia": {"latitude": 39.4699, "longitude": -0.3763},
+    "madrid": {"latitude": 40.4168, "longitude": -3.7038},
+    "barcelona": {"latitude": 41.3874, "longitude": 2.1686},
+    "sevilla": {"latitude": 37.3891, "longitude": -5.9845},
+    "seville": {"latitude": 37.3891, "longitude": -5.9845},
+    "zaragoza": {"latitude": 41.6488, "longitude": -0.8891},
+    "malaga": {"latitude": 36.7213, "longitude": -4.4214},
+    "bilbao": {"latitude": 43.2630, "longitude": -2.9350},
+    "alicante": {"latitude": 38.3452, "longitude": -0.4810},
+    "castellon": {"latitude": 39.9864, "longitude": -0.0513},
+    "murcia": {"latitude": 37.9922, "longitude": -1.1307},
+    "palma": {"latitude": 39.5696, "longitude": 2.6502},
+    "lisbon": {"latitude": 38.7223, "longitude": -9.1393},
+    "paris": {"latitude": 48.8566, "longitude": 2.3522},
+    "london": {"latitude": 51.5072, "longitude": -0.1276},
+    "berlin": {"latitude": 52.5200, "longitude": 13.4050},
+    "rome": {"latitude": 41.9028, "longitude": 12.4964},
+    "milan": {"latitude": 45.4642, "longitude": 9.1900},
+    "amsterdam": {"latitude": 52.3676, "longitude": 4.9041},
+    "munich": {"latitude": 48.1351, "longitude": 11.5820},
+    "new york": {"latitude": 40.7128, "longitude": -74.0060},
+    "san francisco": {"latitude": 37.7749, "longitude": -122.4194},
+    "los angeles": {"latitude": 34.0522, "longitude": -118.2437},
+    "mexico city": {"latitude": 19.4326, "longitude": -99.1332},
+    "buenos aires": {"latitude": -34.6037, "longitude": -58.3816},
+    "tokyo": {"latitude": 35.6762, "longitude": 139.6503}
+}
+
+# On-disk cache of the cities resolved through the geocoding service
+CITY_CACHE_PATH = os.getenv('CITY_CACHE_PATH',
+    os.path.join(os.path.expanduser("~"), ".cache", "edem", "city_coordinates.json"))
 
 """ Code: Helpful Functions """
 
@@ -135,27 +202,78 @@ def generate_driving_style_data(
 
     return data
 
-def get_city_coordinates(city_name: str):
+def _normalize_city_name(city_name: str):
+
+    # Case, accents and surrounding spaces do not change the city
+    name = unicodedata.normalize("NFKD", city_name.strip().casefold())
+
+    return "".join(c for c in name if not unicodedata.combining(c))
+
+def _load_city_cache(cache_path: str):
+
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    except (OSError, ValueError):
+        return {}
+
+def _save_city_cache(cache: dict, cache_path: str):
+
+    try:
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+
+        # Write and rename, so a concurrent reader never sees a partial file
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f, indent=2)
+
+        os.replace(tmp_path, cache_path)
+
+    except OSError as err:
+        logging.warning("Could not save the city cache %s: %s", cache_path, err)
+
+def get_city_coordinates(city_name: str, cache_path: str = CITY_CACHE_PATH):
 
     """
-    Gets the coordinates (latitude and longitude) of a city using GeoPy.
+    Gets the coordinates (latitude and longitude) of a city.
+
+    The city is looked up in the bundled table and in the on-disk cache first.
+    GeoPy (Nominatim) is only called on a miss, and its result is cached.
 
     Params:
         city_name(str): Name of the city.
+        cache_path(str): Path of the on-disk cache.
 
     Returns: 
         Dictionary with latitude and longitude.
 
     """
 
+    key = _normalize_city_name(city_name)
+
+    if key in KNOWN_CITIES:
+        return dict(KNOWN_CITIES[key])
+
+    cache = _load_city_cache(cache_path)
+
+    if key in cache:
+        return cache[key]
+
     geolocator = Nominatim(user_agent="geoapi")
     location = geolocator.geocode(city_name)
 
     if location:
-        return {"latitude": location.latitude, "longitude": location.longitude}
+        coordinates = {"latitude": location.latitude, "longitude": location.longitude}
     else:
         raise ValueError(f"No coordinates were found for the city.: {city_name}")
 
+    cache[key] = coordinates
+    _save_city_cache(cache, cache_path)
+
+    return coordinates
+
 def generate_environment_data(
     vehicle_ids: list, timestamps: dict, city_coordinates: dict, radius: float = 0.005):
 
@@ -194,11 +312,191 @@ def generate_environment_data(
 
     return data
 
+""" Code: Vectorized Fleet """
+
+class VehicleFleet:
+
+    """ Vectorized state of a whole fleet of vehicles backed by NumPy arrays """
+
+    def __init__(self, num_vehicles: int, city_coordinates: dict,
+                 radius: float = 0.005, charging_probability: float = 0.1, seed: int = None):
+
+        """
+        Initialize the fleet state.
+
+        Params:
+            num_vehicles(int): Number of vehicles to simulate.
+            city_coordinates(dict): Coordinates of the city.
+            radius(float): Maximum deviation for latitude and longitude from the city center.
+            charging_probability(float): Probability that a battery event is of type 'charging'.
+            seed(int): Seed for the random generator, useful for reproducible runs.
+
+        Returns:
+            -
+        """
+
+        self.rng = np.random.default_rng(seed)
+        self.num_vehicles = num_vehicles
+        self.radius = radius
+        self.charging_probability = charging_probability
+        self.city_coordinates = city_coordinates
+
+        width = max(3, len(str(num_vehicles)))
+        self.vehicle_ids = np.array([f"V{str(i).zfill(width)}" for i in range(1, num_vehicles + 1)])
+
+        self.battery_levels = self.rng.uniform(50, 100, num_vehicles)
+        self.timestamps = np.full(num_vehicles, np.datetime64(datetime.now(), 's'))
+        self.latitudes = np.full(num_vehicles, city_coordinates['latitude'])
+        self.longitudes = np.full(num_vehicles, city_coordinates['longitude'])
+
+    def _sample(self, batch_size: int):
+
+        """
+        Selects the vehicles that emit an event in this batch, in rounds without repeated vehicles.
+
+        Within a round every vehicle appears at most once, so its state is updated once per event
+        and the rounds are applied in sequence, keeping the order of the events of a vehicle.
+
+        Returns:
+            list: Vehicle indexes of every round.
+        """
+
+        return [self.rng.choice(self.num_vehicles, min(self.num_vehicles, batch_size - start), replace=False)
+                for start in range(0, batch_size, self.num_vehicles)]
+
+    def _advance(self, idx):
+
+        """
+        Returns the current timestamps of the vehicles and advances their clocks.
+        """
+
+        timestamps = np.datetime_as_string(self.timestamps[idx], unit='s')
+        self.timestamps[idx] += self.rng.integers(10, 61, len(idx)).astype('timedelta64[s]')
+
+        return np.char.add(timestamps, "Z")
+
+    def generate_battery_batch(self, batch_size: int):
+
+        """
+        Generates a batch of battery events for randomly selected vehicles.
+
+        Params:
+            batch_size(int): Number of events to generate.
+
+        Returns:
+            data(list): List of battery events with vehicle ID, timestamp, battery level, and event type.
+        """
+
+        return [event for idx in self._sample(batch_size) for event in self._battery_events(idx)]
+
+    def _battery_events(self, idx):
+
+        batch_size = len(idx)
+        timestamps = self._advance(idx)
+
+        charging = self.rng.random(batch_size) <= self.charging_probability
+        battery_change = np.where(charging, 100.0, -self.rng.uniform(3.0, 10.0, batch_size))
+
+        self.battery_levels[idx] += battery_change
+        np.clip(self.battery_levels, 10, 100, out=self.battery_levels)
+
+        battery_levels = np.rint(self.battery_levels[idx]).astype(int)
+        event_types = np.where(charging, "charging", "driving")
+
+        return [
+            {"vehicle_id": v, "timestamp": t, "battery_level": b, "event_type": e}
+            for v, t, b, e in zip(self.vehicle_ids[idx].tolist(), timestamps.tolist(),
+                                  battery_levels.tolist(), event_types.tolist())
+        ]
+
+    def generate_driving_batch(self, batch_size: int):
+
+        """
+        Generates a batch of driving style events for randomly selected vehicles.
+
+        Params:
+            batch_size(int): Number of events to generate.
+
+        Returns:
+            data(list): List of driving style events with vehicle ID, timestamp, speed, braking force, and steering angle.
+        """
+
+        return [event for idx in self._sample(batch_size) for event in self._driving_events(idx)]
+
+    def _driving_events(self, idx):
+
+        batch_size = len(idx)
+        timestamps = self._advance(idx)
+
+        speeds = np.round(self.rng.uniform(0, 120, batch_size), 2)
+        braking_forces = np.round(self.rng.uniform(-1, 0, batch_size), 2)
+        steering_angles = np.round(self.rng.uniform(-30, 30, batch_size), 2)
+
+        return [
+            {"vehicle_id": v, "timestamp": t, "speed": s, "braking_force": b, "steering_angle": a}
+            for v, t, s, b, a in zip(self.vehicle_ids[idx].tolist(), timestamps.tolist(), speeds.tolist(),
+                                     braking_forces.tolist(), steering_angles.tolist())
+        ]
+
+    def generate_environment_batch(self, batch_size: int):
+
+        """
+        Generates a batch of environment events for randomly selected vehicles.
+
+        Params:
+            batch_size(int): Number of events to generate.
+
+        Returns:
+            data(list): List of environment events with vehicle ID, timestamp, coordinates, temperature, and humidity.
+        """
+
+        return [event for idx in self._sample(batch_size) for event in self._environment_events(idx)]
+
+    def _environment_events(self, idx):
+
+        batch_size = len(idx)
+        timestamps = self._advance(idx)
+
+        self.latitudes[idx] = self.city_coordinates['latitude'] + self.rng.uniform(-self.radius, self.radius, batch_size)
+        self.longitudes[idx] = self.city_coordinates['longitude'] + self.rng.uniform(-self.radius, self.radius, batch_size)
+
+        latitudes = np.round(self.latitudes[idx], 6)
+        longitudes = np.round(self.longitudes[idx], 6)
+        temperatures = np.round(self.rng.uniform(-10, 35, batch_size), 2)
+        humidities = np.round(self.rng.uniform(20, 80, batch_size), 2)
+
+        return [
+            {"vehicle_id": v, "timestamp": t, "latitude": la, "longitude": lo, "temperature": te, "humidity": h}
+            for v, t, la, lo, te, h in zip(self.vehicle_ids[idx].tolist(), timestamps.tolist(), latitudes.tolist(),
+                                           longitudes.tolist(), temperatures.tolist(), humidities.tolist())
+        ]
+
+    def generate_batch(self, batch_size: int):
+
+        """
+        Generates a batch of events randomly split between the three telemetry categories.
+
+        Params:
+            batch_size(int): Total number of events to generate.
+
+        Returns:
+            dict: Category name as key and the list of generated events as value.
+        """
+
+        battery_size, driving_size, environment_size = self.rng.multinomial(batch_size, [1 / 3] * 3)
+
+        return {
+            "battery": self.generate_battery_batch(battery_size),
+            "driving": self.generate_driving_batch(driving_size),
+            "environment": self.generate_environment_batch(environment_size)
+        }
+
 """ Code: Entry Point """
 
 def run_streaming(project_id: str, telemetry_battery_topic: str,
                   telemetry_driving_topic: str, telemetry_environment_topic: str,
-                  city_coordinates: dict, num_vehicles: int):
+                  city_coordinates: dict, num_vehicles: int, record_path: str = None,
+                  encoding: str = "json"):
     """
     Publishes telemetry data to Pub/Sub topics dynamically (event-by-event).
 
@@ -209,12 +507,17 @@ def run_streaming(project_id: str, telemetry_battery_topic: str,
         telemetry_environment_topic (str): Pub/Sub topic for environment telemetry.
         city_coordinates (dict): Coordinates of the city.
         num_vehicles (int): Number of vehicles to simulate.
+        record_path (str): Optional file where the published messages are recorded.
+        encoding (str): Wire format of the messages, "json" or "avro".
 
     Returns:
         None
     """
     # Initialize PubSub
-    pubsub_class = PubSubMessages(project_id=project_id)
+    pubsub_class = PubSubMessages(project_id=project_id, encoding=encoding)
+
+    if record_path:
+        pubsub_class = RecordingPubSubMessages(pubsub_class, TelemetryRecorder(record_path))
 
     # Initialize vehicle states
     vehicle_ids = [f"V{str(i).zfill(3)}" for i in range(1, num_vehicles + 1)]
@@ -247,7 +550,7 @@ def run_streaming(project_id: str, telemetry_battery_topic: str,
                 topic_name = telemetry_environment_topic
 
             # Publish the event
-            pubsub_class.publishMessages(payload=event, topic_name=topic_name)
+            pubsub_class.publishMessages(payload=event, topic_name=topic_name, telemetry_type=selected_category)
             logging.info("Message published to %s: %s", topic_name, event['vehicle_id'])
 
             # Control the streaming rate
@@ -259,6 +562,126 @@ def run_streaming(project_id: str, telemetry_battery_topic: str,
     except Exception as err:
         logging.error("An unexpected error occurred: %s", err)
 
+    finally:
+        if record_path:
+            pubsub_class.recorder.close()
+
+
+def run_streaming_batch(project_id: str, telemetry_battery_topic: str,
+                        telemetry_driving_topic: str, telemetry_environment_topic: str,
+                        city_coordinates: dict, num_vehicles: int,
+                        events_per_second: float, tick_seconds: float = 0.1, record_path: str = None,
+                        encoding: str = "json"):
+    """
+    Publishes telemetry data to Pub/Sub topics in batches generated for the whole fleet.
+
+    Args:
+        project_id (str): Google Cloud project ID.
+        telemetry_battery_topic (str): Pub/Sub topic for battery telemetry.
+        telemetry_driving_topic (str): Pub/Sub topic for driving telemetry.
+        telemetry_environment_topic (str): Pub/Sub topic for environment telemetry.
+        city_coordinates (dict): Coordinates of the city.
+        num_vehicles (int): Number of vehicles to simulate.
+        events_per_second (float): Target number of published events per second.
+        tick_seconds (float): Interval between generated batches.
+        record_path (str): Optional file where the published messages are recorded.
+        encoding (str): Wire format of the messages, "json" or "avro".
+
+    Returns:
+        None
+    """
+    # Initialize PubSub
+    pubsub_class = PubSubMessages(project_id=project_id, encoding=encoding)
+
+    if record_path:
+        pubsub_class = RecordingPubSubMessages(pubsub_class, TelemetryRecorder(record_path))
+
+    # Initialize fleet state
+    fleet = VehicleFleet(num_vehicles=num_vehicles, city_coordinates=city_coordinates)
+
+    topics = {
+        "battery": telemetry_battery_topic,
+        "driving": telemetry_driving_topic,
+        "environment": telemetry_environment_topic
+    }
+
+    try:
+        stream_fleet(pubsub_class, fleet, topics, events_per_second, tick_seconds)
+
+    except Exception as err:
+        logging.error("An unexpected error occurred: %s", err)
+
+    finally:
+        if record_path:
+            pubsub_class.recorder.close()
+
+def stream_fleet(publisher, fleet: VehicleFleet, topics: dict, events_per_second: float,
+                 tick_seconds: float = 0.1, duration_seconds: float = None):
+    """
+    Publishes fleet batches at the target rate until stopped or the duration elapses.
+
+    The batches of a tick are published without waiting for them. They are awaited at the
+    next tick, after its batches are sent, so the client batch delay never blocks the rate.
+
+    Args:
+        publisher (PubSubMessages): Publisher with publishBatchAsync and waitBatch.
+        fleet (VehicleFleet): Fleet state.
+        topics (dict): Topic name of every category.
+        events_per_second (float): Target number of published events per second.
+        tick_seconds (float): Interval between generated batches.
+        duration_seconds (float): Stop after this many seconds, run until interrupted if None.
+
+    Returns:
+        dict: Number of published and failed events, elapsed seconds and achieved events/s.
+    """
+    totals = {"published": 0, "failed": 0}
+    in_flight = []
+    pending = 0.0
+    start = time.monotonic()
+    next_tick = start
+
+    def _collect(batches):
+        for topic_name, batch in batches:
+            result = publisher.waitBatch(batch)
+            totals["published"] += result["published"]
+            totals["failed"] += result["failed"]
+
+            logging.debug("Published %d events to %s, latency %s", result["published"], topic_name, result["latency"])
+
+    try:
+        while duration_seconds is None or time.monotonic() - start < duration_seconds:
+
+            # Carry the fractional part so low rates are still honoured
+            pending += events_per_second * tick_seconds
+            batch_size = int(pending)
+            pending -= batch_size
+
+            previous, in_flight = in_flight, [
+                (topics[category], publisher.publishBatchAsync(payloads=events, topic_name=topics[category],
+                                                               telemetry_type=category))
+                for category, events in fleet.generate_batch(batch_size).items() if events
+            ]
+
+            _collect(previous)
+
+            # Control the streaming rate
+            next_tick += tick_seconds
+            delay = next_tick - time.monotonic()
+
+            if delay > 0:
+                time.sleep(delay)
+
+    except KeyboardInterrupt:
+        logging.info("Streaming stopped by user.")
+
+    finally:
+        _collect(in_flight)
+
+    elapsed = time.monotonic() - start
+    logging.info("Published %d events (%d failed) in %.1f s (%.1f events/s).",
+                 totals["published"], totals["failed"], elapsed, totals["published"] / max(elapsed, 1e-9))
+
+    return {**totals, "elapsed_seconds": elapsed, "events_per_second": totals["published"] / max(elapsed, 1e-9)}
 
 """ Run """
 
@@ -267,16 +690,34 @@ if __name__ == "__main__":
     # Set Logs
     logging.getLogger().setLevel(logging.INFO)
 
+    args, opts = parser.parse_known_args()
+
     # Run Generator
     logging.info('Initializing the data generator.')
 
     location_payload = get_city_coordinates(city_name=args.city_name)
 
-    run_streaming(project_id = args.project_id,
-        telemetry_battery_topic = args.telemetry_battery_topic,
-        telemetry_driving_topic = args.telemetry_driving_topic,
-        telemetry_environment_topic = args.telemetry_environment_topic,
-        city_coordinates = location_payload,
-        num_vehicles = args.num_vehicles)
+    if args.mode == 'batch':
+
+        run_streaming_batch(project_id = args.project_id,
+            telemetry_battery_topic = args.telemetry_battery_topic,
+            telemetry_driving_topic = args.telemetry_driving_topic,
+            telemetry_environment_topic = args.telemetry_environment_topic,
+            city_coordinates = location_payload,
+            num_vehicles = args.num_vehicles,
+            events_per_second = args.events_per_second,
+            record_path = args.record,
+            encoding = args.encoding)
+
+    else:
+
+        run_streaming(project_id = args.project_id,
+            telemetry_battery_topic = args.telemetry_battery_topic,
+            telemetry_driving_topic = args.telemetry_driving_topic,
+            telemetry_environment_topic = args.telemetry_environment_topic,
+            city_coordinates = location_payload,
+            num_vehicles = args.num_vehicles,
+            record_path = args.record,
+            encoding = args.encoding)
     
     logging.info('Terminating the data generator.')
\ No newline at end of file
@@ -31,181 +31,1431 @@ import apache_beam as beam
 from apache_beam.runners import DataflowRunner
 from apache_beam.options.pipeline_options import PipelineOptions
 import apache_beam.transforms.window as window
-from apache_beam.metrics import Metrics
+from apache_beam.metrics import Metrics, MetricsFilter
+from apache_beam.transforms.userstate import CombiningValueStateSpec, ReadModifyWriteStateSpec, TimerSpec, on_timer
+from apache_beam.transforms.timeutil import TimeDomain
+from apache_beam.coders import BooleanCoder
+from apache_beam.utils import shared
+from apache_beam.transforms.periodicsequence import PeriodicImpulse
+from apache_beam.io.filesystems import FileSystems
 
 # B. Apache Beam ML Libraries
 from apache_beam.ml.inference.base import ModelHandler
 from apache_beam.ml.inference.base import RunInference
 
 # C. Python Libraries
+from collections import OrderedDict
+from array import array
 from datetime import datetime
+import numpy as np
+import threading
 import argparse
 import logging
+import math
+import time
 import json
 
 beam.options.pipeline_options.PipelineOptions.allow_non_parallel_instruction_output = True
 DataflowRunner.__test__ = False
 
+""" Code: Telemetry Records """
+
+def _text(value):
+
+    if not isinstance(value, str):
+        raise TypeError(f"expected a string, got {type(value).__name__}")
+
+    return value
+
+def _number(value):
+
+    # bool is an int subclass, but never a valid measurement
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError(f"expected a number, got {type(value).__name__}")
+
+    return value
+
+def _timestamp(value):
+
+    # %Y-%m-%dT%H:%M:%SZ, checked without parsing it
+    if not isinstance(value, str) or len(value) != 20 or value[10] != "T" or value[-1] != "Z":
+        raise ValueError(f"invalid timestamp: {value!r}")
+
+    return value
+
+class TelemetryRecord:
+
+    """
+    Base class of the typed telemetry events. The fields are stored in __slots__,
+    so the records are smaller than dicts and their attributes are faster to read.
+    """
+
+    __slots__ = ()
+
+    # (field name, validator) pairs, in wire order
+    FIELDS = ()
+
+    @classmethod
+    def from_dict(cls, data: dict):
+
+        """
+        Builds a record from a decoded message, validating every field.
+
+        Raises:
+            KeyError: If a field is missing.
+            TypeError, ValueError: If a field has an invalid value.
+        """
+
+        record = cls.__new__(cls)
+
+        for name, validate in cls.FIELDS:
+            setattr(record, name, validate(data[name]))
+
+        return record
+
+    def to_dict(self):
+
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other):
+
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+
+        return f"{type(self).__name__}({self.to_dict()})"
+
+class BatteryEvent(TelemetryRecord):
+
+    __slots__ = ("vehicle_id", "timestamp", "battery_level", "event_type")
+
+    FIELDS = (("vehicle_id", _text), ("timestamp", _timestamp), ("battery_level", _number), ("event_type", _text))
+
+class DrivingEvent(TelemetryRecord):
+
+    __slots__ = ("vehicle_id", "timestamp", "speed", "braking_force", "steering_angle")
+
+    FIELDS = (("vehicle_id", _text), ("timestamp", _timestamp), ("speed", _number),
+              ("braking_force", _number), ("steering_angle", _number))
+
+class EnvironmentEvent(TelemetryRecord):
+
+    __slots__ = ("vehicle_id", "timestamp", "latitude", "longitude", "temperature", "humidity")
+
+    FIELDS = (("vehicle_id", _text), ("timestamp", _timestamp), ("latitude", _number),
+              ("longitude", _number), ("temperature", _number), ("humidity", _number))
+
+TELEMETRY_RECORDS = {
+    "battery": BatteryEvent,
+    "driving": DrivingEvent,
+    "environment": EnvironmentEvent,
+}
+
+def get_json_decoder(codec: str = "auto"):
+
+    """
+    Returns the JSON decoding function of the requested codec.
+
+    Params:
+        codec (str): "orjson", "msgspec", "json" (standard library) or "auto"
+            (the fastest one installed).
+
+    Returns:
+        callable: Function that decodes a JSON document from bytes.
+    """
+
+    if codec in ("auto", "orjson"):
+        try:
+            import orjson
+            return orjson.loads
+        except ImportError:
+            if codec == "orjson":
+                raise
+
+    if codec in ("auto", "msgspec"):
+        try:
+            import msgspec
+            return msgspec.json.decode
+        except ImportError:
+            if codec == "msgspec":
+                raise
+
+    return json.loads
+
 """ Code: Helpful functions """
-def ParsePubSubMessage(message):
+
+def ParsePubSubMessage(message, telemetry_type: str, decode=json.loads):
 
     """
-    Decodes messages from Pub/Sub for further transformation.
+    Decodes messages from Pub/Sub into typed telemetry records for further transformation.
 
     Params:
         message (bytes): The raw Pub/Sub message payload to be parsed and decoded.
+        telemetry_type (str): "battery", "driving" or "environment".
+        decode (callable): JSON decoding function (see get_json_decoder).
 
     Returns:
         tuple: Returns a tuple, key/value, with the vehicle ID and the complete message for further aggregation.
-        tuple (str, dict): A tuple where:
+        tuple (str, TelemetryRecord): A tuple where:
         - The first element is the vehicle ID.
-        - The second element is the complete message for further aggregation.
+        - The second element is the typed record of the message.
+
+    Raises:
+        Exception: If the message is not valid JSON or does not match the record fields.
+    """
+
+    record = TELEMETRY_RECORDS[telemetry_type].from_dict(decode(message))
+
+    return record.vehicle_id, record
+
+class ParsePubSubMessageDoFn(beam.DoFn):
+
+    """
+    Parses the messages of a telemetry topic. Malformed messages are sent to the
+    "dead_letter" output instead of failing the bundle.
+
+    Messages published with the attribute encoding=avro are decoded with the Avro schema
+    of their schema_version attribute, any other message is decoded as JSON.
+    """
+
+    def __init__(self, telemetry_type: str, codec: str = "auto", avro_schemas: dict = None):
+
+        """
+        Params:
+            telemetry_type (str): "battery", "driving" or "environment".
+            codec (str): JSON codec, see get_json_decoder.
+            avro_schemas (dict): Optional {schema version: Avro schema} of the telemetry type
+                (see telemetry_schemas.py), passed at launch time so workers do not need the module.
+        """
+
+        self.telemetry_type = telemetry_type
+        self.codec = codec
+        self.avro_schemas = avro_schemas or {}
+        self.malformed = Metrics.counter(self.__class__, f"malformed_{telemetry_type}_messages")
+
+    def setup(self):
+
+        # Resolved on the worker, where the installed codecs may differ from the launcher
+        self.decode = get_json_decoder(self.codec)
+        self.avro_decoders = {}
+
+        if self.avro_schemas:
+
+            from fastavro import parse_schema, schemaless_reader
+            import io
+
+            for version, schema in self.avro_schemas.items():
+                parsed = parse_schema(schema)
+                self.avro_decoders[str(version)] = lambda data, parsed=parsed: schemaless_reader(io.BytesIO(data), parsed, None)
+
+    def _decoder(self, attributes):
+
+        """
+        Returns the decoding function of a message from its attributes.
+        """
+
+        if attributes and attributes.get("encoding") == "avro":
+            return self.avro_decoders[attributes.get("schema_version")]
+
+        return self.decode
+
+    def process(self, message):
+
+        # Messages read with attributes are PubsubMessage objects
+        data = getattr(message, "data", message)
+
+        try:
+            yield ParsePubSubMessage(data, self.telemetry_type, self._decoder(getattr(message, "attributes", None)))
+
+        except Exception as err:
+            self.malformed.inc()
+            logging.warning("Malformed %s message: %s", self.telemetry_type, err)
+
+            yield beam.pvalue.TaggedOutput("dead_letter", json.dumps({
+                "telemetry_type": self.telemetry_type,
+                "error": f"{type(err).__name__}: {err}",
+                "attributes": dict(getattr(message, "attributes", None) or {}),
+                "message": data.decode("utf-8", "replace") if isinstance(data, bytes) else str(data)
+            }).encode("utf-8"))
+
+""" Code: CombineFn """
+
+class TelemetryStatsCombineFn(beam.CombineFn):
+
+    """
+    Incrementally aggregates the events of a vehicle in a single pass: running count,
+    running sums of the averaged metrics and the latest event by timestamp.
+    Only the compact accumulator is shuffled to the CoGroupByKey.
+    """
+
+    def __init__(self, avg_fields: tuple = ()):
+        self.avg_fields = avg_fields
+
+    def create_accumulator(self):
+        # [count, sums, latest event, charging event seen]
+        return [0, [0.0] * len(self.avg_fields), None, False]
+
+    def add_input(self, accumulator, event):
+
+        accumulator[0] += 1
+
+        sums = accumulator[1]
+        for i, field in enumerate(self.avg_fields):
+            sums[i] += getattr(event, field)
+
+        latest = accumulator[2]
+        if latest is None or event.timestamp >= latest.timestamp:
+            accumulator[2] = event
+
+        accumulator[3] = accumulator[3] or getattr(event, "event_type", None) == "charging"
+
+        return accumulator
+
+    def merge_accumulators(self, accumulators):
+
+        merged = self.create_accumulator()
+
+        for count, sums, latest, charged in accumulators:
+
+            merged[0] += count
+            merged[1] = [a + b for a, b in zip(merged[1], sums)]
+
+            if latest is not None and (merged[2] is None or latest.timestamp >= merged[2].timestamp):
+                merged[2] = latest
+
+            merged[3] = merged[3] or charged
+
+        return merged
+
+    def extract_output(self, accumulator):
+
+        count, sums, latest, charged = accumulator
+
+        output = {f"avg_{field}": total / count for field, total in zip(self.avg_fields, sums)} if count else {}
+        output.update({"count": count, "latest": latest, "has_charged": charged})
+
+        return output
+
+""" Code: Traffic Score Cache """
+
+class TrafficScoreCache:
+
+    """
+    Bounded LRU cache of traffic scores keyed by a location grid cell and a time bucket.
+    Nearby vehicles reporting in the same time bucket reuse the score of the first one.
+    """
+
+    def __init__(self, cell_size: float = 0.01, bucket_seconds: int = 60,
+                 ttl_seconds: float = 300, max_size: int = 10000):
+
+        self.cell_size = cell_size
+        self.bucket_seconds = bucket_seconds
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, payload: dict):
+
+        """
+        Returns the (lat cell, lon cell, time bucket) key of a payload, or None if it has no location.
+        """
+
+        environment_info = payload.get("environment_info") or {}
+
+        if "latitude" not in environment_info:
+            return None
+
+        event_time = datetime.strptime(payload["timestamp"], "%Y-%m-%dT%H:%M:%SZ").timestamp()
+
+        return (math.floor(environment_info["latitude"] / self.cell_size),
+                math.floor(environment_info["longitude"] / self.cell_size),
+                int(event_time // self.bucket_seconds))
+
+    def get(self, key):
+
+        with self.lock:
+
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return None
+
+            score, stored_at = entry
+
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+
+            return score
+
+    def put(self, key, score: float):
+
+        with self.lock:
+
+            self.entries[key] = (score, time.monotonic())
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+class LookupTrafficScoreDoFn(beam.DoFn):
+
+    """
+    Sends the vehicles whose cell already has a fresh traffic score to the "cached" output
+    as (payload, score), skipping the image capture and the Vision API call.
+
+    Hits and misses are counters summed across all the workers, see traffic_cache_hit_rate.
     """
 
-    #ToDo: Complete this section
+    def __init__(self, shared_handle, cache_kwargs: dict):
+        self.shared_handle = shared_handle
+        self.cache_kwargs = cache_kwargs
+        self.hits = Metrics.counter(self.__class__, "traffic_cache_hits")
+        self.misses = Metrics.counter(self.__class__, "traffic_cache_misses")
+
+    def setup(self):
+        # One cache per worker process, shared with StoreTrafficScoreDoFn
+        self.cache = self.shared_handle.acquire(lambda: TrafficScoreCache(**self.cache_kwargs))
+
+    def process(self, element):
+
+        key = self.cache.key(element)
+        score = None if key is None else self.cache.get(key)
 
-    return payload['vehicle_id'], payload
+        if score is None:
+            self.misses.inc()
+            yield element
+        else:
+            self.hits.inc()
+            yield beam.pvalue.TaggedOutput("cached", (element, score))
 
-def getTrafficImage(item, api_url):
+def traffic_cache_hit_rate(result):
 
     """
-    Simulates the images captured by the various cameras equipped on the vehicle
+    Derives the job-level traffic cache hit rate from the hits and misses counters.
 
     Params:
-        item (dict): A single element from the input PCollection, representing the
-            payload with the upstream data.
-        api_url(str): API that returns different images simulating the environment captured by the vehicle.
+        result (PipelineResult): Result of the pipeline run.
 
     Returns:
-        tuple (dict, Bytes): A tuple where:
-        - The first element is the same payload as input.
-        - The second element is the image in bytes for model inference.
+        float: Share of the lookups answered by the cache, None if there were no lookups.
     """
 
-    import requests
-    import io
+    totals = {"traffic_cache_hits": 0, "traffic_cache_misses": 0}
+
+    for name in totals:
+        for counter in result.metrics().query(MetricsFilter().with_name(name))["counters"]:
+            totals[name] += counter.committed if counter.committed is not None else counter.attempted
+
+    lookups = sum(totals.values())
+
+    return totals["traffic_cache_hits"] / lookups if lookups else None
+
+class StoreTrafficScoreDoFn(beam.DoFn):
+
+    """
+    Stores the traffic score returned by the model in the worker cache. Scores of images
+    that could not be fetched (no image_url) are passed through but not cached, so a
+    transient error doesn't mark the whole cell as traffic-free for the TTL.
+    """
+
+    def __init__(self, shared_handle, cache_kwargs: dict):
+        self.shared_handle = shared_handle
+        self.cache_kwargs = cache_kwargs
+
+    def setup(self):
+        self.cache = self.shared_handle.acquire(lambda: TrafficScoreCache(**self.cache_kwargs))
+
+    def process(self, element):
+
+        payload, score = element
+        key = self.cache.key(payload)
+
+        if key is not None and payload.get("image_url"):
+            self.cache.put(key, score)
+
+        yield element
+
+""" Code: Autonomy Model """
+
+# Coefficients used when no --autonomy_model file is given, and for the keys a file leaves out
+DEFAULT_AUTONOMY_MODEL = {
+    "version": "default",
+    "base_efficiency": 6.5,
+    "temp_coefficient": 0.01,
+    "humidity_coefficient": 0.005,
+    "brake_coefficient": 0.05,
+    "optimal_temperature": 25,
+    "optimal_humidity": 50,
+    # A traffic score above the threshold gets the level and its autonomy factor
+    "traffic_levels": [
+        {"threshold": 1.5, "level": "High", "factor": 0.7},
+        {"threshold": 0.5, "level": "Medium", "factor": 0.85}
+    ],
+    "default_traffic_level": {"level": "Low", "factor": 1.0}
+}
+
+class AutonomyModel:
+
+    """
+    Autonomy model coefficients, compiled once per load: plain attributes instead of
+    dict lookups, traffic levels sorted by descending threshold and the arrays used
+    by the vectorized DoFn.
+    """
+
+    COEFFICIENTS = ("base_efficiency", "temp_coefficient", "humidity_coefficient",
+                    "brake_coefficient", "optimal_temperature", "optimal_humidity")
+
+    __slots__ = COEFFICIENTS + ("version", "traffic_levels", "default_traffic_level", "thresholds", "factors", "levels")
+
+    def __init__(self, config: dict = None):
+
+        """
+        Params:
+            config(dict): Model coefficients, see DEFAULT_AUTONOMY_MODEL. Missing keys keep their default value.
+
+        Raises:
+            KeyError: If a traffic level is incomplete.
+            TypeError: If a coefficient, threshold or factor is not a number.
+        """
+
+        config = {**DEFAULT_AUTONOMY_MODEL, **(config or {})}
+
+        self.version = str(config["version"])
+
+        for name in self.COEFFICIENTS:
+            setattr(self, name, _number(config[name]))
+
+        levels = sorted(config["traffic_levels"], key=lambda level: level["threshold"], reverse=True)
+        default = config["default_traffic_level"]
+
+        # (score threshold, level, autonomy factor), from the highest threshold down
+        self.traffic_levels = tuple((_number(level["threshold"]), _text(level["level"]), _number(level["factor"]))
+                                    for level in levels)
+        self.default_traffic_level = (_text(default["level"]), _number(default["factor"]))
+
+        self.thresholds = [threshold for threshold, _, _ in self.traffic_levels]
+        self.levels = [level for _, level, _ in self.traffic_levels] + [self.default_traffic_level[0]]
+        self.factors = np.array([factor for _, _, factor in self.traffic_levels] + [self.default_traffic_level[1]])
+
+    def __repr__(self):
+
+        return f"AutonomyModel(version={self.version!r})"
+
+def load_autonomy_model(path: str):
+
+    """
+    Reads and compiles an autonomy model JSON file (local path or gs://).
+
+    Returns:
+        AutonomyModel: The compiled model.
+    """
+
+    with FileSystems.open(path) as f:
+        return AutonomyModel(json.loads(f.read()))
+
+class LoadAutonomyModelDoFn(beam.DoFn):
+
+    """
+    Reloads the autonomy model file on every tick of the refresh impulse.
+    A file that cannot be read or is invalid keeps the last valid model.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def setup(self):
+        self.model = None
+
+    def process(self, element):
+
+        try:
+            model = load_autonomy_model(self.path)
+
+        except Exception as e:
+            logging.error("Invalid autonomy model %s, keeping the %s model: %s",
+                          self.path, "previous" if self.model else "default", e)
+            model = self.model or AutonomyModel()
+
+        else:
+            if self.model is None or model.version != self.model.version:
+                logging.info("Autonomy model %s loaded from %s", model.version, self.path)
+
+        self.model = model
+
+        yield model
+
+""" Code: Supercharger Index """
+
+EARTH_RADIUS_KM = 6371.0088
+
+def haversine_km(latitude_1: float, longitude_1: float, latitude_2: float, longitude_2: float):
+
+    """
+    Great-circle distance in km between two points in degrees.
+    """
+
+    latitude_1, longitude_1, latitude_2, longitude_2 = map(math.radians, (latitude_1, longitude_1, latitude_2, longitude_2))
+
+    a = (math.sin((latitude_2 - latitude_1) / 2) ** 2
+         + math.cos(latitude_1) * math.cos(latitude_2) * math.sin((longitude_2 - longitude_1) / 2) ** 2)
+
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(a, 1.0)))
+
+def _unit_vectors(latitudes, longitudes):
+
+    """
+    Points in degrees as unit vectors: the larger the dot product of two of them,
+    the shorter their great-circle distance.
+    """
+
+    latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+    cos_latitudes = np.cos(latitudes)
+
+    return np.stack([cos_latitudes * np.cos(longitudes), cos_latitudes * np.sin(longitudes), np.sin(latitudes)], axis=-1)
+
+def _unit_vector(latitude: float, longitude: float):
+
+    # Scalar version of _unit_vectors, without the NumPy call overhead
+    latitude, longitude = math.radians(latitude), math.radians(longitude)
+
+    return np.array([math.cos(latitude) * math.cos(longitude), math.cos(latitude) * math.sin(longitude), math.sin(latitude)])
+
+class SuperchargerIndex:
+
+    """
+    Grid index of charging stations for nearest-k and within-radius queries on the
+    great-circle (haversine) distance.
+
+    The stations are sorted by the (row, column) cell of a latitude/longitude grid, so
+    the candidates of a query are one contiguous slice per grid row. Candidates are
+    ranked by the dot product of their unit vectors, and the haversine distance is
+    only computed for the stations returned.
+    """
+
+    def __init__(self, stations: list, cell_size: float = 0.5):
+
+        """
+        Params:
+            stations(list): Station dicts with id, name, latitude and longitude (degrees).
+            cell_size(float): Grid cell size in degrees.
+        """
+
+        self.cell_size = cell_size
+        self.rows = math.ceil(180 / cell_size)
+        self.columns = math.ceil(360 / cell_size)
+
+        latitudes = np.array([float(station["latitude"]) for station in stations], dtype=np.float64)
+        longitudes = np.array([float(station["longitude"]) for station in stations], dtype=np.float64)
+
+        rows = np.minimum(((latitudes + 90) // cell_size).astype(np.int64), self.rows - 1)
+        columns = (((longitudes + 180) % 360) // cell_size).astype(np.int64) % self.columns
+        keys = rows * self.columns + columns
+        order = np.argsort(keys, kind="stable")
+
+        self.stations = [{"id": stations[i]["id"], "name": stations[i]["name"],
+                          "latitude": float(latitudes[i]), "longitude": float(longitudes[i])} for i in order.tolist()]
+        self.vectors = np.ascontiguousarray(_unit_vectors(latitudes[order], longitudes[order]))
+
+        # Position of the first station of every cell, plus the end of the last one.
+        # An array of int64 reads as plain ints, faster than NumPy scalars in the query loop
+        cell_starts = np.searchsorted(keys[order], np.arange(self.rows * self.columns + 1))
+        self.cell_starts = array("q", cell_starts.astype(np.int64).tobytes())
+
+    def __len__(self):
+
+        return len(self.stations)
+
+    def _cell(self, latitude: float, longitude: float):
+
+        row = min(int((latitude + 90) // self.cell_size), self.rows - 1)
+        column = int(((longitude + 180) % 360) // self.cell_size) % self.columns
+
+        return row, column
+
+    def _slices(self, row: int, column: int, row_radius: int, column_radius: int):
+
+        """
+        Returns the (start, end) position slices of the stations in the block of cells
+        around (row, column), merging the adjacent ones.
+        """
+
+        # Column ranges of the block, wrapped around the antimeridian
+        if 2 * column_radius + 1 >= self.columns:
+            ranges = [(0, self.columns - 1)]
+        elif column - column_radius < 0:
+            ranges = [(column - column_radius + self.columns, self.columns - 1), (0, column + column_radius)]
+        elif column + column_radius >= self.columns:
+            ranges = [(column - column_radius, self.columns - 1), (0, column + column_radius - self.columns)]
+        else:
+            ranges = [(column - column_radius, column + column_radius)]
+
+        cell_starts = self.cell_starts
+        slices = []
+
+        for block_row in range(max(row - row_radius, 0), min(row + row_radius, self.rows - 1) + 1):
+
+            base = block_row * self.columns
+
+            for first, last in sorted(ranges):
+
+                start, end = cell_starts[base + first], cell_starts[base + last + 1]
 
-    # API call to simulate a photo captured by the radar
+                if start == end:
+                    continue
 
-    #Read image from URL
+                if slices and slices[-1][1] == start:
+                    slices[-1] = (slices[-1][0], end)
+                else:
+                    slices.append((start, end))
 
-    #Append image_url to the payload
+        return slices
 
-    #ToDo: Complete this section
+    def _gather(self, slices):
+
+        """
+        Returns the unit vectors of the stations of the slices.
+        """
+
+        if len(slices) == 1:
+            return self.vectors[slices[0][0]:slices[0][1]]
+
+        return np.concatenate([self.vectors[start:end] for start, end in slices])
+
+    @staticmethod
+    def _position(slices, index: int):
+
+        """
+        Maps an index into the gathered slices back to a station position.
+        """
+
+        for start, end in slices:
+
+            if index < end - start:
+                return start + index
+
+            index -= end - start
+
+    @staticmethod
+    def _positions(slices, indexes):
+
+        """
+        Maps an array of indexes into the gathered slices back to station positions.
+        """
+
+        starts = np.array([start for start, _ in slices])
+        lengths = np.array([end - start for start, end in slices])
+        offsets = np.cumsum(lengths) - lengths
+        owners = np.searchsorted(offsets, indexes, "right") - 1
+
+        return starts[owners] + (indexes - offsets[owners])
+
+    @staticmethod
+    def _lower_bound(latitude: float, row_span: float, column_span: float = None):
+
+        """
+        Minimum angular distance (radians) from a point to any station outside a block
+        that extends row_span radians of latitude and column_span radians of longitude
+        beyond the cell of the point (None if the block covers every column).
+        """
+
+        if column_span is None:
+            return row_span
+
+        latitude = math.radians(latitude)
+
+        # Across the meridians of the block edge, or around the nearest pole
+        across_meridians = min(math.asin(math.cos(latitude) * math.sin(min(column_span, math.pi / 2))),
+                               math.pi / 2 - abs(latitude))
+
+        return min(row_span, across_meridians)
+
+    def _results(self, latitude: float, longitude: float, positions):
+
+        results = []
+
+        for position in positions:
+            station = self.stations[position]
+            distance = haversine_km(latitude, longitude, station["latitude"], station["longitude"])
+            results.append(dict(station, distance_km=round(distance, 2)))
+
+        return results
+
+    def nearest(self, latitude: float, longitude: float, k: int = 1):
+
+        """
+        Returns the k nearest stations.
+
+        The block of cells around the point doubles until it holds k stations and no station
+        outside it can be closer than the k-th one found.
+
+        Params:
+            latitude(float): Latitude in degrees.
+            longitude(float): Longitude in degrees.
+            k(int): Number of stations.
+
+        Returns:
+            list: Station dicts with their distance_km, nearest first.
+        """
+
+        k = min(k, len(self.stations))
+
+        if k <= 0:
+            return []
+
+        row, column = self._cell(latitude, longitude)
+        vector = _unit_vector(latitude, longitude)
+        cell = math.radians(self.cell_size)
+        radius = 1
+
+        while True:
+
+            # Columns narrow towards the poles: the block is widened to stay roughly square,
+            # and covers every column once it reaches a pole
+            edge_latitude = abs(latitude) + (radius + 1) * self.cell_size
+
+            if edge_latitude >= 90:
+                column_radius = self.columns
+            else:
+                column_radius = math.ceil(radius / math.cos(math.radians(edge_latitude)))
+
+            full_columns = 2 * column_radius + 1 >= self.columns
+            exhaustive = radius >= self.rows
+
+            slices = [(0, len(self.stations))] if exhaustive else self._slices(row, column, radius, column_radius)
+
+            if sum(end - start for start, end in slices) >= k:
+
+                # Negative dot products: the smallest is the nearest station
+                distances = -(self._gather(slices) @ vector)
+
+                if k == 1:
+                    found = np.array([distances.argmin()])
+                else:
+                    found = np.argpartition(distances, k - 1)[:k] if k < len(distances) else np.arange(k)
+
+                bound = self._lower_bound(latitude, radius * cell, None if full_columns else column_radius * cell)
+
+                if exhaustive or -distances[found].max() >= math.cos(bound):
+                    break
+
+            radius *= 2
+
+        found = found[np.argsort(distances[found], kind="stable")]
+
+        return self._results(latitude, longitude, [self._position(slices, index) for index in found.tolist()])
+
+    def _within(self, latitude: float, longitude: float, radius_km: float):
+
+        """
+        Returns the candidate slices of a radius and the dot products of their stations
+        with the point.
+        """
+
+        row, column = self._cell(latitude, longitude)
+        radius = radius_km / EARTH_RADIUS_KM
+        row_radius = math.ceil(math.degrees(radius) / self.cell_size)
+
+        # Longitude half-width of the circle, unless it contains a pole
+        if abs(math.radians(latitude)) + radius >= math.pi / 2:
+            column_radius = self.columns
+        else:
+            half_width = math.asin(math.sin(radius) / math.cos(math.radians(latitude)))
+            column_radius = math.ceil(math.degrees(half_width) / self.cell_size)
+
+        slices = self._slices(row, column, row_radius, column_radius)
+
+        if not slices:
+            return slices, np.empty(0)
+
+        return slices, self._gather(slices) @ _unit_vector(latitude, longitude)
+
+    def within(self, latitude: float, longitude: float, radius_km: float, limit: int = None):
+
+        """
+        Returns the stations within a radius, e.g. those reachable with the remaining autonomy.
+
+        Params:
+            latitude(float): Latitude in degrees.
+            longitude(float): Longitude in degrees.
+            radius_km(float): Radius in km.
+            limit(int): Maximum number of stations, all by default.
+
+        Returns:
+            list: Station dicts with their distance_km, nearest first.
+        """
+
+        slices, dots = self._within(latitude, longitude, radius_km)
+        inside = np.flatnonzero(dots >= math.cos(min(radius_km / EARTH_RADIUS_KM, math.pi)))
+        inside = inside[np.argsort(-dots[inside], kind="stable")[:limit]]
+
+        return self._results(latitude, longitude, self._positions(slices, inside).tolist() if len(inside) else [])
+
+    def count_within(self, latitude: float, longitude: float, radius_km: float):
+
+        """
+        Returns the number of stations within a radius.
+        """
+
+        _, dots = self._within(latitude, longitude, radius_km)
+
+        return int(np.count_nonzero(dots >= math.cos(min(radius_km / EARTH_RADIUS_KM, math.pi))))
+
+def load_superchargers(path: str, cell_size: float = 0.5):
+
+    """
+    Reads a CSV file of charging stations (local path or gs://) with the columns
+    id, name, latitude and longitude, and indexes them.
+
+    Returns:
+        SuperchargerIndex: The station index.
+    """
+
+    import csv
+    import io
+
+    with FileSystems.open(path) as f:
+        stations = list(csv.DictReader(io.TextIOWrapper(f, encoding="utf-8")))
+
+    logging.info("Indexed %d charging stations from %s", len(stations), path)
+
+    return SuperchargerIndex(stations, cell_size)
 
 """ Code: DoFn """
 
+class GetTrafficImageDoFn(beam.DoFn):
+
+    """
+    Simulates the images captured by the various cameras equipped on the vehicle.
+
+    The images of a bundle are fetched concurrently through a pooled HTTP session created
+    once per worker, with timeouts and retries. Image bytes are cached by content hash,
+    so repeated image URLs are downloaded only once.
+    """
+
+    def __init__(self, api_url: str, max_workers: int = 8, timeout: float = 10,
+                 retries: int = 3, cache_size: int = 256):
+
+        """
+        Params:
+            api_url(str): API that returns different images simulating the environment captured by the vehicle.
+            max_workers(int): Maximum number of concurrent requests per worker.
+            timeout(float): Timeout in seconds of every HTTP request.
+            retries(int): Retries of failed requests (connection errors, 429 and 5xx).
+            cache_size(int): Maximum number of images kept in the cache.
+        """
+
+        self.api_url = api_url
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.retries = retries
+        self.cache_size = cache_size
+        self.failures = Metrics.counter(self.__class__, "image_fetch_failures")
+        self.cache_hits = Metrics.counter(self.__class__, "image_cache_hits")
+
+    def setup(self):
+
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        from concurrent.futures import ThreadPoolExecutor
+
+        retry = Retry(total=self.retries, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        # image URL -> content hash -> image bytes
+        self.url_digests = OrderedDict()
+        self.images = {}
+        self.lock = threading.Lock()
+
+    def _read_image(self, image_url: str):
+
+        """
+        Returns the bytes of an image, downloading it only if it is not cached,
+        and whether it was a cache hit.
+        """
+
+        import hashlib
+
+        with self.lock:
+            digest = self.url_digests.get(image_url)
+
+            if digest is not None:
+                self.url_digests.move_to_end(image_url)
+                return self.images[digest], True
+
+        response = self.session.get(image_url, timeout=self.timeout)
+        response.raise_for_status()
+
+        image_bytes = response.content
+        digest = hashlib.sha256(image_bytes).hexdigest()
+
+        with self.lock:
+            self.url_digests[image_url] = digest
+            self.images[digest] = image_bytes
+
+            while len(self.url_digests) > self.cache_size:
+                _, evicted = self.url_digests.popitem(last=False)
+
+                if evicted not in self.url_digests.values():
+                    self.images.pop(evicted, None)
+
+        return image_bytes, False
+
+    def _fetch(self, item):
+
+        """
+        Calls the image API and reads the returned image.
+
+        Returns:
+            tuple ((dict, Bytes), bool, bool): The payload with the image_url appended and the image
+            in bytes, whether the image was cached and whether the fetch failed.
+            Images that cannot be fetched are returned empty and scored as no traffic.
+        """
+
+        cache_hit = failed = False
+
+        try:
+            # API call to simulate a photo captured by the radar
+            response = self.session.get(self.api_url, timeout=self.timeout)
+            response.raise_for_status()
+            image_url = response.json()["image_url"]
+
+            #Read image from URL
+            image_bytes, cache_hit = self._read_image(image_url)
+
+        except Exception as err:
+            logging.error("Failed to capture the traffic image of %s: %s", item.get("vehicle_id"), err)
+            failed = True
+            image_url, image_bytes = None, b""
+
+        #Append image_url to the payload
+        return (dict(item, image_url=image_url), image_bytes), cache_hit, failed
+
+    def start_bundle(self):
+        self.pending = []
+
+    def process(self, element, timestamp=beam.DoFn.TimestampParam, window=beam.DoFn.WindowParam):
+
+        """
+        Params:
+            element (dict): A single element from the input PCollection, representing the
+                payload with the upstream data.
+
+        Returns:
+            - The (payload, image bytes) tuples are emitted when the bundle finishes.
+        """
+
+        self.pending.append((self.executor.submit(self._fetch, element), timestamp, window))
+
+    def finish_bundle(self):
+
+        from apache_beam.utils.windowed_value import WindowedValue
+
+        for future, timestamp, window in self.pending:
+
+            result, cache_hit, failed = future.result()
+
+            # Metrics are only reported from the bundle thread, increments in the pool threads are lost
+            if cache_hit:
+                self.cache_hits.inc()
+            if failed:
+                self.failures.inc()
+
+            yield WindowedValue(result, timestamp, [window])
+
+        self.pending = []
+
+    def teardown(self):
+
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
 class FormatFirestoreDocument(beam.DoFn):
 
-    def __init__(self,mode,firestore_collection):
+    """
+    Writes the payloads as Firestore documents. The client is created once per worker and
+    the documents are buffered and written in bulk (BulkWriter), flushed when the buffer
+    is full, when the oldest document exceeds the flush latency and at the end of the bundle.
+    """
+
+    def __init__(self, mode, firestore_collection, max_batch_size: int = 500,
+                 max_flush_latency: float = 5, max_retries: int = 5):
+
+        """
+        Params:
+            mode(str): Flag that allows distinguishing between inserting critical users and non-critical ones.
+            firestore_collection(str): The Firestore collection where the documents are written.
+            max_batch_size(int): Maximum number of buffered documents before flushing.
+            max_flush_latency(float): Maximum seconds a document stays buffered before flushing.
+            max_retries(int): Maximum attempts of a failed document write.
+        """
+
         self.mode = mode
         self.firestore_collection = firestore_collection
+        self.max_batch_size = max_batch_size
+        self.max_flush_latency = max_flush_latency
+        self.max_retries = max_retries
+        self.documents_written = Metrics.counter(self.__class__, "firestore_documents_written")
+        self.documents_failed = Metrics.counter(self.__class__, "firestore_documents_failed")
+        self.batches = Metrics.counter(self.__class__, "firestore_batches")
+        self.retries = Metrics.counter(self.__class__, "firestore_retries")
+
+    def setup(self):
+
+        from google.cloud import firestore
+
+        # Firestore Client
+        self.db = firestore.Client()
+        self.collection = self.db.collection(self.firestore_collection)
+
+        # The BulkWriter callbacks run in background threads, where Beam metrics are not
+        # available, so they update local counters reported on every flush
+        self.lock = threading.Lock()
+        self.stats = {"written": 0, "failed": 0, "retries": 0}
+
+        self.bulk_writer = self.db.bulk_writer()
+        self.bulk_writer.on_write_result(self._on_write_result)
+        self.bulk_writer.on_write_error(self._on_write_error)
+
+    def _on_write_result(self, reference, result, bulk_writer):
+
+        with self.lock:
+            self.stats["written"] += 1
+
+    def _on_write_error(self, error, bulk_writer):
+
+        retry = error.attempts < self.max_retries
+
+        with self.lock:
+            self.stats["retries" if retry else "failed"] += 1
+
+        if not retry:
+            logging.error("Failed to write Firestore document %s: %s", error.operation.reference.path, error.message)
+
+        return retry
+
+    def start_bundle(self):
+
+        self.buffer = []
+        self.oldest_buffered = None
+
+    def _flush(self):
+
+        """
+        Writes the buffered documents and waits until they are committed.
+        """
+
+        if not self.buffer:
+            return
+
+        for vehicle_id, timestamp, element in self.buffer:
+            self.bulk_writer.set(
+                self.collection.document(vehicle_id).collection(self.mode).document(timestamp), element)
+
+        self.bulk_writer.flush()
+
+        with self.lock:
+            stats, self.stats = self.stats, {"written": 0, "failed": 0, "retries": 0}
+
+        self.documents_written.inc(stats["written"])
+        self.documents_failed.inc(stats["failed"])
+        self.retries.inc(stats["retries"])
+        self.batches.inc()
+
+        self.buffer = []
+        self.oldest_buffered = None
 
     def process(self, element):
 
         """
-        Formats each payload or processed element to write it as a document in Firestore
+        Formats each payload or processed element to buffer it as a document in Firestore
 
         Params:
             element (dict): A single element from the input PCollection,representing the
                 payload with the upstream data.
-            mode(str): Flag that allows distinguishing between inserting critical users and non-critical ones.
 
         Returns:
             -
         """
 
-        from google.cloud import firestore
+        if self.oldest_buffered is None:
+            self.oldest_buffered = time.monotonic()
 
-        # Firestore Client
+        self.buffer.append((element["vehicle_id"], element["timestamp"], element))
 
-        # Write Data into Firestore
-        
-        #ToDo: Complete this section
+        if (len(self.buffer) >= self.max_batch_size
+                or time.monotonic() - self.oldest_buffered >= self.max_flush_latency):
+            self._flush()
+
+    def finish_bundle(self):
+
+        self._flush()
+
+    def teardown(self):
+
+        self.bulk_writer.close()
 
 class BusinessLogicDoFn(beam.DoFn):
 
     @staticmethod
-    def _get_battery_info(battery_data: list):
+    def _get_battery_info(battery_stats: list):
+
+        """
+        Extracts the latest battery info from the aggregated data.
+        """
+
+        if not battery_stats:
+            return {}
+        
+        latest_battery = battery_stats[0]["latest"]
+
+        return {k: v for k, v in latest_battery.to_dict().items() if k != "vehicle_id"}
+
+    @staticmethod
+    def _get_environment_info(environment_stats: list):
+
+        """
+        Extracts the averages and the latest entry from the aggregated environment data.
+        """
+
+        if not environment_stats:
+            return {}
+        
+        stats = environment_stats[0]
+        latest_environment = stats["latest"]
+
+        return {
+            "timestamp": latest_environment.timestamp,
+            "latitude": latest_environment.latitude,
+            "longitude": latest_environment.longitude,
+            "avg_temperature": stats["avg_temperature"],
+            "avg_humidity": stats["avg_humidity"],
+        }
+
+    @staticmethod
+    def _get_driving_info(driving_stats: list):
 
         """
-        Extracts the latest battery info from the data.
+        Extracts the averages and the latest entry from the aggregated driving data.
         """
 
-        if not battery_data:
+        if not driving_stats:
             return {}
         
-        latest_battery = battery_data[-1]
+        stats = driving_stats[0]
+
+        return {
+            "timestamp": stats["latest"].timestamp,
+            "avg_speed": stats["avg_speed"],
+            "avg_braking_force": stats["avg_braking_force"],
+            "avg_steering_angle": stats["avg_steering_angle"],
+        }
+
+    def process(self, element):
+
+        """
+        DoFn class that implements the business logic: checks for vehicles with 
+        less than 30% battery and no charging event within the analyzed window.
+        As output,it separates both cases into different output PCollections
+        for further analysis.
+
+        Params:
+            element (tuple): Vehicle ID and the aggregated battery, driving and environment data.
+
+        Yields:
+            PCollection (TaggedOutput): 
+                - "critical_battery_users": Telemetry data for vehicles with critical battery levels (< 30%) and no charging events.
+                - "non_critical_battery_users": Telemetry data for vehicles with sufficient battery levels or charging events.
+        """
+
+        vehicle_id, data = element
+
+        battery_data = data["battery"]
+        battery_info = self._get_battery_info(battery_data)
+
+        payload = {
+            "vehicle_id": vehicle_id,
+            "timestamp": battery_info.get("timestamp", datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")),
+            "battery_info": battery_info,
+            "driving_info": self._get_driving_info(data["driving"]),
+            "environment_info": self._get_environment_info(data["environment"]),
+        }
+
+        has_charged = bool(battery_data) and battery_data[0]["has_charged"]
+
+        if battery_info and battery_info["battery_level"] < 30 and not has_charged:
+            yield beam.pvalue.TaggedOutput("critical_battery_users", payload)
+        else:
+            yield beam.pvalue.TaggedOutput("non_critical_battery_users", payload)
+
+class StatefulBusinessLogicDoFn(BusinessLogicDoFn):
+
+    """
+    Alternative to the windowed CoGroupByKey: keeps the latest battery reading and
+    the running driving/environment aggregates of each vehicle in Beam state and
+    raises the critical battery decision as soon as the reading arrives.
+    """
+
+    BATTERY_STATE = CombiningValueStateSpec("battery", combine_fn=TelemetryStatsCombineFn())
+    DRIVING_STATE = CombiningValueStateSpec("driving", combine_fn=TelemetryStatsCombineFn(
+        avg_fields=("speed", "braking_force", "steering_angle")))
+    ENVIRONMENT_STATE = CombiningValueStateSpec("environment", combine_fn=TelemetryStatsCombineFn(
+        avg_fields=("temperature", "humidity")))
+    ALERTED_STATE = ReadModifyWriteStateSpec("alerted", BooleanCoder())
+    FLUSH_PENDING_STATE = ReadModifyWriteStateSpec("flush_pending", BooleanCoder())
+    FLUSH_TIMER = TimerSpec("flush", TimeDomain.WATERMARK)
 
-        return {k: v for k, v in latest_battery.items() if k != "vehicle_id"}
+    def __init__(self, flush_interval: int = 60):
+        self.flush_interval = flush_interval
+        self.critical_alerts = Metrics.counter(self.__class__, "critical_alerts")
 
     @staticmethod
-    def _get_environment_info(environment_data: list):
+    def _read(state):
 
         """
-        Aggregates environment data to compute averages and extract the latest entry.
+        Returns the aggregated state wrapped as the CoGroupByKey output (empty list if no events).
         """
 
-        if not environment_data:
-            return {}
-        
-        avg_temperature = sum(e["temperature"] for e in environment_data) / len(environment_data)
-        avg_humidity = sum(e["humidity"] for e in environment_data) / len(environment_data)
-        latest_environment = environment_data[-1]
+        stats = state.read()
 
-        return {
-            "timestamp": latest_environment["timestamp"],
-            "latitude": latest_environment["latitude"],
-            "longitude": latest_environment["longitude"],
-            "avg_temperature": avg_temperature,
-            "avg_humidity": avg_humidity,
-        }
+        return [stats] if stats["count"] else []
 
     @staticmethod
-    def _get_driving_info(event_data: list):
+    def _is_critical(battery_stats: dict):
 
         """
-        Aggregates driving event data to compute averages and extract the latest entry.
+        Same decision as the windowed path, on the latest reading by timestamp, so late events don't flip it.
         """
 
-        if not event_data:
-            return {}
-        
-        avg_speed = sum(e["speed"] for e in event_data) / len(event_data)
-        avg_braking_force = sum(e["braking_force"] for e in event_data) / len(event_data)
-        avg_steering_angle = sum(e["steering_angle"] for e in event_data) / len(event_data)
-        latest_event = event_data[-1]
+        return battery_stats["latest"].battery_level < 30 and not battery_stats["has_charged"]
 
-        return {
-            "timestamp": latest_event["timestamp"],
-            "avg_speed": avg_speed,
-            "avg_braking_force": avg_braking_force,
-            "avg_steering_angle": avg_steering_angle,
+    def _build_payload(self, vehicle_id, battery, driving, environment):
+
+        battery_data = self._read(battery)
+        battery_info = self._get_battery_info(battery_data)
+
+        payload = {
+            "vehicle_id": vehicle_id,
+            "timestamp": battery_info.get("timestamp", datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")),
+            "battery_info": battery_info,
+            "driving_info": self._get_driving_info(self._read(driving)),
+            "environment_info": self._get_environment_info(self._read(environment)),
         }
 
-    def process(self, element):
+        return payload, battery_data
+
+    def process(self, element,
+                timestamp=beam.DoFn.TimestampParam,
+                battery=beam.DoFn.StateParam(BATTERY_STATE),
+                driving=beam.DoFn.StateParam(DRIVING_STATE),
+                environment=beam.DoFn.StateParam(ENVIRONMENT_STATE),
+                alerted=beam.DoFn.StateParam(ALERTED_STATE),
+                flush_pending=beam.DoFn.StateParam(FLUSH_PENDING_STATE),
+                flush_timer=beam.DoFn.TimerParam(FLUSH_TIMER)):
 
         """
-        DoFn class that implements the business logic: checks for vehicles with 
-        less than 30% battery and no charging event within the analyzed window.
-        As output,it separates both cases into different output PCollections
-        for further analysis.
+        Updates the state of the vehicle with a single telemetry event.
 
         Params:
-            element (dict): A dictionary containing vehicle telemetry data.
+            element (tuple): Vehicle ID and a (telemetry type, event) tuple.
 
         Yields:
             PCollection (TaggedOutput): 
-                - "critical_battery_users": Telemetry data for vehicles with critical battery levels (< 30%) and no charging events.
-                - "non_critical_battery_users": Telemetry data for vehicles with sufficient battery levels or charging events.
+                - "critical_battery_users": Emitted as soon as the latest battery reading is below 30%
+                  with no charging event in the interval, and driving and environment data are available.
+                - "non_critical_battery_users": Emitted by the flush timer for non-critical vehicles without an active alert.
+                  Critical vehicles still missing driving or environment data are emitted as critical by the timer.
+        """
+
+        vehicle_id, (telemetry_type, event) = element
+
+        {"battery": battery, "driving": driving, "environment": environment}[telemetry_type].add(event)
+
+        if not flush_pending.read():
+            flush_timer.set(timestamp + self.flush_interval)
+            flush_pending.write(True)
+
+        stats = battery.read()
+
+        if not stats["count"]:
+            return
+
+        if not self._is_critical(stats):
+            alerted.clear()
+
+        elif not alerted.read():
+
+            payload, _ = self._build_payload(vehicle_id, battery, driving, environment)
+
+            # The autonomy needs the driving and environment aggregates, wait for them whatever the arrival order
+            if not payload["driving_info"] or not payload["environment_info"]:
+                return
+
+            alerted.write(True)
+            self.critical_alerts.inc()
+
+            yield beam.pvalue.TaggedOutput("critical_battery_users", payload)
+
+    @on_timer(FLUSH_TIMER)
+    def flush(self,
+              key=beam.DoFn.KeyParam,
+              battery=beam.DoFn.StateParam(BATTERY_STATE),
+              driving=beam.DoFn.StateParam(DRIVING_STATE),
+              environment=beam.DoFn.StateParam(ENVIRONMENT_STATE),
+              alerted=beam.DoFn.StateParam(ALERTED_STATE),
+              flush_pending=beam.DoFn.StateParam(FLUSH_PENDING_STATE)):
+
+        """
+        Emits the aggregated data of the interval for the vehicles without an alert and resets the aggregates.
         """
 
-        #ToDo: Complete this section
+        payload, battery_data = self._build_payload(key, battery, driving, environment)
+
+        if not alerted.read():
+
+            # Critical vehicles whose driving or environment data never arrived were not alerted
+            # by process, they are still critical, as in the windowed path
+            if battery_data and self._is_critical(battery_data[0]):
+                alerted.write(True)
+                self.critical_alerts.inc()
+                yield beam.pvalue.TaggedOutput("critical_battery_users", payload)
+            else:
+                yield beam.pvalue.TaggedOutput("non_critical_battery_users", payload)
+
+        # Keep the latest battery reading across intervals
+        battery.clear()
+        if battery_data:
+            battery.add(battery_data[0]["latest"])
+
+        driving.clear()
+        environment.clear()
+        flush_pending.clear()
 
 class CalculateAutonomyDoFn(beam.DoFn):
 
-    @staticmethod
-    def _categorize_traffic(traffic_score: float):
+    # Default model, replaced by the autonomy model side input when --autonomy_model is given
+    MODEL = AutonomyModel()
+
+    # Autonomy = Battery available * Efficiency * traffic coefficient
+    KEYS_TO_CHECK = [
+        ('battery_info', 'battery_level'),
+        ('environment_info', 'avg_temperature'),
+        ('environment_info', 'avg_humidity'),
+        ('driving_info', 'avg_braking_force')
+    ]
+
+    @classmethod
+    def _categorize_traffic(cls, traffic_score: float, model: AutonomyModel = None):
         """
         Categorizes traffic level and determines the autonomy factor.
 
@@ -216,15 +1466,17 @@ class CalculateAutonomyDoFn(beam.DoFn):
             Tuple[str, float]: Traffic level and corresponding autonomy factor.
         """
 
-        if traffic_score > 1.5:
-            return "High", 0.7
-        elif 0.5 < traffic_score <= 1.5:
-            return "Medium", 0.85
-        else:
-            return "Low", 1.0
-        
-    @staticmethod
-    def _calculate_efficiency(temperature: float, humidity: float, braking_force: float) -> float:
+        model = model or cls.MODEL
+
+        for threshold, level, factor in model.traffic_levels:
+            if traffic_score > threshold:
+                return level, factor
+
+        return model.default_traffic_level
+
+    @classmethod
+    def _calculate_efficiency(cls, temperature: float, humidity: float, braking_force: float,
+                              model: AutonomyModel = None) -> float:
         """
         Calculates the vehicle's efficiency based on environmental and driving conditions.
 
@@ -237,28 +1489,40 @@ class CalculateAutonomyDoFn(beam.DoFn):
             float: Calculated efficiency.
         """
         # Constants
-        base_efficiency = 6.5
-        temp_coefficient = 0.01
-        humidity_coefficient = 0.005
-        brake_coefficient = 0.05
-        optimal_temperature = 25
-        optimal_humidity = 50
+        model = model or cls.MODEL
 
         # Efficiency adjustments
-        temp_adjusted = (1 - temp_coefficient * abs(temperature - optimal_temperature))
-        humidity_adjusted = (1 - humidity_coefficient * abs(humidity - optimal_humidity))
-        brake_adjusted = (1 + brake_coefficient * abs(braking_force))
+        temp_adjusted = (1 - model.temp_coefficient * abs(temperature - model.optimal_temperature))
+        humidity_adjusted = (1 - model.humidity_coefficient * abs(humidity - model.optimal_humidity))
+        brake_adjusted = (1 + model.brake_coefficient * abs(braking_force))
 
-        return base_efficiency * temp_adjusted * humidity_adjusted * brake_adjusted
+        return model.base_efficiency * temp_adjusted * humidity_adjusted * brake_adjusted
 
-    def process(self, element):
+    @classmethod
+    def _is_valid(cls, payload: dict):
+
+        return all(key in payload[section] for section, key in cls.KEYS_TO_CHECK if section in payload)
+
+    @staticmethod
+    def _autonomy_info(traffic_score, traffic_level, autonomy_factor, efficiency, autonomy):
+
+        return {
+            "traffic_score": traffic_score,
+            "traffic_level": traffic_level,
+            "autonomy_factor": autonomy_factor,
+            "efficiency": efficiency,
+            "autonomy_km": round(autonomy, 2)
+        }
+
+    def process(self, element, model: AutonomyModel = None):
 
         """
         DoFn that, based on all the collected and enriched data, determines the vehicle's
-        range and identifies the nearest supercharger station based on its position.
+        range. The nearest supercharger stations are added by FindSuperchargersDoFn.
 
         Params:
             element(PCollection): Payload with the upstream data.
+            model(AutonomyModel): Autonomy model side input, MODEL by default.
 
         Yields:
             dict: A dictionary containing the enriched data, including the range, 
@@ -267,35 +1531,228 @@ class CalculateAutonomyDoFn(beam.DoFn):
         """
 
         dict, traffic_score = element
+        model = model or self.MODEL
 
         # Determine traffic level and autonomy factor
-        traffic_level, autonomy_factor = self._categorize_traffic(traffic_score)
-
-        # Autonomy = Battery available * Efficiency * traffic coefficient
-        keys_to_check = [
-            ('battery_info', 'battery_level'),
-            ('environment_info', 'avg_temperature'),
-            ('environment_info', 'avg_humidity'),
-            ('driving_info', 'avg_braking_force')
-        ]
+        traffic_level, autonomy_factor = self._categorize_traffic(traffic_score, model)
 
-        is_valid = all(key in dict[section] for section, key in keys_to_check if section in dict)
+        if self._is_valid(dict):
 
-        if is_valid:
-
-            # Input params
-            #ToDo: Complete this section
+            # Input params
+            battery_available = dict['battery_info']['battery_level']
+            temperature = dict['environment_info']['avg_temperature']
+            humidity = dict['environment_info']['avg_humidity']
+            braking_force = dict['driving_info']['avg_braking_force']
 
             # Calculate efficiency and autonomy
-            efficiency = self._calculate_efficiency(temperature, humidity, braking_force)
+            efficiency = self._calculate_efficiency(temperature, humidity, braking_force, model)
             autonomy = battery_available * efficiency * autonomy_factor
 
             # Append data to the payload
-            #ToDo: Complete this section
+            dict['autonomy_info'] = self._autonomy_info(traffic_score, traffic_level, autonomy_factor, efficiency, autonomy)
+
+            yield dict
+
+class BatchedCalculateAutonomyDoFn(CalculateAutonomyDoFn):
+
+    """
+    Vectorized CalculateAutonomyDoFn: buffers the elements of a bundle and computes the
+    efficiency, traffic level and autonomy of all of them in a single NumPy pass.
+
+    The operations are applied in the same order as in the scalar path, so the results
+    are identical (see benchmark_autonomy.py).
+    """
+
+    def __init__(self, max_batch_size: int = 1000):
+
+        """
+        Params:
+            max_batch_size(int): Maximum number of buffered elements before computing a batch.
+        """
+
+        self.max_batch_size = max_batch_size
+
+    @staticmethod
+    def _categorize_traffic_batch(traffic_scores, model: AutonomyModel):
+
+        """
+        Returns the traffic level index (into model.levels) and the autonomy factor of every score.
+        """
+
+        thresholds = model.thresholds
+
+        if thresholds:
+            # NaN scores are not above any threshold, as in the scalar comparison
+            conditions = [traffic_scores > threshold for threshold in thresholds]
+            indexes = np.select(conditions, np.arange(len(thresholds)), default=len(thresholds))
+        else:
+            indexes = np.zeros(len(traffic_scores), dtype=np.int64)
+
+        return indexes, model.factors[indexes]
+
+    @staticmethod
+    def _calculate_efficiency_batch(temperatures, humidities, braking_forces, model: AutonomyModel):
+
+        temp_adjusted = (1 - model.temp_coefficient * np.abs(temperatures - model.optimal_temperature))
+        humidity_adjusted = (1 - model.humidity_coefficient * np.abs(humidities - model.optimal_humidity))
+        brake_adjusted = (1 + model.brake_coefficient * np.abs(braking_forces))
+
+        return model.base_efficiency * temp_adjusted * humidity_adjusted * brake_adjusted
+
+    def _calculate_batch(self, elements, model: AutonomyModel = None):
+
+        """
+        Computes the autonomy of a list of (payload, traffic score) elements.
+
+        Params:
+            elements(list): (payload, traffic score) elements.
+            model(AutonomyModel): Autonomy model, MODEL by default.
+
+        Returns:
+            list: The payloads with autonomy_info appended (invalid payloads are dropped),
+                with the index of their element.
+        """
+
+        valid = [(i, payload, score) for i, (payload, score) in enumerate(elements) if self._is_valid(payload)]
+
+        if not valid:
+            return []
+
+        scores = np.array([score for _, _, score in valid], dtype=np.float64)
+        battery = np.array([p['battery_info']['battery_level'] for _, p, _ in valid], dtype=np.float64)
+        temperatures = np.array([p['environment_info']['avg_temperature'] for _, p, _ in valid], dtype=np.float64)
+        humidities = np.array([p['environment_info']['avg_humidity'] for _, p, _ in valid], dtype=np.float64)
+        braking_forces = np.array([p['driving_info']['avg_braking_force'] for _, p, _ in valid], dtype=np.float64)
+
+        model = model or self.MODEL
+
+        level_indexes, factors = self._categorize_traffic_batch(scores, model)
+        efficiencies = self._calculate_efficiency_batch(temperatures, humidities, braking_forces, model)
+        autonomies = battery * efficiencies * factors
+
+        levels = model.levels
+        results = []
+
+        # tolist() converts to Python floats, so rounding and the stored values match the scalar path
+        for (i, payload, score), level_index, factor, efficiency, autonomy in zip(
+                valid, level_indexes.tolist(), factors.tolist(), efficiencies.tolist(), autonomies.tolist()):
+
+            payload['autonomy_info'] = self._autonomy_info(score, levels[level_index], factor, efficiency, autonomy)
+            results.append((i, payload))
+
+        return results
+
+    def start_bundle(self):
+        self.buffer = []
+        self.buffer_model = None
+
+    def _flush(self):
+
+        from apache_beam.utils.windowed_value import WindowedValue
+
+        results = self._calculate_batch([element for element, _, _ in self.buffer], self.buffer_model)
+
+        for i, payload in results:
+            _, timestamp, window = self.buffer[i]
+            yield WindowedValue(payload, timestamp, [window])
+
+        self.buffer = []
+
+    def process(self, element, timestamp=beam.DoFn.TimestampParam, window=beam.DoFn.WindowParam,
+                model: AutonomyModel = None):
+
+        """
+        Buffers the element. The enriched payloads are emitted when the buffer is full,
+        when the autonomy model changes or when the bundle finishes.
+        """
+
+        # A batch is computed with a single model
+        if self.buffer and model is not self.buffer_model:
+            yield from self._flush()
+
+        self.buffer.append((element, timestamp, window))
+        self.buffer_model = model
+
+        if len(self.buffer) >= self.max_batch_size:
+            yield from self._flush()
+
+    def finish_bundle(self):
+
+        yield from self._flush()
+
+class FindSuperchargersDoFn(beam.DoFn):
+
+    """
+    Adds the nearest charging stations to the payload, and how many stations are
+    reachable with the remaining autonomy. The station index is loaded once per
+    worker process and shared by its threads.
+    """
+
+    def __init__(self, shared_handle, path: str, k: int = 3, cell_size: float = 0.5):
+
+        """
+        Params:
+            shared_handle(shared.Shared): Handle of the per-process station index.
+            path(str): CSV file of charging stations (local path or gs://).
+            k(int): Number of nearest stations added to the payload.
+            cell_size(float): Grid cell size of the index in degrees.
+        """
+
+        self.shared_handle = shared_handle
+        self.path = path
+        self.k = k
+        self.cell_size = cell_size
+
+    def setup(self):
+        self.index = self.shared_handle.acquire(lambda: load_superchargers(self.path, self.cell_size))
+
+    def process(self, element):
+
+        environment_info = element.get("environment_info") or {}
+
+        if "latitude" in environment_info:
+
+            latitude, longitude = environment_info["latitude"], environment_info["longitude"]
 
+            element["supercharger_info"] = {
+                "nearest": self.index.nearest(latitude, longitude, self.k),
+                "reachable": self.index.count_within(latitude, longitude, element["autonomy_info"]["autonomy_km"])
+            }
+
+        yield element
 
 class CloudVisionModelHandler(ModelHandler):
 
+    # The Vision API accepts at most 16 images per BatchAnnotateImages request
+    MAX_IMAGES_PER_REQUEST = 16
+
+    TRAFFIC_KEYWORDS = {"traffic", "congestion", "car", "vehicle", "pedestrian", "public transport", "urban area", "city"}
+
+    def __init__(self, min_batch_size: int = 1, max_batch_size: int = 64,
+                 max_batch_duration_secs: int = 1, max_concurrent_requests: int = 4):
+
+        """
+        Params:
+            min_batch_size(int): Minimum number of images per inference batch.
+            max_batch_size(int): Maximum number of images per inference batch. Batches larger than
+                16 images are split into concurrent Vision API requests.
+            max_batch_duration_secs(int): Maximum seconds an element waits for its batch to fill.
+            max_concurrent_requests(int): Maximum number of concurrent Vision API requests per batch.
+        """
+
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.max_batch_duration_secs = max_batch_duration_secs
+        self.max_concurrent_requests = max_concurrent_requests
+
+    def batch_elements_kwargs(self):
+
+        return {
+            "min_batch_size": self.min_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "max_batch_duration_secs": self.max_batch_duration_secs,
+        }
+
     def load_model(self):
         
         """Initiate the Google Vision API client."""
@@ -304,60 +1761,85 @@ class CloudVisionModelHandler(ModelHandler):
         
         client = vision.ImageAnnotatorClient()
         return client
+
+    def _annotate(self, model, image_batch):
+
+        """
+        Sends a single BatchAnnotateImages request (up to 16 images) and returns the traffic score of each image.
+        """
+
+        from google.cloud import vision
+        from google.cloud.vision_v1.types import Feature
+
+        feature = Feature()
+        feature.type_ = Feature.Type.LABEL_DETECTION
+
+        image_requests = [
+            vision.AnnotateImageRequest(image=vision.Image(content=image_bytes), features=[feature])
+            for image_bytes in image_batch]
+        batch_image_request = vision.BatchAnnotateImagesRequest(requests=image_requests)
+
+        model_responses = model.batch_annotate_images(request=batch_image_request).responses
+
+        scores = []
+
+        for response in model_responses:
+
+            if response.error.message:
+                logging.warning("Vision API could not annotate an image: %s", response.error.message)
+
+            # Calculate traffic score
+            scores.append(sum(label.score for label in response.label_annotations
+                              if label.description.lower() in self.TRAFFIC_KEYWORDS))
+
+        return scores
     
-    def run_inference(self, batch, model, inference):
+    def run_inference(self, batch, model, inference_args=None):
 
         """
         A RunInference class that performs label detection using a pre-trained model (Vertex AI)
 
         This class processes batches of images, detects labels using the label_detection
         method, and returns the results with labels and their confidence scores.
+        Batches larger than the Vision API limit are split into concurrent requests.
 
         Params:
 
-            A list of tuples (str, bytes), where:
-                str: An identifier for the image.
+            A list of tuples (dict, bytes), where:
+                dict: The payload of the vehicle.
                 bytes: The image data in binary format.
 
         Yields:
-            tuple (dict, Bytes): A tuple where:
+            tuple (dict, float): A tuple for every image of the batch where:
                 - dict: A single element from the input PCollection, representing the
                     payload with the upstream data.
-                - list: Detected scores for the image (label annotations).
+                - float: Traffic score of the image (label annotations).
 
         """
 
-        from google.cloud import vision
-        from google.cloud.vision_v1.types import Feature
-
-
-        feature = Feature()
-        feature.type_ = Feature.Type.LABEL_DETECTION
+        from concurrent.futures import ThreadPoolExecutor
 
-        images = [vision.Image(content=image_bytes) for (item, image_bytes) in batch]
         item_list = [item for (item, image_bytes) in batch]
+        images = [image_bytes for (item, image_bytes) in batch]
 
-        image_requests = [vision.AnnotateImageRequest(image=image, features=[feature]) for image in images]
-        batch_image_request = vision.BatchAnnotateImagesRequest(requests=image_requests)
-
-        model_responses = model.batch_annotate_images(request=batch_image_request).responses
-
-        response = model_responses[0].label_annotations
-        output_dict = item_list[0]
+        image_batches = [images[i:i + self.MAX_IMAGES_PER_REQUEST]
+                         for i in range(0, len(images), self.MAX_IMAGES_PER_REQUEST)]
 
-        traffic_objects = [text for text in response]
+        if len(image_batches) == 1:
+            batch_scores = [self._annotate(model, image_batches[0])]
 
-        traffic_keywords = {"traffic", "congestion", "car", "vehicle", "pedestrian", "public transport", "urban area", "city"}
+        else:
+            with ThreadPoolExecutor(max_workers=min(len(image_batches), self.max_concurrent_requests)) as executor:
+                batch_scores = list(executor.map(lambda image_batch: self._annotate(model, image_batch), image_batches))
 
-        # Calculate traffic score
-        traffic_score = sum(label.score for label in traffic_objects if label.description.lower() in traffic_keywords)
+        scores = [score for image_scores in batch_scores for score in image_scores]
 
-        yield output_dict, traffic_score
+        yield from zip(item_list, scores)
 
 
 """ Code: Dataflow Process """
 
-def run():
+def run(argv=None):
 
     """ Input Arguments """
 
@@ -404,92 +1886,310 @@ def run():
                 required=True,
                 help='System that evaluates the telemetry data of the car.')
 
-    args, pipeline_opts = parser.parse_known_args()
+    parser.add_argument(
+                '--window_size',
+                required=False,
+                type=int,
+                default=60,
+                help='Size in seconds of the fixed windows used to aggregate the telemetry data.')
+
+    parser.add_argument(
+                '--processing_mode',
+                required=False,
+                choices=['windowed', 'stateful'],
+                default='windowed',
+                help='windowed: fixed windows and CoGroupByKey. stateful: per-vehicle state and timers, critical alerts are emitted on arrival and the rest flushed every --window_size seconds.')
+
+    parser.add_argument(
+                '--traffic_cache_cell_size',
+                required=False,
+                type=float,
+                default=0.01,
+                help='Size in degrees of the grid cells whose vehicles share a traffic score.')
+
+    parser.add_argument(
+                '--traffic_cache_bucket_seconds',
+                required=False,
+                type=int,
+                default=60,
+                help='Size in seconds of the time buckets whose vehicles share a traffic score.')
+
+    parser.add_argument(
+                '--traffic_cache_ttl',
+                required=False,
+                type=float,
+                default=300,
+                help='Seconds a cached traffic score remains valid.')
+
+    parser.add_argument(
+                '--traffic_cache_size',
+                required=False,
+                type=int,
+                default=10000,
+                help='Maximum number of cached traffic scores per worker.')
+
+    parser.add_argument(
+                '--transport',
+                required=False,
+                choices=['pubsub', 'local'],
+                default='pubsub',
+                help='pubsub: Google Cloud services. local: in-process broker (see local_transport.py) for benchmarks on the DirectRunner.')
+
+    parser.add_argument(
+                '--json_codec',
+                required=False,
+                choices=['auto', 'orjson', 'msgspec', 'json'],
+                default='auto',
+                help='JSON decoder of the telemetry messages. auto uses orjson or msgspec when installed and the standard library otherwise.')
+
+    parser.add_argument(
+                '--dead_letter_topic',
+                required=False,
+                default=None,
+                help='Optional PubSub topic where malformed telemetry messages are published.')
+
+    parser.add_argument(
+                '--autonomy_mode',
+                required=False,
+                choices=['vectorized', 'scalar'],
+                default='vectorized',
+                help='vectorized: computes the autonomy of the buffered elements of a bundle in a single NumPy pass. scalar: one element at a time.')
+
+    parser.add_argument(
+                '--autonomy_model',
+                required=False,
+                default=None,
+                help='Optional JSON file (local path or gs://) with the autonomy model coefficients, reloaded periodically.')
+
+    parser.add_argument(
+                '--autonomy_model_refresh',
+                required=False,
+                type=int,
+                default=300,
+                help='Seconds between reloads of the autonomy model file.')
+
+    parser.add_argument(
+                '--superchargers',
+                required=False,
+                default=None,
+                help='Optional CSV file (local path or gs://) of charging stations with id, name, latitude and longitude columns.')
+
+    parser.add_argument(
+                '--superchargers_k',
+                required=False,
+                type=int,
+                default=3,
+                help='Number of nearest charging stations added to the critical vehicles.')
+
+    args, pipeline_opts = parser.parse_known_args(argv)
+
+    local = args.transport == 'local'
+
+    if local:
+        from local_transport import (ReadFromLocalPubSub, WriteToLocalPubSub,
+                                     getLocalTrafficImage, LocalTrafficModelHandler)
+
+    # Imported here, so the module is not part of the main session pickled for the workers
+    from telemetry_schemas import TELEMETRY_SCHEMAS
 
     """ Pipeline """
 
     # A. Pipeline Options
 
     options = PipelineOptions(pipeline_opts,
-        save_main_session=True, streaming=True, project=args.project_id)
+        save_main_session=True, streaming=not local, project=args.project_id)
     
     # B. Pipeline Object
 
     with beam.Pipeline(argv=pipeline_opts,options=options) as p:
 
-        """
-        IMPORTANT TIP. How to reduce repetition in Beam pipelines:
-
         telemetry_sources = {
             "battery": args.battery_telemetry_subscription,
             "driving": args.driving_telemetry_subscription,
             "environment": args.environment_telemetry_subscription,
         }
 
+        telemetry_combiners = {
+            "battery": TelemetryStatsCombineFn(),
+            "driving": TelemetryStatsCombineFn(avg_fields=("speed", "braking_force", "steering_angle")),
+            "environment": TelemetryStatsCombineFn(avg_fields=("temperature", "humidity")),
+        }
+
         telemetry_data = {}
+        dead_letters = []
 
         for telemetry_type, subscription in telemetry_sources.items():
-            telemetry_data[telemetry_type] = (
+
+            if local:
+                source = ReadFromLocalPubSub(topic_name=subscription)
+            else:
+                source = beam.io.ReadFromPubSub(subscription=f'projects/{args.project_id}/subscriptions/{subscription}',
+                                                with_attributes=True)
+
+            parsed = (
                 p
-                | f"Read {telemetry_type.capitalize()} Telemetry Data From PubSub" >> #ToDo: Complete this section
-                | f"Parse JSON {telemetry_type} messages" >> #ToDo: Complete this section
-                | f"Fixed Window for {telemetry_type.capitalize()} Telemetry Data" >> #ToDo: Complete this section
+                    | f"Read {telemetry_type.capitalize()} Telemetry Data From PubSub" >> source
+                    | f"Parse JSON {telemetry_type} messages" >> beam.ParDo(
+                        ParsePubSubMessageDoFn(telemetry_type, codec=args.json_codec,
+                            avro_schemas={version: schemas[telemetry_type] for version, schemas in TELEMETRY_SCHEMAS.items()})
+                        ).with_outputs("dead_letter", main="parsed")
             )
-        """
 
-        battery_data = (
-            p 
-                | "Read Battery Telemetry Data From PubSub" >> #ToDo: Complete this section
-                | "Parse JSON battery messages" >> #ToDo: Complete this section
-                | "Fixed Window for Battery Telemetry Data" >> #ToDo: Complete this section
+            telemetry_data[telemetry_type] = parsed.parsed
+            dead_letters.append(parsed.dead_letter)
+
+        if local:
+            write_dead_letters = beam.ParDo(WriteToLocalPubSub(topic_name="dead_letter"))
+        elif args.dead_letter_topic:
+            write_dead_letters = beam.io.WriteToPubSub(topic=f'projects/{args.project_id}/topics/{args.dead_letter_topic}')
+        else:
+            write_dead_letters = None
+
+        if write_dead_letters is not None:
+            (
+                dead_letters
+                    | "Merge Malformed Messages" >> beam.Flatten()
+                    | "Write Malformed Messages" >> write_dead_letters
+            )
+
+        if args.processing_mode == 'stateful':
+
+            # Single keyed stream, the per-vehicle state replaces windows and the shuffle of the join
+            tagged_data = [
+                telemetry_data[telemetry_type]
+                    | f"Tag {telemetry_type} events" >> beam.Map(lambda kv, t=telemetry_type: (kv[0], (t, kv[1])))
+                for telemetry_type in telemetry_sources
+            ]
+
+            processed_data = (tagged_data
+                | "Merge Telemetry Streams" >> beam.Flatten()
+                | "Check battery level" >> beam.ParDo(StatefulBusinessLogicDoFn(flush_interval=args.window_size)).with_outputs(
+                    "critical_battery_users", "non_critical_battery_users")
+            )
+
+        else:
+
+            aggregated_data = {
+                telemetry_type: (
+                    pcoll
+                        | f"Fixed Window for {telemetry_type.capitalize()} Telemetry Data" >> beam.WindowInto(window.FixedWindows(args.window_size))
+                        | f"Aggregate {telemetry_type.capitalize()} Telemetry Data" >> beam.CombinePerKey(telemetry_combiners[telemetry_type])
+                )
+                for telemetry_type, pcoll in telemetry_data.items()
+            }
+
+            # CoGroupByKey
+            grouped_data = (
+                aggregated_data | "Merge PCollections" >> beam.CoGroupByKey())
+            
+            processed_data = (grouped_data
+                | "Check battery level" >> beam.ParDo(BusinessLogicDoFn()).with_outputs(
+                    "critical_battery_users", "non_critical_battery_users")
+            )
+
+        if local:
+            write_non_critical = beam.ParDo(WriteToLocalPubSub(topic_name="firestore/non_critical_battery_users"))
+            write_critical = beam.ParDo(WriteToLocalPubSub(topic_name="firestore/critical_battery_users"))
+            write_notifications = beam.ParDo(WriteToLocalPubSub(topic_name=args.output_topic))
+            traffic_image = beam.Map(getLocalTrafficImage)
+            model_handler = LocalTrafficModelHandler()
+        else:
+            write_non_critical = beam.ParDo(FormatFirestoreDocument(mode="non_critical_battery_users", firestore_collection=args.firestore_collection))
+            write_critical = beam.ParDo(FormatFirestoreDocument(mode="critical_battery_users", firestore_collection=args.firestore_collection))
+            write_notifications = beam.io.WriteToPubSub(topic=f'projects/{args.project_id}/topics/{args.output_topic}')
+            traffic_image = beam.ParDo(GetTrafficImageDoFn(api_url=args.image_api))
+            model_handler = CloudVisionModelHandler()
+
+        (
+            processed_data.non_critical_battery_users
+                | "Write non_critical_battery_users documents" >> write_non_critical
         )
 
-        driving_data = (
-            p 
-                | "Read Driving Telemetry Data From PubSub" >> #ToDo: Complete this section
-                | "Parse JSON driving messages" >> #ToDo: Complete this section
-                | "Fixed Window for Driving Telemetry Data" >> #ToDo: Complete this section
+        traffic_cache = shared.Shared()
+        traffic_cache_kwargs = {
+            "cell_size": args.traffic_cache_cell_size,
+            "bucket_seconds": args.traffic_cache_bucket_seconds,
+            "ttl_seconds": args.traffic_cache_ttl,
+            "max_size": args.traffic_cache_size,
+        }
+
+        traffic_lookup = (
+            processed_data.critical_battery_users
+                | "Lookup Traffic Score Cache" >> beam.ParDo(LookupTrafficScoreDoFn(traffic_cache, traffic_cache_kwargs)).with_outputs(
+                    "cached", main="missed")
         )
 
-        environment_data = (
-            p 
-                | "Read Environment Telemetry Data From PubSub" >> #ToDo: Complete this section
-                | "Parse JSON environment messages" >> #ToDo: Complete this section
-                | "Fixed Window for Environment Telemetry Data" >> #ToDo: Complete this section
+        inferred_data = (
+            traffic_lookup.missed
+                | "Capture Traffic Image" >> traffic_image
+                | "Model Inference" >> RunInference(model_handler=model_handler) 
+                | "Store Traffic Score" >> beam.ParDo(StoreTrafficScoreDoFn(traffic_cache, traffic_cache_kwargs))
         )
 
-        # CoGroupByKey
-        grouped_data = (
-            battery_data, driving_data, environment_data) | "Merge PCollections" >> #ToDo: Complete this section
-        
-        processed_data = (grouped_data
-            | "Check battery level" >> #ToDo: Complete this section
+        merged_data = (
+            (inferred_data, traffic_lookup.cached)
+                | "Merge Traffic Scores" >> beam.Flatten()
         )
 
+        # Autonomy model coefficients as a slowly-updating side input
+        autonomy_side_inputs = {}
 
-        (
-            processed_data.non_critical_battery_users
-                | "Write non_critical_battery_users documents" >> #ToDo: Complete this section
-        )
+        if args.autonomy_model:
+
+            # Local runs are bounded, the model is loaded once
+            if local:
+                model_ticks = p | "Autonomy Model Tick" >> beam.Create([None])
+
+            # Reloaded in every --autonomy_model_refresh window, the main input is windowed
+            # the same way so each element reads the model of its window
+            else:
+                model_ticks = p | "Autonomy Model Refresh" >> PeriodicImpulse(
+                    fire_interval=args.autonomy_model_refresh, apply_windowing=True)
+
+                merged_data = merged_data | "Autonomy Model Windows" >> beam.WindowInto(
+                    window.FixedWindows(args.autonomy_model_refresh))
+
+            autonomy_model = (
+                model_ticks
+                    | "Load Autonomy Model" >> beam.ParDo(LoadAutonomyModelDoFn(args.autonomy_model))
+                    | "Latest Autonomy Model" >> beam.combiners.Latest.Globally().without_defaults()
+            )
+
+            # Elements older than the first reload (e.g. a subscription backlog) use the default model
+            autonomy_side_inputs["model"] = beam.pvalue.AsSingleton(autonomy_model, default_value=None)
 
         send_data = (
-            processed_data.critical_battery_users
-                | "Capture Traffic Image" >> #ToDo: Complete this section
-                | "Model Inference" >> RunInference(model_handler=CloudVisionModelHandler()) 
-                | "Calcular Autonomia" >> #ToDo: Complete this section
+            merged_data
+                | "Calcular Autonomia" >> beam.ParDo(
+                    BatchedCalculateAutonomyDoFn() if args.autonomy_mode == 'vectorized' else CalculateAutonomyDoFn(),
+                    **autonomy_side_inputs)
         )
 
+        if args.superchargers:
+            send_data = send_data | "Find Superchargers" >> beam.ParDo(
+                FindSuperchargersDoFn(shared.Shared(), args.superchargers, k=args.superchargers_k))
+
         (
             send_data
-                | "Encode notifications" >> #ToDo: Complete this section
-                | "Write notifications to PubSub" >> #ToDo: Complete this section
+                | "Encode notifications" >> beam.Map(lambda x: json.dumps({
+                    "vehicle_id": x["vehicle_id"],
+                    "system_id": args.system_id,
+                    "message": f"Vehicle {x['vehicle_id']}: battery at {x['battery_info']['battery_level']}%, "
+                               f"estimated autonomy {x['autonomy_info']['autonomy_km']} km.",
+                    "superchargers": x.get("supercharger_info")
+                }).encode("utf-8"))
+                | "Write notifications to PubSub" >> write_notifications
         )
 
         (
             send_data
-                | "Write critical_battery_users documents" >> #ToDo: Complete this section
+                | "Write critical_battery_users documents" >> write_critical
         )
 
+    hit_rate = traffic_cache_hit_rate(p.result)
+
+    if hit_rate is not None:
+        logging.info("Traffic cache hit rate: %.1f%%", 100 * hit_rate)
 
 if __name__ == '__main__':
 
@@ -0,0 +1,178 @@
+"""
+Script: Local Transport
+
+Description: In-process stand-ins for Pub/Sub, Firestore and the traffic image services,
+    so the generator and the Dataflow pipeline can run end to end on the DirectRunner
+    without a GCP project.
+
+    The broker keeps every published message in memory. The pipeline reads the topics
+    as a bounded collection timestamped with their publish time (the same event time
+    that ReadFromPubSub assigns) and writes its outputs back to the broker.
+
+    To use the real Pub/Sub client against the official emulator instead, export
+    PUBSUB_EMULATOR_HOST before running the generator and the pipeline.
+
+EDEM. Master Big Data & Cloud 2024/2025
+Professor: Javi Briones
+"""
+
+""" Import Libraries """
+
+# A. Apache Beam Libraries
+import apache_beam as beam
+from apache_beam.ml.inference.base import ModelHandler
+
+# B. Python Libraries
+import threading
+import hashlib
+import time
+import json
+
+# C. Custom Classes
+from pubsub import percentiles
+
+""" Code: Broker """
+
+class InMemoryBroker:
+
+    """ Thread-safe, in-process registry of topics and their messages """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.topics = {}
+
+    def publish(self, topic_name: str, data: bytes):
+
+        """
+        Appends a message to a topic.
+
+        Params:
+            topic_name(str): Topic name.
+            data(bytes): Message payload.
+
+        Returns:
+            float: Publish time (epoch seconds).
+        """
+
+        published_at = time.time()
+
+        with self.lock:
+            self.topics.setdefault(topic_name, []).append((published_at, data))
+
+        return published_at
+
+    def messages(self, topic_name: str):
+
+        """
+        Returns a snapshot of the (publish time, data) pairs of a topic.
+        """
+
+        with self.lock:
+            return list(self.topics.get(topic_name, []))
+
+    def reset(self):
+
+        with self.lock:
+            self.topics.clear()
+
+# Single broker per process, shared by the generator and the DirectRunner workers
+broker = InMemoryBroker()
+
+""" Code: Publisher """
+
+class LocalPubSubMessages:
+
+    """ Drop-in replacement of PubSubMessages that publishes to the in-memory broker """
+
+    def __init__(self, project_id: str, **kwargs):
+
+        self.project_id = project_id
+
+    def publishMessages(self, payload: dict, topic_name: str, telemetry_type: str = None):
+
+        broker.publish(topic_name, json.dumps(payload).encode("utf-8"))
+
+    def publishBatch(self, payloads, topic_name: str, timeout: float = None, telemetry_type: str = None):
+
+        latencies = []
+
+        for payload in payloads:
+
+            start = time.monotonic()
+            broker.publish(topic_name, json.dumps(payload).encode("utf-8"))
+            latencies.append(time.monotonic() - start)
+
+        return {"published": len(latencies), "failed": 0, "latency": percentiles(latencies)}
+
+    def publishBatchAsync(self, payloads, topic_name: str, telemetry_type: str = None):
+
+        # The broker publishes synchronously, the pending batch is already its result
+        return self.publishBatch(payloads, topic_name, telemetry_type=telemetry_type)
+
+    def waitBatch(self, batch: dict, timeout: float = None):
+
+        return batch
+
+    def __exit__(self):
+
+        pass
+
+""" Code: Pipeline I/O """
+
+class ReadFromLocalPubSub(beam.PTransform):
+
+    """ Reads the messages of a broker topic, timestamped with their publish time """
+
+    def __init__(self, topic_name: str):
+
+        super().__init__()
+        self.topic_name = topic_name
+
+    def expand(self, pbegin):
+
+        return (
+            pbegin
+                | "Snapshot" >> beam.Create(broker.messages(self.topic_name))
+                | "Publish Time" >> beam.Map(lambda m: beam.window.TimestampedValue(m[1], m[0]))
+        )
+
+class WriteToLocalPubSub(beam.DoFn):
+
+    """ Publishes each element to a broker topic """
+
+    def __init__(self, topic_name: str):
+
+        self.topic_name = topic_name
+
+    def process(self, element):
+
+        if isinstance(element, (bytes, str)):
+            data = element if isinstance(element, bytes) else element.encode("utf-8")
+        else:
+            data = json.dumps(element, default=str).encode("utf-8")
+
+        broker.publish(self.topic_name, data)
+
+""" Code: Traffic Image Stand-ins """
+
+def getLocalTrafficImage(item, api_url=None):
+
+    """
+    Returns a deterministic pseudo image for the vehicle instead of calling the image API.
+    """
+
+    return dict(item, image_url=f"local://{item['vehicle_id']}"), hashlib.sha256(item["vehicle_id"].encode("utf-8")).digest()
+
+class LocalTrafficModelHandler(ModelHandler):
+
+    """ Scores every image of the batch from its bytes instead of calling the Vision API """
+
+    def load_model(self):
+
+        return None
+
+    def run_inference(self, batch, model, inference_args=None):
+
+        for item, image_bytes in batch:
+            yield item, image_bytes[0] / 255 * 2.5
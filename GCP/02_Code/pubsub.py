@@ -9,8 +9,9 @@ Professor: Javi Briones
 
 """ Import Libraries """
 
-# A. Python Libraries
+# A. Python Libraries
 import logging
+import time
 import json
 
 # B. Google Cloud Libraries
@@ -18,28 +19,98 @@ from google.cloud import pubsub_v1
 
 """ Code """
 
+def percentiles(values: list, points: tuple = (50, 95, 99)):
+
+    """
+    Computes nearest-rank percentiles of a list of values.
+
+    Params:
+        values(list): Values to summarize.
+        points(tuple): Percentiles to compute.
+
+    Returns:
+        dict: Percentile name (e.g. 'p50') as key and its value.
+    """
+
+    if not values:
+        return {f"p{p}": None for p in points}
+
+    ordered = sorted(values)
+
+    return {f"p{p}": ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))] for p in points}
+
 class PubSubMessages:
 
     """ Publish Messages in our PubSub Topic """
 
-    def __init__(self, project_id: str):
+    def __init__(self, project_id: str, max_messages: int = 1000, max_bytes: int = 1024 * 1024,
+                 max_latency: float = 0.05, flow_control_messages: int = 10000,
+                 flow_control_bytes: int = 64 * 1024 * 1024, encoding: str = "json"):
 
         """
         Initialize the PubSubMessages class.
 
         Params:
             project_id(str): Google Cloud Project ID.
+            max_messages(int): Maximum number of messages per publish batch.
+            max_bytes(int): Maximum size in bytes of a publish batch.
+            max_latency(float): Maximum seconds a message waits before its batch is sent.
+            flow_control_messages(int): Maximum number of outstanding messages before publishing blocks.
+            flow_control_bytes(int): Maximum outstanding bytes before publishing blocks.
+            encoding(str): "json" or "avro" (compact binary, see telemetry_schemas.py). Avro is
+                only used for the messages published with a telemetry_type.
 
         Returns: 
             -
         """
 
-        self.publisher = pubsub_v1.PublisherClient()
+        batch_settings = pubsub_v1.types.BatchSettings(
+            max_messages=max_messages,
+            max_bytes=max_bytes,
+            max_latency=max_latency)
+
+        flow_control = pubsub_v1.types.PublishFlowControl(
+            message_limit=flow_control_messages,
+            byte_limit=flow_control_bytes,
+            limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK)
+
+        self.publisher = pubsub_v1.PublisherClient(
+            batch_settings=batch_settings,
+            publisher_options=pubsub_v1.types.PublisherOptions(flow_control=flow_control))
+
         self.project_id = project_id
+        self.topic_paths = {}
+        self.avro_encoder = None
+
+        if encoding == "avro":
+            from telemetry_schemas import AvroEncoder
+            self.avro_encoder = AvroEncoder()
 
         logging.info("PubSub Client initialized.")
 
-    def publishMessages(self, payload: dict, topic_name: str):
+    def _topic_path(self, topic_name: str):
+
+        """
+        Returns the cached full path of a topic.
+        """
+
+        if topic_name not in self.topic_paths:
+            self.topic_paths[topic_name] = self.publisher.topic_path(self.project_id, topic_name)
+
+        return self.topic_paths[topic_name]
+
+    def _encode(self, payload: dict, telemetry_type: str = None):
+
+        """
+        Returns the message data and attributes of a payload.
+        """
+
+        if self.avro_encoder is not None and telemetry_type is not None:
+            return self.avro_encoder.encode(payload, telemetry_type), self.avro_encoder.attributes
+
+        return json.dumps(payload).encode("utf-8"), {}
+
+    def publishMessages(self, payload: dict, topic_name: str, telemetry_type: str = None):
 
         """
         Publishes the desired message to the specified topic.
@@ -47,19 +118,113 @@ class PubSubMessages:
         Params:
             payload(dict): Vehicle Telemetry Data Payload.
             topic_name(str): Google PubSub Topic Name.
+            telemetry_type(str): "battery", "driving" or "environment", selects the Avro schema.
 
         Returns: 
             -
 
         """
 
-        json_str = json.dumps(payload).encode("utf-8")
+        data, attributes = self._encode(payload, telemetry_type)
+
+        self.publisher.publish(self._topic_path(topic_name), data, **attributes)
+
+    def publishBatch(self, payloads, topic_name: str, timeout: float = None, telemetry_type: str = None):
+
+        """
+        Publishes an iterable of messages to the specified topic and waits for all of them.
+
+        Params:
+            payloads(iterable): Vehicle Telemetry Data Payloads.
+            topic_name(str): Google PubSub Topic Name.
+            timeout(float): Maximum seconds to wait for the publish futures.
+            telemetry_type(str): "battery", "driving" or "environment", selects the Avro schema.
+
+        Returns: 
+            dict: Number of published and failed messages and publish latency percentiles in seconds.
+
+        """
+
+        return self.waitBatch(self.publishBatchAsync(payloads, topic_name, telemetry_type), timeout)
+
+    def publishBatchAsync(self, payloads, topic_name: str, telemetry_type: str = None):
+
+        """
+        Publishes an iterable of messages to the specified topic without waiting for them.
+
+        The client groups the messages according to the batch settings and blocks
+        when the flow control limits are reached, providing backpressure to the caller.
+        Several batches can be in flight at once, so their batch delays overlap.
+
+        Params:
+            payloads(iterable): Vehicle Telemetry Data Payloads.
+            topic_name(str): Google PubSub Topic Name.
+            telemetry_type(str): "battery", "driving" or "environment", selects the Avro schema.
+
+        Returns: 
+            dict: Pending batch, to be passed to waitBatch.
+
+        """
+
+        topic_path = self._topic_path(topic_name)
+        batch = {"topic_name": topic_name, "futures": [], "sent_at": [], "done_at": []}
+
+        def _callback(index):
+
+            # Waiters can wake up before the callbacks run, so the outcome is read in waitBatch
+            batch["done_at"][index] = time.monotonic()
+
+        for payload in payloads:
+
+            data, attributes = self._encode(payload, telemetry_type)
+
+            batch["done_at"].append(None)
+            batch["sent_at"].append(time.monotonic())
+
+            future = self.publisher.publish(topic_path, data, **attributes)
+            future.add_done_callback(lambda f, index=len(batch["futures"]): _callback(index))
+            batch["futures"].append(future)
+
+        return batch
+
+    def waitBatch(self, batch: dict, timeout: float = None):
+
+        """
+        Waits for the messages of a batch returned by publishBatchAsync.
+
+        Params:
+            batch(dict): Pending batch.
+            timeout(float): Maximum seconds to wait for each publish future.
+
+        Returns: 
+            dict: Number of published and failed messages and publish latency percentiles in seconds.
+
+        """
+
+        latencies = []
+        errors = []
+
+        for index, future in enumerate(batch["futures"]):
+            try:
+                future.result(timeout=timeout)
+            except Exception as err:
+                # Timeouts are counted as failures
+                errors.append(err)
+                continue
+
+            latencies.append((batch["done_at"][index] or time.monotonic()) - batch["sent_at"][index])
+
+        if errors:
+            logging.error("Failed to publish %d messages to %s: %s", len(errors), batch["topic_name"], errors[0])
 
-        topic_path = self.publisher.topic_path(self.project_id, topic_name)
-        self.publisher.publish(topic_path, json_str)
+        return {
+            "published": len(latencies),
+            "failed": len(errors),
+            "latency": percentiles(latencies)
+        }
 
     def __exit__(self):
         
         self.publisher.transport.close()
 
-        logging.info("PubSub Client closed.")
\ No newline at end of file
+        logging.info("PubSub Client closed.")
@@ -0,0 +1,300 @@
+"""
+Script: Telemetry Record and Replay
+
+Description: Records the telemetry published by the data generator to compressed
+    newline-delimited JSON files (NDJSON.gz) and replays them into Pub/Sub at their
+    original timing, N times faster, or as fast as possible.
+
+    Every line of a recording holds the publish time, the topic, the telemetry type and the payload:
+
+        {"t": 1735689600.123, "topic": "battery-telemetry", "type": "battery", "payload": {...}}
+
+    The telemetry type selects the Avro schema when replaying with --encoding avro.
+
+    Record with the generator:
+
+        python edem_data_generator.py ... --record telemetry.ndjson.gz
+
+    Replay at 10x (use --speed 0 to replay as fast as possible):
+
+        python telemetry_replay.py --project_id <PROJECT_ID> --input telemetry.ndjson.gz --speed 10 --encoding avro
+
+EDEM. Master Big Data & Cloud 2024/2025
+Professor: Javi Briones
+"""
+
+""" Import Libraries """
+
+# A. Python Libraries
+import threading
+import argparse
+import logging
+import gzip
+import time
+import json
+
+""" Input Params """
+
+parser = argparse.ArgumentParser(description=('Telemetry Replay'))
+
+parser.add_argument(
+    '--project_id',
+    required=False,
+    default='local',
+    help='GCP Project ID.')
+
+parser.add_argument(
+    '--input',
+    required=True,
+    help='Recording to replay (NDJSON.gz).')
+
+parser.add_argument(
+    '--speed',
+    required=False,
+    type=float,
+    default=1.0,
+    help='Replay speed: 1 keeps the original timing, N replays N times faster, 0 replays as fast as possible.')
+
+parser.add_argument(
+    '--topic_prefix',
+    required=False,
+    default='',
+    help='Prefix added to the recorded topic names, e.g. to replay into test topics.')
+
+parser.add_argument(
+    '--batch_size',
+    required=False,
+    type=int,
+    default=1000,
+    help='Maximum number of messages published per batch.')
+
+parser.add_argument(
+    '--encoding',
+    required=False,
+    choices=['json', 'avro'],
+    default='json',
+    help='Wire format of the replayed messages. avro: compact binary with a versioned schema (telemetry_schemas.py).')
+
+parser.add_argument(
+    '--transport',
+    required=False,
+    choices=['pubsub', 'local'],
+    default='pubsub',
+    help='pubsub: Google Pub/Sub. local: in-process broker (local_transport).')
+
+""" Code: Recording """
+
+class TelemetryRecorder:
+
+    """ Thread-safe writer of a telemetry recording """
+
+    def __init__(self, path: str):
+
+        """
+        Params:
+            path(str): Output file (NDJSON.gz).
+        """
+
+        self.lock = threading.Lock()
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        self.count = 0
+
+    def write(self, topic_name: str, payload: dict, published_at: float = None, telemetry_type: str = None):
+
+        """
+        Appends a message to the recording.
+
+        Params:
+            topic_name(str): Topic the message was published to.
+            payload(dict): Message payload.
+            published_at(float): Publish time (epoch seconds), now by default.
+            telemetry_type(str): "battery", "driving" or "environment".
+        """
+
+        line = json.dumps({"t": published_at or time.time(), "topic": topic_name, "type": telemetry_type,
+                           "payload": payload})
+
+        with self.lock:
+            self.file.write(line + "\n")
+            self.count += 1
+
+    def close(self):
+
+        with self.lock:
+            self.file.close()
+
+        logging.info("Recorded %d messages.", self.count)
+
+class RecordingPubSubMessages:
+
+    """ Wraps a PubSubMessages publisher and records every message it publishes """
+
+    def __init__(self, publisher, recorder: TelemetryRecorder):
+
+        self.publisher = publisher
+        self.recorder = recorder
+
+    def publishMessages(self, payload: dict, topic_name: str, telemetry_type: str = None):
+
+        self.recorder.write(topic_name, payload, telemetry_type=telemetry_type)
+        self.publisher.publishMessages(payload=payload, topic_name=topic_name, telemetry_type=telemetry_type)
+
+    def publishBatch(self, payloads, topic_name: str, timeout: float = None, telemetry_type: str = None):
+
+        payloads = list(payloads)
+        published_at = time.time()
+
+        for payload in payloads:
+            self.recorder.write(topic_name, payload, published_at, telemetry_type)
+
+        return self.publisher.publishBatch(payloads=payloads, topic_name=topic_name, timeout=timeout,
+                                           telemetry_type=telemetry_type)
+
+    def publishBatchAsync(self, payloads, topic_name: str, telemetry_type: str = None):
+
+        payloads = list(payloads)
+        published_at = time.time()
+
+        for payload in payloads:
+            self.recorder.write(topic_name, payload, published_at, telemetry_type)
+
+        return self.publisher.publishBatchAsync(payloads=payloads, topic_name=topic_name,
+                                                telemetry_type=telemetry_type)
+
+    def waitBatch(self, batch: dict, timeout: float = None):
+
+        return self.publisher.waitBatch(batch, timeout)
+
+    def __exit__(self):
+
+        self.recorder.close()
+        self.publisher.__exit__()
+
+""" Code: Replay """
+
+def read_recording(path: str):
+
+    """
+    Streams the messages of a recording in file order.
+
+    Yields:
+        tuple: (publish time, topic name, telemetry type, payload). The telemetry type is None
+            in recordings made without it, whose messages are replayed as JSON.
+    """
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            message = json.loads(line)
+            yield message["t"], message["topic"], message.get("type"), message["payload"]
+
+def iter_due_batches(messages, speed: float = 1.0, batch_size: int = 1000):
+
+    """
+    Groups the messages into batches released at their replay time.
+
+    The offset of every message from the first one is divided by the speed, so bursts
+    in the recording stay bursts in the replay. With speed 0 the batches are released
+    as soon as they are full.
+
+    Params:
+        messages(iterable): (publish time, topic name, telemetry type, payload) in publish time order.
+        speed(float): Replay speed factor, 0 for as fast as possible.
+        batch_size(int): Maximum number of messages per batch.
+
+    Yields:
+        list: (topic name, telemetry type, payload) tuples due now.
+    """
+
+    batch = []
+    first = None
+    start = time.monotonic()
+
+    for published_at, topic_name, telemetry_type, payload in messages:
+
+        if first is None:
+            first = published_at
+
+        if speed > 0:
+
+            delay = start + (published_at - first) / speed - time.monotonic()
+
+            # Release what is due before waiting for the next message
+            if delay > 0:
+                if batch:
+                    yield batch
+                    batch = []
+                time.sleep(delay)
+
+        batch.append((topic_name, telemetry_type, payload))
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def replay(path: str, publisher, speed: float = 1.0, topic_prefix: str = "", batch_size: int = 1000):
+
+    """
+    Replays a recording into a PubSubMessages publisher.
+
+    Params:
+        path(str): Recording to replay.
+        publisher(PubSubMessages): Publisher with publishBatch, its encoding applies to the replay.
+        speed(float): Replay speed factor, 0 for as fast as possible.
+        topic_prefix(str): Prefix added to the recorded topic names.
+        batch_size(int): Maximum number of messages per batch.
+
+    Returns:
+        dict: Number of published and failed messages, elapsed seconds and messages/s.
+    """
+
+    published = 0
+    failed = 0
+    start = time.monotonic()
+
+    for batch in iter_due_batches(read_recording(path), speed, batch_size):
+
+        by_topic = {}
+
+        for topic_name, telemetry_type, payload in batch:
+            by_topic.setdefault((topic_prefix + topic_name, telemetry_type), []).append(payload)
+
+        for (topic_name, telemetry_type), payloads in by_topic.items():
+            result = publisher.publishBatch(payloads=payloads, topic_name=topic_name, telemetry_type=telemetry_type)
+            published += result["published"]
+            failed += result["failed"]
+
+    elapsed = time.monotonic() - start
+
+    return {
+        "published": published,
+        "failed": failed,
+        "elapsed_seconds": round(elapsed, 2),
+        "messages_per_second": round(published / max(elapsed, 1e-9), 1)
+    }
+
+""" Run """
+
+if __name__ == "__main__":
+
+    # Set Logs
+    logging.getLogger().setLevel(logging.INFO)
+
+    args, opts = parser.parse_known_args()
+
+    if args.transport == 'local':
+        from local_transport import LocalPubSubMessages as Publisher
+    else:
+        from pubsub import PubSubMessages as Publisher
+
+    publisher = Publisher(project_id=args.project_id, encoding=args.encoding)
+
+    try:
+        summary = replay(args.input, publisher, speed=args.speed,
+                         topic_prefix=args.topic_prefix, batch_size=args.batch_size)
+        logging.info("Replay summary: %s", json.dumps(summary))
+
+    finally:
+        publisher.__exit__()
@@ -0,0 +1,98 @@
+"""
+Script: Telemetry Schemas
+
+Description: Versioned Avro schemas of the telemetry events, shared by the generator
+    (pubsub.py) and the Dataflow pipeline, for the compact binary wire format.
+
+    Avro messages carry no field names, so every message is published with the
+    attributes encoding=avro and schema_version=<version>. Messages without the
+    attributes are JSON. A new schema version is added next to the previous ones,
+    so the pipeline keeps decoding messages published with older versions.
+
+    The pipeline receives these schemas as DoFn arguments at launch time, so the
+    module does not need to be installed on the Dataflow workers.
+
+EDEM. Master Big Data & Cloud 2024/2025
+Professor: Javi Briones
+"""
+
+""" Import Libraries """
+
+import io
+
+""" Schemas """
+
+SCHEMA_VERSION = 1
+
+TELEMETRY_SCHEMAS = {
+    1: {
+        "battery": {
+            "type": "record",
+            "name": "BatteryEvent",
+            "namespace": "edem.telemetry.v1",
+            "fields": [
+                {"name": "vehicle_id", "type": "string"},
+                {"name": "timestamp", "type": "string"},
+                {"name": "battery_level", "type": "int"},
+                {"name": "event_type", "type": "string"}
+            ]
+        },
+        "driving": {
+            "type": "record",
+            "name": "DrivingEvent",
+            "namespace": "edem.telemetry.v1",
+            "fields": [
+                {"name": "vehicle_id", "type": "string"},
+                {"name": "timestamp", "type": "string"},
+                {"name": "speed", "type": "double"},
+                {"name": "braking_force", "type": "double"},
+                {"name": "steering_angle", "type": "double"}
+            ]
+        },
+        "environment": {
+            "type": "record",
+            "name": "EnvironmentEvent",
+            "namespace": "edem.telemetry.v1",
+            "fields": [
+                {"name": "vehicle_id", "type": "string"},
+                {"name": "timestamp", "type": "string"},
+                {"name": "latitude", "type": "double"},
+                {"name": "longitude", "type": "double"},
+                {"name": "temperature", "type": "double"},
+                {"name": "humidity", "type": "double"}
+            ]
+        }
+    }
+}
+
+""" Code """
+
+class AvroEncoder:
+
+    """ Encodes telemetry payloads with the current schema version """
+
+    def __init__(self, version: int = SCHEMA_VERSION):
+
+        from fastavro import parse_schema, schemaless_writer
+
+        self.writer = schemaless_writer
+        self.version = version
+        self.schemas = {telemetry_type: parse_schema(schema)
+                        for telemetry_type, schema in TELEMETRY_SCHEMAS[version].items()}
+        self.attributes = {"encoding": "avro", "schema_version": str(version)}
+
+    def encode(self, payload: dict, telemetry_type: str):
+
+        """
+        Params:
+            payload(dict): Telemetry event.
+            telemetry_type(str): "battery", "driving" or "environment".
+
+        Returns:
+            bytes: The Avro encoded event (schemaless, without header).
+        """
+
+        buffer = io.BytesIO()
+        self.writer(buffer, self.schemas[telemetry_type], payload)
+
+        return buffer.getvalue()